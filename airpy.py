@@ -1,10 +1,26 @@
+import os
+import re
+import json
+import time
+import stat
 import serial
+import tempfile
 import warnings
+import threading
 import propar as pp
 import tkinter as tk
 from tkinter import ttk
 from serial.tools import list_ports
+from dataclasses import dataclass, replace
 from typing import Dict, Tuple, Any
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+
+try:
+    import fcntl
+except ImportError:
+    # Windows opens serial ports exclusively, so a second process already fails to open the port
+    fcntl = None
 
 
 #######################################################################
@@ -15,69 +31,1033 @@ from typing import Dict, Tuple, Any
 # 8: 'Measure',               # Measurement from 0-32000 (32000 = 100%)
 # 9: 'Setpoint',              # Setpoint from 0-32000 
 # 21: 'Max Output',           # Maximum output in capacity unit at 100%
+# 92: 'Serial Number',        # Serial number of the instrument
 # 129: 'Capacity Unit',       # Readout unit of the MFC at capacity
 # 205: 'fMeasure',            # Actual flow in capacity unit
 # 206: 'fSetpoint',           # Set flow in capacity unit 
 # 253: 'Standard Mass FLow'   # In units ln/min
 # }
 
+# Address propar uses for the instrument directly connected to the port
+LOCAL_ADDRESS = 0x80
+
+
+def node_name(port: str, address: int = LOCAL_ADDRESS) -> str:
+    """
+
+    :param port: Serial port of the FLOW-BUS
+    :param address: Propar node address of the instrument on the bus
+
+    :return: Name of the node, the port itself for the local instrument 
+             and port@address for other nodes on the bus, e.g. COM3@5
+
+    """
+    return port if address == LOCAL_ADDRESS else f'{port}@{address}'
+
+
+def split_node(node: str) -> tuple[str, int]:
+    """
+
+    :param node: Name of the node as made by node_name
+
+    :return: Tuple of serial port and propar node address
+
+    """
+    port, _, address = node.rpartition('@')
+    if not port or not address.isdigit():
+        return node, LOCAL_ADDRESS
+    return port, int(address)
+
+
+#######################################################################
+###-----------------Bronkhorst MFC capacity units-------------------###
+#######################################################################
+
+# Capacity units are <quantity><condition>/<time>, e.g. mln/min or kg/h, where
+# the condition is n for normal, s for standard or nothing for actual conditions.
+# Volume flows are scaled to mL<condition>/min, mass flows to g/min
+
+VOLUME_UNITS = {'l': 1000.0, 'ml': 1.0, 'ul': 0.001, 'cc': 1.0, 'm3': 1e6}
+MASS_UNITS = {'kg': 1000.0, 'g': 1.0, 'mg': 0.001, 'ug': 1e-6}
+TIME_UNITS = {'s': 60.0, 'min': 1.0, 'h': 1 / 60}
+PRETTY_QUANTITIES = {'l': 'L', 'ml': 'mL', 'ul': 'uL', 'cc': 'cc', 'm3': 'm3', 
+                     'kg': 'kg', 'g': 'g', 'mg': 'mg', 'ug': 'ug'}
+
+# Short names used on some instruments
+UNIT_ALIASES = {'sccm': 'mls/min', 'slm': 'ls/min', 'ccm': 'cc/min'}
+
+UNIT_PATTERN = re.compile(r'^(kg|mg|ug|g|m3|ml|ul|l|cc)(n|s)?/(s|min|h)$')
+
+# Measure (DDE 8) and setpoint (DDE 9) are 0-32000 for 0-100% of the capacity
+FULL_SCALE = 32000
+
+
+@dataclass(frozen=True)
+class ReadPlan:
+    """
+
+    How to read the flow of one instrument, compiled once when connecting, 
+    so reading a flow is a parameter read and a multiplication. The raw 
+    parameters are the 0-32000 integers, scaled with raw_scale to data_unit
+
+    """
+    measure_dde: int
+    setpoint_dde: int
+    scale: float
+    data_unit: str
+    pretty_unit: str
+    raw_measure_dde: int = 8
+    raw_setpoint_dde: int = 9
+    raw_scale: float|None = None
+
+
+_read_plans = {}
+
+
+def compile_read_plan(readout_unit: str, max_flow: float|None = None) -> ReadPlan:
+    """
+
+    :param readout_unit: Capacity unit of the instrument (DDE 129)
+    :param max_flow: Capacity of the instrument (DDE 21), needed to scale 
+                     the raw measure and setpoint
+
+    :return: ReadPlan reading fMeasure (DDE 205) and fSetpoint (DDE 206),
+             scaled from the capacity unit to mL/min for volume flows, 
+             g/min for mass flows and % for percentages
+
+    """
+    if readout_unit not in _read_plans:
+        _read_plans[readout_unit] = _compile_unit(readout_unit)
+    plan = _read_plans[readout_unit]
+    if max_flow is not None:
+        plan = replace(plan, raw_scale=max_flow * plan.scale / FULL_SCALE)
+    return plan
+
+
+def _compile_unit(readout_unit: str) -> ReadPlan:
+    """
+
+    :param readout_unit: Capacity unit of the instrument (DDE 129)
+
+    :return: ReadPlan of the unit without raw scaling
+
+    """
+
+    unit = readout_unit.strip()
+    key = UNIT_ALIASES.get(unit.lower(), unit.lower())
+    match = UNIT_PATTERN.match(key)
+    if key == '%':
+        plan = ReadPlan(205, 206, 1.0, '%', '%')
+    elif match is not None:
+        quantity, condition, per = match.groups()
+        condition = condition or ''
+        if quantity in VOLUME_UNITS:
+            scale = VOLUME_UNITS[quantity] * TIME_UNITS[per]
+            data_unit = f'mL{condition}/min'
+        else:
+            scale = MASS_UNITS[quantity] * TIME_UNITS[per]
+            data_unit = 'g/min'
+
+        # Normal conditions are implied in the labels of the plots
+        pretty_condition = '' if condition == 'n' else condition
+        plan = ReadPlan(205, 206, scale, data_unit, f'{PRETTY_QUANTITIES[quantity]}{pretty_condition}/{per}')
+    else:
+        warnings.warn(f'Unknown capacity unit {unit!r}, flows are read unscaled.')
+        plan = ReadPlan(205, 206, 1.0, unit, unit)
+    return plan
+
+
+#######################################################################
+###------------------Bronkhorst MFC metadata cache------------------###
+#######################################################################
+
+
+class MetadataCache:
+    def __init__(self, path: str|None = None, max_age: float = 60) -> None:
+        """
+
+        On-disk cache of the capacity (DDE 21) and capacity unit (DDE 129)
+        of every MFC, keyed by the serial number (DDE 92) of the instrument.
+        An MFC found in the cache is connected with one read of its serial
+        number. Delete the file or call forget() after reconfiguring an MFC
+
+        :param path: Path of the cache file, defaults to the home directory
+        :param max_age: Seconds a serial number read at a port is trusted
+                        without reading it again, e.g. between port discovery
+                        and the construction of the BronkhorstMFC objects
+
+        """
+
+        if path is None:
+            path = os.path.join(os.path.expanduser('~'), '.bronkhorst_mfc_metadata.json')
+        self.path = path
+        self.max_age = max_age
+        self._verified = {}
+        self._lock = threading.RLock()
+        try:
+            with open(self.path, 'r') as file:
+                self.entries = json.load(file)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def verify(self, port: str, communication: Any) -> str|None:
+        """
+
+        Reads the serial number of the instrument at a port, unless it
+        was read within max_age seconds
+
+        :param port: Serial port of the instrument, as port@address for 
+                     nodes on a FLOW-BUS
+        :param communication: Object with the propar.instrument interface for the port
+
+        :returns: Serial number of the instrument, None if it did not answer
+
+        """
+        if port in self._verified:
+            serial_number, verified = self._verified[port]
+            if time.monotonic() - verified < self.max_age:
+                return serial_number
+
+        serial_number = communication.readParameter(92)
+        if serial_number is None:
+            self._verified.pop(port, None)
+            return None
+        return self.remember(port, serial_number)
+
+    def remember(self, port: str, serial_number: str) -> str:
+        """
+
+        Marks the serial number of the instrument at a port as just read
+
+        :param port: Serial port of the instrument, as port@address for 
+                     nodes on a FLOW-BUS
+        :param serial_number: Serial number read from the instrument
+
+        :returns: The serial number without padding
+
+        """
+        serial_number = serial_number.strip()
+        self._verified[port] = (serial_number, time.monotonic())
+        return serial_number
+
+    def get(self, serial_number: str) -> dict|None:
+        """
+
+        :param serial_number: Serial number of the instrument
+
+        :returns: Dictionary with max_flow and readout_unit, None if not cached
+
+        """
+        return self.entries.get(serial_number)
+
+    def put(self, serial_number: str, max_flow: float, readout_unit: str) -> None:
+        """
+
+        Stores the settings of an instrument and writes the cache file
+
+        :param serial_number: Serial number of the instrument
+        :param max_flow: Capacity of the instrument at 100%
+        :param readout_unit: Capacity unit of the instrument
+
+        """
+        with self._lock:
+            self.entries[serial_number] = {'max_flow': max_flow, 'readout_unit': readout_unit}
+            self.save()
+
+    def forget(self, serial_number: str) -> None:
+        """
+
+        Removes an instrument, so its settings are read again on next connect
+
+        :param serial_number: Serial number of the instrument
+
+        """
+        with self._lock:
+            if self.entries.pop(serial_number, None) is not None:
+                self.save()
+
+    def save(self) -> None:
+        # Write to a temporary file first, so a crash never leaves a half written cache
+        with self._lock:
+            temp_path = f'{self.path}.tmp'
+            with open(temp_path, 'w') as file:
+                json.dump(self.entries, file, indent=2)
+            os.replace(temp_path, self.path)
+
+    def connect(self, port: str, communication: Any) -> tuple[str|None, float, str]:
+        """
+
+        Gets the settings of an instrument from the cache, or reads and
+        caches them when the instrument is not known yet
+
+        :param port: Serial port of the instrument, as port@address for 
+                     nodes on a FLOW-BUS
+        :param communication: Object with the propar.instrument interface for the port
+
+        :returns: Tuple of serial number, capacity and capacity unit
+
+        """
+        serial_number = self.verify(port, communication)
+        entry = self.get(serial_number) if serial_number is not None else None
+        if entry is not None:
+            return serial_number, entry['max_flow'], entry['readout_unit']
+
+        max_flow = float(communication.readParameter(21))
+        readout_unit = communication.readParameter(129).strip()
+        if serial_number is not None:
+            self.put(serial_number, max_flow, readout_unit)
+        return serial_number, max_flow, readout_unit
+
+
+#######################################################################
+###-------------------Bronkhorst MFC read cache---------------------###
+#######################################################################
+
+# Writing one setpoint changes the other, so both are invalidated together
+LINKED_DDE_NUMBERS = {9: (9, 206), 206: (9, 206)}
+
+
+class ReadCache:
+    def __init__(self, ttl: float = 0.2, ttls: dict[int, float]|None = None) -> None:
+        """
+
+        Short lived cache of parameter values for a BronkhorstMFC. Reads of 
+        a parameter within its TTL are answered from the cache, and reads of 
+        a parameter that is already being read by another thread wait for 
+        that request instead of sending their own
+
+        :param ttl: Seconds a read value is reused
+        :param ttls: TTL per DDE number overriding ttl, 0 disables caching 
+                     of the parameter but still shares concurrent reads
+
+        """
+
+        self.ttl = ttl
+        self.ttls = ttls if ttls is not None else {}
+        self.values = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def read(self, dde_numbers: list[int], fetch: Any) -> dict:
+        """
+
+        :param dde_numbers: Parameter numbers of parameters to read
+        :param fetch: Function reading a list of parameter numbers from the 
+                      instrument, returning a dictionary like read_bronkhorst
+
+        :returns: Dictionary with read parameter values and the parameter number
+
+        """
+
+        now = time.monotonic()
+        parameters = {}
+        missing = []
+        waiting = {}
+        with self._lock:
+            for dde in dde_numbers:
+                cached = self.values.get(dde)
+                if cached is not None and now - cached[1] < self.ttls.get(dde, self.ttl):
+                    parameters[dde] = cached[0]
+                    self.hits += 1
+                elif dde in self._in_flight:
+                    waiting[dde] = self._in_flight[dde]
+                    self.coalesced += 1
+                else:
+                    missing.append(dde)
+                    self.misses += 1
+            if missing:
+                future = Future()
+                for dde in missing:
+                    self._in_flight[dde] = future
+
+        if missing:
+            try:
+                values = fetch(missing)
+            except BaseException as e:
+                with self._lock:
+                    for dde in missing:
+                        self._in_flight.pop(dde, None)
+                future.set_exception(e)
+                raise
+            stamp = time.monotonic()
+            with self._lock:
+                for dde in missing:
+                    # Failed reads are not cached, so the next call tries again
+                    if values.get(dde) is not None:
+                        self.values[dde] = (values[dde], stamp)
+                    self._in_flight.pop(dde, None)
+            future.set_result(values)
+            parameters.update(values)
+
+        for dde, pending in waiting.items():
+            parameters[dde] = pending.result()[dde]
+        return {dde: parameters[dde] for dde in dde_numbers}
+
+    def invalidate(self, *dde_numbers: int) -> None:
+        """
+
+        Drops cached values, all of them when no DDE numbers are given
+
+        :param dde_numbers: Parameter numbers to drop
+
+        """
+        with self._lock:
+            if not dde_numbers:
+                self.values.clear()
+            for dde in dde_numbers:
+                self.values.pop(dde, None)
+
+    def stats(self) -> dict:
+        """
+
+        :returns: Dictionary with the hit, miss and coalesced read counters 
+                  and the hit rate
+
+        """
+        total = self.hits + self.misses + self.coalesced
+        return {'hits': self.hits, 
+                'misses': self.misses, 
+                'coalesced': self.coalesced,
+                'hit_rate': (self.hits + self.coalesced) / total if total else 0.0}
+
+
+#######################################################################
+###----------------Bronkhorst MFC cross-process locks---------------###
+#######################################################################
+
+
+class PortBusyError(RuntimeError):
+    def __init__(self, port: str, owner: dict|None = None) -> None:
+        """
+
+        Raised when the serial port of an MFC is owned by another process
+
+        :param port: Serial port of the MFC
+        :param owner: Dictionary the owning process published in the lock 
+                      file, with its pid and the address of its MFC broker
+
+        """
+        self.port = port
+        self.owner = owner if owner is not None else {}
+        self.pid = self.owner.get('pid')
+        self.broker = self.owner.get('broker')
+        message = f'Port {port} busy, owned by PID {self.pid if self.pid is not None else "unknown"}'
+        if self.broker is not None:
+            message += f', which serves it through the MFC broker at {self.broker}'
+        super().__init__(message)
+
+
+def port_lock_key(port: str) -> str:
+    """
+
+    :param port: Serial port of the MFC
+
+    :return: USB serial number of the adapter at the port, so the lock 
+             follows the adapter under another device name, or the device 
+             path for adapters without one, usable as a file name
+
+    """
+    device = os.path.realpath(port)
+    for info in list_ports.comports():
+        if info.serial_number and os.path.realpath(info.device) == device:
+            return re.sub(r'[^\w.-]', '_', f'usb-{info.serial_number}')
+    return re.sub(r'[^\w.-]', '_', device.strip('/\\'))
+
+
+def private_directory(path: str) -> bool:
+    """
+
+    :param path: Path of a directory
+
+    :return: True if the path is a directory (not a link) of the user, which 
+             other users cannot access
+
+    """
+    try:
+        info = os.lstat(path)
+    except OSError:
+        return False
+    return stat.S_ISDIR(info.st_mode) and info.st_uid == os.geteuid() and not info.st_mode & 0o077
+
+
+def port_lock_dir() -> str:
+    """
+
+    :return: Directory of the port lock files only the user can access, 
+             XDG_RUNTIME_DIR or a 0700 directory in the temporary directory,
+             as the owner of a lock may publish the key of its broker
+
+    :raises PermissionError: When the directory exists but is not private
+
+    """
+    if not hasattr(os, 'geteuid'):
+        return tempfile.gettempdir()
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir and private_directory(runtime_dir):
+        return runtime_dir
+    lock_dir = os.path.join(tempfile.gettempdir(), f'bronkhorst_mfc-{os.geteuid()}')
+    try:
+        os.mkdir(lock_dir, 0o700)
+    except FileExistsError:
+        pass
+    if not private_directory(lock_dir):
+        raise PermissionError(f'Lock directory {lock_dir} is accessible by other users!')
+    return lock_dir
+
+
+class PortLock:
+    def __init__(self, port: str, lock_dir: str|None = None) -> None:
+        """
+
+        Advisory lock on the serial device of an MFC, shared by all 
+        processes of the user through a lock file. The owner writes its PID
+        to the file, and the lock is released by the OS if the owner dies
+
+        :param port: Serial port of the MFC
+        :param lock_dir: Directory of the lock files, defaults to port_lock_dir()
+
+        """
+        self.port = port
+        self.key = port_lock_key(port)
+        self.path = os.path.join(lock_dir if lock_dir is not None else port_lock_dir(), 
+                                 f'bronkhorst_mfc_{self.key}.lock')
+        self.users = 0
+        self._file = None
+
+    def acquire(self) -> None:
+        """
+
+        :raises PortBusyError: When another process holds the lock
+
+        """
+        if fcntl is None:
+            return
+
+        # Only readable by the user, as the owner may publish the key of its broker.
+        # A link or a file of another user in place of the lock file is not used
+        try:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+        except PermissionError:
+            raise PortBusyError(self.port)
+        info = os.fstat(fd)
+        if info.st_uid != os.geteuid() or info.st_mode & 0o077:
+            os.close(fd)
+            raise PermissionError(f'Lock file {self.path} is accessible by other users!')
+        file = os.fdopen(fd, 'r+')
+        try:
+            fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            file.close()
+            raise PortBusyError(self.port, self.owner())
+        self._file = file
+        self.publish()
+
+    def owner(self) -> dict|None:
+        """
+
+        :returns: Dictionary the owner published, None if it has not yet
+
+        """
+        try:
+            with open(self.path, 'r') as file:
+                return json.loads(file.read() or 'null')
+        except (OSError, ValueError):
+            return None
+
+    def publish(self, **info: Any) -> None:
+        """
+
+        Writes the PID of the process and further info to the lock file
+
+        :param info: Values for other processes, e.g. the address of a broker
+
+        """
+        if self._file is None:
+            return
+        self._file.seek(0)
+        self._file.truncate()
+        json.dump({'pid': os.getpid(), 'port': self.port, **info}, self._file)
+        self._file.flush()
+
+    def release(self) -> None:
+        # The file is left in place, removing it would let two processes lock different files
+        if self._file is None:
+            return
+        fcntl.flock(self._file, fcntl.LOCK_UN)
+        self._file.close()
+        self._file = None
+
+
+_port_locks = {}
+_port_locks_lock = threading.Lock()
+
+
+def acquire_port_lock(port: str) -> PortLock:
+    """
+
+    :param port: Serial port of the MFC
+
+    :return: The PortLock of the port, shared by all users in this process,
+             e.g. the nodes of a FLOW-BUS
+
+    :raises PortBusyError: When another process owns the port
+
+    """
+    key = port_lock_key(port)
+    with _port_locks_lock:
+        if key not in _port_locks:
+            lock = PortLock(port)
+            lock.acquire()
+            _port_locks[key] = lock
+        _port_locks[key].users += 1
+        return _port_locks[key]
+
+
+def release_port_lock(lock: PortLock) -> bool:
+    """
+
+    :param lock: PortLock from acquire_port_lock
+
+    :return: True if this was the last user and the port was unlocked
+
+    """
+    with _port_locks_lock:
+        lock.users -= 1
+        if lock.users > 0:
+            return False
+        lock.release()
+        if _port_locks.get(lock.key) is lock:
+            del _port_locks[lock.key]
+        return True
+
+
+#######################################################################
+###-------------------Resilient Bronkhorst MFC I/O------------------###
+#######################################################################
+
+# Propar statuses of a request that got no valid answer, which are worth sending again
+TRANSIENT_STATUSES = (pp.PP_STATUS_TIMEOUT_ANSWER, 
+                      pp.PP_STATUS_NO_ANSWER_FOUND, 
+                      pp.PP_STATUS_TIMEOUT_START_CHAR,
+                      pp.PP_STATUS_TIMEOUT_SERIAL_LINE, 
+                      pp.PP_STATUS_NO_START_CHARACTER, 
+                      pp.PP_STATUS_SYNC_ERROR,
+                      pp.PP_STATUS_SEND_ERROR, 
+                      pp.PP_STATUS_COMMUNICATION_ERROR, 
+                      pp.PP_STATUS_ERROR_SERIAL_PORT,
+                      pp.PP_STATUS_PROTOCOL_ERROR)
+
+
+class ResilientInstrument:
+    def __init__(self, 
+                 port: str, 
+                 address: int = LOCAL_ADDRESS,
+                 timeout: float = 0.5,
+                 deadline: float = 2.0,
+                 retries: int = 3,
+                 backoff: float = 0.05,
+                 reopen_after: int = 2) -> None:
+        """
+
+        propar.instrument for a port that survives glitches of the USB 
+        adapter. Requests without a valid answer are sent again with an 
+        exponential backoff, and the port is closed and opened again when 
+        it raises or after several failed requests in a row. A call gives 
+        up after its retries or its deadline, and then fails like propar:
+        None for readParameter, False for writeParameter and an error 
+        status for chained requests. Use one thread per port, e.g. a 
+        PortWorker, as reopening the port replaces the shared propar master
+
+        :param port: Serial port of the Bronkhorst MFC
+        :param address: Propar node address of the MFC
+        :param timeout: Seconds to wait for the answer to a single request
+        :param deadline: Seconds a call may take including all retries
+        :param retries: Number of times a failed request is sent again
+        :param backoff: Seconds before the first retry, doubled on every retry
+        :param reopen_after: Failed requests in a row after which the port is reopened
+
+        """
+
+        self.port = port
+        self.comport = port
+        self.address = address
+        self.timeout = timeout
+        self.deadline = deadline
+        self.retries = retries
+        self.backoff = backoff
+        self.reopen_after = reopen_after
+        self.stats = {'calls': 0, 'retries': 0, 'reopens': 0, 'failures': 0}
+        self.on_retry = None
+
+        # Called after the port was opened again, the instrument may have reset
+        self.on_reopen = None
+        self._failures_in_row = 0
+
+        self.instrument = None
+        self._open()
+        self.db = self.instrument.db
+
+    def __getattr__(self, name: str) -> Any:
+        if name == 'instrument':
+            raise AttributeError(name)
+        return getattr(self.instrument, name)
+
+    def _open(self) -> None:
+        self.instrument = pp.instrument(self.port, address=self.address)
+        self.instrument.master.response_timeout = self.timeout
+
+    def rebind(self, port: str) -> None:
+        """
+
+        Moves the instrument to another serial port, e.g. after the adapter 
+        was enumerated under a new device name
+
+        :param port: New serial port of the instrument
+
+        """
+        if self.instrument is not None:
+            close_instrument(self.instrument)
+            self.instrument = None
+        self.port = port
+        self.comport = port
+        self._failures_in_row = 0
+        self._open()
+
+    def reopen(self) -> None:
+        """
+
+        Closes the port and opens it again, the port stays closed until the 
+        next call if the adapter is not back yet
+
+        """
+        self.stats['reopens'] += 1
+        if self.instrument is not None:
+            close_instrument(self.instrument)
+            self.instrument = None
+        try:
+            self._open()
+        except (serial.SerialException, OSError):
+            return
+        if self.on_reopen is not None:
+            self.on_reopen()
+
+    def _call(self, name: str, failed: Any, failure: Any, *args) -> Any:
+        """
+
+        :param name: Method of propar.instrument to call
+        :param failed: Function telling if the result of the call failed
+        :param failure: Result returned when no attempt succeeded
+
+        :returns: Result of the first successful attempt, or failure
+
+        """
+        self.stats['calls'] += 1
+        deadline = time.monotonic() + self.deadline
+        attempt = 0
+        while True:
+            result = failure
+            raised = False
+            if self.instrument is None:
+                self.reopen()
+            if self.instrument is not None:
+                try:
+                    result = getattr(self.instrument, name)(*args)
+                except (serial.SerialException, OSError):
+                    # A vanished adapter raises from pyserial, a closed port is reopened above
+                    result = failure
+                    raised = True
+            if not raised and not failed(result):
+                self._failures_in_row = 0
+                return result
+
+            self._failures_in_row += 1
+            if raised or self._failures_in_row >= self.reopen_after:
+                self._failures_in_row = 0
+                self.reopen()
+
+            attempt += 1
+            delay = self.backoff * 2 ** (attempt - 1)
+            if attempt > self.retries or time.monotonic() + delay >= deadline:
+                self.stats['failures'] += 1
+                return result if result is not None else failure
+            self.stats['retries'] += 1
+            if self.on_retry is not None:
+                self.on_retry()
+            time.sleep(delay)
+
+    def readParameter(self, dde_nr: int, channel: int|None = None) -> Any:
+        return self._call('readParameter', lambda value: value is None, None, dde_nr, channel)
+
+    def writeParameter(self, dde_nr: int, data: Any, channel: int|None = None) -> bool:
+        return self._call('writeParameter', lambda result: not result, False, dde_nr, data, channel)
+
+    def read_parameters(self, parameters: list[dict], callback=None, channel: int|None = None) -> Any:
+        if callback is not None:
+            return self.instrument.read_parameters(parameters, callback, channel)
+        failed = lambda response: not response or any(r.get('status') in TRANSIENT_STATUSES for r in response)
+        failure = [{'status': pp.PP_STATUS_TIMEOUT_ANSWER, 'data': None}]
+        return self._call('read_parameters', failed, failure, parameters, None, channel)
+
+    def write_parameters(self, parameters: list[dict], command: int = pp.PP_COMMAND_SEND_PARM_WITH_ACK,
+                         callback=None, channel: int|None = None) -> Any:
+        if callback is not None:
+            return self.instrument.write_parameters(parameters, command, callback, channel)
+        return self._call('write_parameters', lambda status: status in TRANSIENT_STATUSES, pp.PP_STATUS_TIMEOUT_ANSWER,
+                          parameters, command, None, channel)
+
+
 #######################################################################
 ###-----------------Bronkhorst MFC Controller setup-----------------###
 #######################################################################
 
 
 class BronkhorstMFC:
-    def __init__(self, port: str) -> None:
+    def __init__(self, 
+                 port: str, 
+                 communication: Any = None, 
+                 metadata_cache: MetadataCache|None = None, 
+                 address: int = LOCAL_ADDRESS,
+                 read_cache: ReadCache|None = None,
+                 resilient: bool = False) -> None:
         """
         
         Initializes the BronkhorstMFC class by reading the port of a 
         connected Bronkhorst MFC
+
+        :param port: Serial port of the connected Bronkhorst MFC
+        :param communication: Object with the propar.instrument interface to 
+                              use instead of opening the port, e.g. a 
+                              propar_sim.SimulatedInstrument
+        :param metadata_cache: MetadataCache to take the capacity and capacity
+                               unit from instead of reading them from the MFC
+        :param address: Propar node address of the MFC, the default 0x80 is 
+                        the instrument connected to the port. Several MFCs 
+                        on one FLOW-BUS share the port and its propar master
+        :param read_cache: ReadCache to answer repeated and concurrent reads 
+                           from, reads always go to the MFC when None
+        :param resilient: Open the port as a ResilientInstrument, which retries 
+                          failed requests and reopens the port after a glitch
+
+        :raises PortBusyError: When another process owns the port, see PortLock
         
         """
-        pretty_units = {'mln/min': 'mL/min', 'ln/min': 'L/min'}
-
         self.port = port
-        self.communication = pp.instrument(self.port)
-        self.max_flow = float(self.communication.readParameter(21))
-        self.readout_unit = self.communication.readParameter(129).strip()
-        self.data_unit = None
-        self.pretty_unit = pretty_units[self.readout_unit]
+        self.address = address
+        self.node = node_name(port, address)
+
+        # A port opened here is locked, so no other process interleaves frames on it
+        self.port_lock = None
+        if communication is None:
+            self.port_lock = acquire_port_lock(port)
+            try:
+                if resilient:
+                    communication = ResilientInstrument(self.port, address)
+                else:
+                    communication = pp.instrument(self.port, address=address)
+            except BaseException:
+                release_port_lock(self.port_lock)
+                raise
+        self.communication = communication
+        self.serial_number = None
+        if metadata_cache is not None:
+            self.serial_number, self.max_flow, self.readout_unit = metadata_cache.connect(self.node, communication)
+        else:
+            self.max_flow = float(self.communication.readParameter(21))
+            self.readout_unit = self.communication.readParameter(129).strip()
+        self.read_plan = compile_read_plan(self.readout_unit, self.max_flow)
+        self.data_unit = self.read_plan.data_unit
+        self.pretty_unit = self.read_plan.pretty_unit
 
-    def read_bronkhorst(self, dde_numbers: list[int]) -> dict:
+        # Propar parameter definitions are looked up once per DDE number 
+        # and reused for every chained request
+        self.parameters = {}
+        self.read_timing = {}
+        self.read_cache = read_cache
+
+        # Called without arguments after the port was reopened or rebound, when 
+        # the MFC may have lost its setpoint, e.g. SetpointWriter.forget
+        self.reset_callbacks = []
+        if isinstance(communication, ResilientInstrument):
+            communication.on_reopen = self._reset
+
+        # Held for every request and while the port is swapped by rebind, so
+        # threads writing setpoints directly never use a half-moved instrument
+        self._lock = threading.RLock()
+
+    def read_bronkhorst(self, dde_numbers: list[int], batched: bool = True) -> dict:
         """
         
         :param dde_numbers: Parameter numbers of parameters to read
+        :param batched: Read a list of parameters in one chained request
+                        instead of one request per parameter
         
         :returns: Dictionary with read parameter values and the parameter number
         """
 
         if type(dde_numbers) == int:
-            parameters = {dde_numbers: self.communication.readParameter(dde_numbers)}
-        elif type(dde_numbers) == list:
-            parameters = {dde: self.communication.readParameter(dde) for dde in dde_numbers}
-        else:
+            dde_numbers = [dde_numbers]
+        elif type(dde_numbers) != list:
             raise ValueError('Please input the dde numbers to be checked as integers or a list of intgers!')
+
+        if self.read_cache is not None:
+            return self.read_cache.read(dde_numbers, lambda missing: self._read(missing, batched))
+        return self._read(dde_numbers, batched)
+
+    def _read(self, dde_numbers: list[int], batched: bool) -> dict:
+        if batched and len(dde_numbers) > 1:
+            return self.read_bronkhorst_batch(dde_numbers)
+        return self._read_single(dde_numbers)
+
+    def read_bronkhorst_batch(self, dde_numbers: list[int]) -> dict:
+        """
+        
+        Reads all parameters in a single chained propar request, so the 
+        whole list only costs one serial round trip. The timing of the 
+        call is stored in self.read_timing
+        
+        :param dde_numbers: Parameter numbers of parameters to read
+        
+        :returns: Dictionary with read parameter values and the parameter number,
+                  values that could not be read are None as for readParameter
+        """
+
+        start = time.perf_counter()
+        request = [dict(self._parameter(dde)) for dde in dde_numbers]
+        prepared = time.perf_counter()
+        with self._lock:
+            response = self.communication.read_parameters(request)
+        received = time.perf_counter()
+
+        # A failed request returns a single status item instead of one item per parameter
+        if response is None or len(response) != len(dde_numbers):
+            parameters = {dde: None for dde in dde_numbers}
+        else:
+            parameters = {dde: (resp['data'] if resp.get('status', pp.PP_STATUS_OK) == pp.PP_STATUS_OK else None)
+                          for dde, resp in zip(dde_numbers, response)}
+        done = time.perf_counter()
+
+        self.read_timing = {'mode': 'batched', 
+                            'round_trips': 1, 
+                            'prepare': prepared - start,
+                            'bus': received - prepared,
+                            'unpack': done - received, 
+                            'total': done - start}
+        return parameters
+
+    def _read_single(self, dde_numbers: list[int]) -> dict:
+        """
+        
+        Reads the parameters with one propar request per parameter
+
+        :param dde_numbers: Parameter numbers of parameters to read
+
+        :returns: Dictionary with read parameter values and the parameter number
+        """
+
+        start = time.perf_counter()
+        parameters = {}
+        per_dde = {}
+        with self._lock:
+            for dde in dde_numbers:
+                sent = time.perf_counter()
+                parameters[dde] = self.communication.readParameter(dde)
+                per_dde[dde] = time.perf_counter() - sent
+        done = time.perf_counter()
+
+        self.read_timing = {'mode': 'single', 
+                            'round_trips': len(dde_numbers), 
+                            'bus': sum(per_dde.values()),
+                            'per_dde': per_dde,
+                            'total': done - start}
         return parameters
+
+    def _parameter(self, dde_number: int) -> dict:
+        """
+        
+        :param dde_number: Parameter number to look up in the propar database
+
+        :returns: Propar parameter definition (process, parameter and type)
+        """
+
+        if dde_number not in self.parameters:
+            try:
+                self.parameters[dde_number] = self.communication.db.get_parameter(dde_number)
+            except KeyError:
+                raise ValueError(f'DDE parameter number {dde_number} is not known by propar!')
+        return self.parameters[dde_number]
     
-    def write_bronkhorst(self, dde_number: int, value: Any) -> None:
+    def write_bronkhorst(self, dde_number: int, value: Any) -> bool:
         """
 
         :param dde_number: Parameter number for the parameter to be written
         :param value: Value to write to the parameter number
+
+        :returns: True if the MFC acknowledged the write, False as for 
+                  writeParameter when it did not
         
         """
         
-        self.communication.writeParameter(dde_number, value)
+        with self._lock:
+            written = self.communication.writeParameter(dde_number, value)
+        if self.read_cache is not None:
+            self.read_cache.invalidate(*LINKED_DDE_NUMBERS.get(dde_number, (dde_number,)))
+        return written
+
+    def rebind(self, port: str) -> None:
+        """
+
+        Moves the MFC to another serial port without reading its settings 
+        again, e.g. when its USB adapter was enumerated under a new device 
+        name. A propar.instrument is replaced by one on the new port, a 
+        ResilientInstrument (also behind a wrapper) is moved in place. 
+        Requests of other threads wait until the MFC is moved
+
+        :param port: New serial port of the MFC
+
+        """
+
+        with self._lock:
+            if hasattr(self.communication, 'rebind'):
+                self.communication.rebind(port)
+            else:
+                close_instrument(self.communication)
+                self.communication = pp.instrument(port, address=self.address)
+            self.port = port
+            self.node = node_name(port, self.address)
+            self._reset()
+
+    def _reset(self) -> None:
+        if self.read_cache is not None:
+            self.read_cache.invalidate()
+        for callback in self.reset_callbacks:
+            callback()
+
+    def close(self) -> None:
+        """
+
+        Releases the lock of the port, and closes the port when no other 
+        node of the process uses it
+
+        """
+        if self.port_lock is not None and release_port_lock(self.port_lock):
+            close_instrument(self.communication)
+        self.port_lock = None
 
 class Arduino:
     def __init__(self) -> None:
         pass
 
-    def find_arduino_port(self) -> serial.Serial:
+    def find_arduino_port(self, baudrate: int = 9600, timeout: float|None = None) -> serial.Serial:
         '''
         
         Finds the port for all connected Arduino boards
 
+        :param baudrate: Baud rate set in the sketch running on the Arduino
+        :param timeout: Read timeout of the port in seconds, None blocks
+
         :returns: serial.Serial object for the connected Arduino
         
         '''
@@ -104,8 +1084,216 @@ class Arduino:
             #if len(arduino_ports)+1 < arduino_to_use or arduino_to_use <= 0:
             #    raise ValueError(port_error)
             
-        return serial.Serial(arduino_ports[0], 9600)
-    
+        return serial.Serial(arduino_ports[0], baudrate, timeout=timeout)
+
+
+# Fields of an Arduino line are separated by commas, semicolons, tabs or spaces,
+# and are either bare numbers or named as name:value or name=value
+ARDUINO_FIELD_SEPARATORS = re.compile(r'[,;\s]+')
+
+
+def parse_arduino_line(line: str) -> dict:
+    """
+
+    :param line: Line sent by the Arduino, e.g. 'co2:412.5,o2:20.9' or '412.5 20.9'
+
+    :return: Dictionary of the values as floats, bare numbers are named by 
+             their position in the line starting at 0
+
+    :raises ValueError: When a field is not a number
+
+    """
+    values = {}
+    for idx, field in enumerate(f for f in ARDUINO_FIELD_SEPARATORS.split(line.strip()) if f):
+        name, separator, value = field.partition(':') if ':' in field else field.partition('=')
+        values[name if separator else str(idx)] = float(value if separator else field)
+    if not values:
+        raise ValueError('Empty line')
+    return values
+
+
+@dataclass
+class ArduinoRecord:
+    """
+
+    One parsed line from the Arduino, time is the time.time() and monotonic
+    the time.monotonic() at which the bytes of the line were received
+
+    """
+    time: float
+    monotonic: float
+    values: dict
+    line: str
+
+
+class ArduinoReader:
+    def __init__(self, 
+                 port: str|None = None, 
+                 baudrate: int = 9600, 
+                 history: int = 1000, 
+                 buffer_size: int = 4096,
+                 parse: Any = None, 
+                 connection: Any = None) -> None:
+        """
+
+        Reads an Arduino on a background thread, so no control loop ever 
+        waits for a readline. Received bytes are collected in a bounded 
+        buffer and split into lines as they arrive, every line is parsed and
+        stamped with its arrival time. The latest value of every field and
+        a bounded history of records are kept for the other threads
+
+        :param port: Serial port of the Arduino, found with Arduino().find_arduino_port when None
+        :param baudrate: Baud rate set in the sketch running on the Arduino
+        :param history: Number of records kept
+        :param buffer_size: Bytes kept of an unfinished line, the oldest bytes 
+                            are dropped if no line end arrives
+        :param parse: Function parsing a line into a dictionary of values, 
+                      defaults to parse_arduino_line
+        :param connection: Open object with the serial.Serial interface to 
+                           read from instead of opening the port
+
+        """
+
+        if connection is None and port is None:
+            connection = Arduino().find_arduino_port(baudrate, timeout=0.1)
+        elif connection is None:
+            connection = serial.Serial(port, baudrate, timeout=0.1)
+        self.connection = connection
+        self.port = getattr(connection, 'port', port)
+        self.parse = parse if parse is not None else parse_arduino_line
+        self.buffer_size = buffer_size
+        self.history = deque(maxlen=history)
+        self.on_record = None
+        self.stats = {'bytes': 0, 'lines': 0, 'parse_errors': 0, 'dropped_bytes': 0}
+
+        self._buffer = bytearray()
+        self._scanned = 0
+        self._latest = {}
+        self._lock = threading.Lock()
+        self._running = False
+        self._thread = None
+
+    def start(self) -> 'ArduinoReader':
+        # Bytes sent before the reader started belong to a line that may be cut off
+        self.connection.reset_input_buffer()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name=f'arduino-{self.port}', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, timeout: float = 2.0) -> None:
+        """
+
+        Stops the reading thread. A read waiting for data is cancelled, so 
+        the thread also ends on a port opened without a read timeout
+
+        :param timeout: Seconds to wait for the thread to end
+
+        """
+        self._running = False
+        if self._thread is None:
+            return
+        cancel_read = getattr(self.connection, 'cancel_read', None)
+        if cancel_read is not None:
+            cancel_read()
+        self._thread.join(timeout)
+        if not self._thread.is_alive():
+            self._thread = None
+
+    def close(self) -> None:
+        self.stop()
+        self.connection.close()
+
+        # A read that could not be cancelled ends with the port
+        if self._thread is not None:
+            self._thread.join(1.0)
+            self._thread = None
+
+    def _run(self) -> None:
+        while self._running:
+            try:
+                # Wait for the first byte up to the port timeout, then take all that arrived
+                data = self.connection.read(max(1, self.connection.in_waiting))
+            except (serial.SerialException, OSError):
+                if self._running:
+                    time.sleep(0.1)
+                continue
+            if data:
+                self.feed(data, time.time(), time.monotonic())
+
+    def feed(self, data: bytes, received: float, monotonic: float) -> list[ArduinoRecord]:
+        """
+
+        Adds received bytes to the buffer and parses the lines completed by them
+
+        :param data: Received bytes
+        :param received: time.time() at which the bytes arrived
+        :param monotonic: time.monotonic() at which the bytes arrived
+
+        :returns: List of the new records
+
+        """
+        self.stats['bytes'] += len(data)
+        self._buffer += data
+        records = []
+
+        # Only the new bytes are searched for line ends
+        start = 0
+        end = self._buffer.find(b'\n', self._scanned)
+        while end != -1:
+            line = self._buffer[start:end].decode('ascii', errors='replace').strip()
+            start = end + 1
+            end = self._buffer.find(b'\n', start)
+            if not line:
+                continue
+            self.stats['lines'] += 1
+            try:
+                values = self.parse(line)
+            except ValueError:
+                self.stats['parse_errors'] += 1
+                continue
+            records.append(ArduinoRecord(received, monotonic, values, line))
+        del self._buffer[:start]
+        if len(self._buffer) > self.buffer_size:
+            self.stats['dropped_bytes'] += len(self._buffer) - self.buffer_size
+            del self._buffer[:len(self._buffer) - self.buffer_size]
+        self._scanned = len(self._buffer)
+
+        if records:
+            with self._lock:
+                self.history.extend(records)
+                for record in records:
+                    for name, value in record.values.items():
+                        self._latest[name] = (value, record.time)
+            if self.on_record is not None:
+                for record in records:
+                    self.on_record(record)
+        return records
+
+    def latest(self, max_age: float|None = None) -> dict:
+        """
+
+        :param max_age: Seconds after which a value is left out as stale
+
+        :returns: Dictionary of the latest value of every field
+
+        """
+        now = time.time()
+        with self._lock:
+            return {name: value for name, (value, stamp) in self._latest.items() 
+                    if max_age is None or now - stamp <= max_age}
+
+    def records(self, since: float|None = None) -> list[ArduinoRecord]:
+        """
+
+        :param since: time.time() after which records are returned, all kept when None
+
+        :returns: List of the kept records, oldest first
+
+        """
+        with self._lock:
+            return [record for record in self.history if since is None or record.time > since]
+
 
 class DropdownMenu:
     def __init__(self, root: tk.Tk, options: list[str]) -> None:
@@ -169,11 +1357,222 @@ class DropdownMenu:
         return self.selected_value
 
 
-def find_bronkhorst_ports() -> dict:
+# Propar parameter holding the node address of the instrument answering
+NODE_ADDRESS_PARAMETER = {'proc_nr': 0, 'parm_nr': 1, 'parm_type': pp.PP_TYPE_INT8}
+
+
+@dataclass
+class PortProbe:
+    """
+    
+    Result of probing a serial port for a Bronkhorst MFC
+
+    """
+    port: str
+    found: bool = False
+    serial_number: str|None = None
+    max_flow: float|None = None
+    readout_unit: str|None = None
+    address: int|None = None
+    latency: float|None = None
+    error: str|None = None
+    busy: bool = False
+
+
+def close_instrument(instrument: Any) -> None:
+    """
+
+    Closes the serial port of a propar.instrument, and removes its master
+    so a later propar.instrument on the port opens it again
+
+    :param instrument: propar.instrument to close
+
+    """
+
+    master = getattr(instrument, 'master', None)
+    if master is None:
+        return
+    try:
+        master.propar.run = False
+        master.stop()
+    except Exception:
+        pass
+    if pp._PROPAR_MASTERS.get(instrument.comport) is master:
+        del pp._PROPAR_MASTERS[instrument.comport]
+
+
+def bronkhorst_candidate_ports() -> list[str]:
+    """
+
+    :return: List of serial ports of FTDI adapters, which the MFCs connect through
+
+    """
+    return [p.device for p in list_ports.comports() if p.manufacturer 
+            is not None and 'FTDI' in p.manufacturer]
+
+
+def probe_bronkhorst_port(port: str, 
+                          address: int = LOCAL_ADDRESS,
+                          metadata_cache: MetadataCache|None = None, 
+                          response_timeout: float = 0.2) -> PortProbe:
+    """
+
+    Probes a serial port for a Bronkhorst MFC with one chained read of the 
+    node address, serial number, capacity and capacity unit. Ports opened 
+    by the probe are closed again
+
+    :param port: Serial port to probe
+    :param address: Propar node address to probe
+    :param metadata_cache: MetadataCache to take the capacity and capacity 
+                           unit of known MFCs from
+    :param response_timeout: Seconds to wait for an answer from the port
+
+    :return: PortProbe with the result
+
+    """
+
+    start = time.perf_counter()
+    probe = PortProbe(port)
+
+    # A port already opened by this process is in use, and is left open.
+    # A port of another process is not touched at all
+    owned = port not in pp._PROPAR_MASTERS
+    mfc = None
+    lock = None
+    try:
+        if owned:
+            lock = acquire_port_lock(port)
+        mfc = pp.instrument(port, address=address)
+        if owned:
+            mfc.master.response_timeout = response_timeout
+        dde_numbers = [92] if metadata_cache is not None else [92, 21, 129]
+        request = [dict(NODE_ADDRESS_PARAMETER)] + [mfc.db.get_parameter(dde) for dde in dde_numbers]
+        response = mfc.read_parameters(request)
+        if len(response) == len(request) and all(r.get('status') == pp.PP_STATUS_OK for r in response):
+            probe.found = True
+            probe.address = response[0]['data']
+            probe.serial_number = response[1]['data'].strip()
+            if metadata_cache is not None:
+                node = node_name(port, address)
+                metadata_cache.remember(node, probe.serial_number)
+                _, probe.max_flow, probe.readout_unit = metadata_cache.connect(node, mfc)
+            else:
+                probe.max_flow = float(response[2]['data'])
+                probe.readout_unit = response[3]['data'].strip()
+        else:
+            probe.error = f'No answer, propar status {response[0].get("status")}'
+    except PortBusyError as e:
+        probe.error = str(e)
+        probe.busy = True
+    except Exception as e:
+        probe.error = repr(e)
+    finally:
+        if owned and mfc is not None:
+            close_instrument(mfc)
+        if lock is not None:
+            release_port_lock(lock)
+    probe.latency = time.perf_counter() - start
+    return probe
+
+
+def probe_bronkhorst_ports(ports: list[str]|None = None, 
+                           metadata_cache: MetadataCache|None = None, 
+                           deadline: float = 2.0) -> list[PortProbe]:
+    """
+
+    Probes all ports at the same time, so discovery takes as long as the 
+    slowest port instead of the sum of all ports
+
+    :param ports: Serial ports to probe, defaults to all FTDI adapters
+    :param metadata_cache: MetadataCache to take the capacity and capacity 
+                           unit of known MFCs from
+    :param deadline: Seconds after which ports that have not answered are given up
+
+    :return: List of PortProbe results in the order of the ports
+
+    """
+
+    if ports is None:
+        ports = bronkhorst_candidate_ports()
+    if not ports:
+        return []
+
+    executor = ThreadPoolExecutor(max_workers=len(ports), thread_name_prefix='mfc-probe')
+    futures = [executor.submit(probe_bronkhorst_port, port, metadata_cache=metadata_cache) for port in ports]
+    wait(futures, timeout=deadline)
+
+    # Probes past the deadline keep running in the background and close their port when done
+    executor.shutdown(wait=False, cancel_futures=True)
+    probes = []
+    for port, future in zip(ports, futures):
+        if future.done() and not future.cancelled():
+            probes.append(future.result())
+        else:
+            probes.append(PortProbe(port, latency=deadline, error=f'No answer within {deadline} s'))
+    return probes
+
+
+def scan_bronkhorst_bus(port: str, 
+                        metadata_cache: MetadataCache|None = None, 
+                        response_timeout: float = 0.2) -> list[PortProbe]:
+    """
+
+    Enumerates all nodes on the FLOW-BUS behind a port and probes each of 
+    them through the same propar master. The port is closed again, unless 
+    it was already open in this process
+
+    :param port: Serial port of the FLOW-BUS
+    :param metadata_cache: MetadataCache to take the capacity and capacity 
+                           unit of known MFCs from
+    :param response_timeout: Seconds to wait for an answer from a node
+
+    :return: List of PortProbe results, one per node in bus order
+
+    """
+
+    owned = port not in pp._PROPAR_MASTERS
+    lock = acquire_port_lock(port) if owned else None
+    try:
+        local = pp.instrument(port)
+        try:
+            if owned:
+                local.master.response_timeout = response_timeout
+            nodes = local.master.get_nodes()
+            return [probe_bronkhorst_port(port, address=node['address'], metadata_cache=metadata_cache) 
+                    for node in nodes]
+        finally:
+            if owned:
+                close_instrument(local)
+    finally:
+        if lock is not None:
+            release_port_lock(lock)
+
+
+def connect_bronkhorst_bus(port: str, metadata_cache: MetadataCache|None = None) -> list[BronkhorstMFC]:
+    """
+
+    :param port: Serial port of the FLOW-BUS
+    :param metadata_cache: MetadataCache to take the capacity and capacity 
+                           unit of known MFCs from
+
+    :return: List of BronkhorstMFC objects for every MFC on the bus, all 
+             sharing the propar master of the port
+
+    """
+    return [BronkhorstMFC(port, metadata_cache=metadata_cache, address=probe.address) 
+            for probe in scan_bronkhorst_bus(port, metadata_cache) if probe.found]
+
+
+def find_bronkhorst_ports(metadata_cache: MetadataCache|None = None, deadline: float = 2.0) -> dict:
     """
 
     Finds all relevant serial ports that might have MFC connections
 
+    :param metadata_cache: MetadataCache to take the capacity and capacity 
+                           unit of known MFCs from, so only their serial 
+                           number is read
+    :param deadline: Seconds after which ports that have not answered are given up
+
     :return: Dictionary of connected Bronkhorst MFC's with 
              associated flow rates as a dictionary
     
@@ -182,20 +1581,53 @@ def find_bronkhorst_ports() -> dict:
     # Connect to the local instrument, when no settings provided
     # defaults to locally connected instrument (address=0x80, baudrate=38400)
     mfcs = {}
-    mfc_ports = [p.device for p in list_ports.comports() if 'FTDI' 
-                in p.manufacturer and p.manufacturer is not None]
-    for port in mfc_ports:
-        mfc = pp.instrument(port)
-        if mfc.readParameter(8) is not None:
-            flowrate = str(mfc.readParameter(21))[:3]
-            mfcs[f'{flowrate} {mfc.readParameter(129).strip()}'] = port
-            print(f'MFC with flowrate {flowrate} {mfc.readParameter(129).strip()} found at port {port}')
+    for probe in probe_bronkhorst_ports(metadata_cache=metadata_cache, deadline=deadline):
+        if probe.found:
+            flowrate = str(probe.max_flow)[:3]
+            mfcs[f'{flowrate} {probe.readout_unit}'] = probe.port
+            print(f'MFC with flowrate {flowrate} {probe.readout_unit} found at port {probe.port}')
+        elif probe.busy:
+            print(probe.error)
         else:
-            print(f'MFC not found at port {port}')
-            pass
+            print(f'MFC not found at port {probe.port}')
     return mfcs
 
 
+def compare_read_paths(bh_mfc: BronkhorstMFC, 
+                       dde_numbers: tuple[int, ...] = (8, 9, 205, 206), 
+                       repeats: int = 20) -> dict:
+    """
+
+    Reads the same parameters with one request per parameter and with 
+    one chained request, and prints the average timing of both paths. 
+    The read cache of the MFC is bypassed, so every repeat is timed on the bus
+
+    :param bh_mfc: BronkhorstMFC object to read from
+    :param dde_numbers: Parameter numbers to read on every repeat
+    :param repeats: Number of reads to average over
+
+    :return: Dictionary with the average total and bus time of each path
+    """
+
+    timings = {}
+    for batched in (False, True):
+        total = bus = 0
+        for _ in range(repeats):
+            bh_mfc._read(list(dde_numbers), batched)
+            total += bh_mfc.read_timing['total']
+            bus += bh_mfc.read_timing['bus']
+        timings[bh_mfc.read_timing['mode']] = {'total': total / repeats, 
+                                               'bus': bus / repeats,
+                                               'round_trips': bh_mfc.read_timing['round_trips']}
+
+    speedup = timings['single']['total'] / timings['batched']['total']
+    print(f'Reading DDE {dde_numbers} at port {bh_mfc.port}: '
+          f'single {timings["single"]["total"]*1000:.2f} ms ({timings["single"]["round_trips"]} round trips), '
+          f'batched {timings["batched"]["total"]*1000:.2f} ms (1 round trip), {speedup:.1f}x faster')
+    timings['speedup'] = speedup
+    return timings
+
+
 if __name__ =='__main__':
     mfc_port_connections = find_bronkhorst_ports()
     print(mfc_port_connections)
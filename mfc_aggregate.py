@@ -0,0 +1,192 @@
+import math
+import numpy as np
+from dataclasses import dataclass
+
+#######################################################################
+###------------------Streaming flow aggregation---------------------###
+#######################################################################
+
+# Statistics stored per MFC for every interval, in column order
+AGGREGATE_FIELDS = ('mean', 'min', 'max', 'std', 'count')
+
+
+class StreamingStats:
+    def __init__(self, channels: int) -> None:
+        """
+
+        Running count, mean, standard deviation (Welford), minimum and
+        maximum of several channels at once, in constant memory. NaN
+        values are gaps and left out of the statistics of their channel
+
+        :param channels: Number of channels, e.g. one per MFC
+
+        """
+        self.channels = channels
+        self.reset()
+
+    def reset(self) -> None:
+        self.count = np.zeros(self.channels, dtype=np.int64)
+        self.mean = np.zeros(self.channels)
+        self.min = np.full(self.channels, np.inf)
+        self.max = np.full(self.channels, -np.inf)
+        self._m2 = np.zeros(self.channels)
+
+    def add(self, values: list[float]) -> None:
+        """
+
+        :param values: One value per channel, NaN for a missing value
+
+        """
+        x = np.asarray(values, dtype=np.float64)
+        valid = ~np.isnan(x)
+        self.count += valid
+        delta = np.where(valid, x - self.mean, 0.0)
+        self.mean += np.where(valid, delta / np.maximum(self.count, 1), 0.0)
+        self._m2 += np.where(valid, delta * (x - self.mean), 0.0)
+        self.min = np.fmin(self.min, x)
+        self.max = np.fmax(self.max, x)
+
+    @property
+    def std(self) -> np.ndarray:
+        # Sample standard deviation, NaN with less than two values
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.count > 1, np.sqrt(self._m2 / (self.count - 1)), np.nan)
+
+    def result(self) -> dict:
+        """
+
+        :returns: Dictionary of arrays per AGGREGATE_FIELDS, NaN for channels without values
+
+        """
+        empty = self.count == 0
+        return {'mean': np.where(empty, np.nan, self.mean),
+                'min': np.where(empty, np.nan, self.min),
+                'max': np.where(empty, np.nan, self.max),
+                'std': self.std,
+                'count': self.count.copy()}
+
+
+@dataclass
+class FlowInterval:
+    """
+
+    Statistics of the samples of one interval, start is the epoch time the
+    interval began and every other field has one value per MFC
+
+    """
+    start: float
+    mean: np.ndarray
+    min: np.ndarray
+    max: np.ndarray
+    std: np.ndarray
+    count: np.ndarray
+
+    def values(self) -> list[float]:
+        """
+
+        :returns: Flat list of the statistics, per MFC in AGGREGATE_FIELDS order
+
+        """
+        return [getattr(self, field)[idx].item() for idx in range(len(self.mean)) for field in AGGREGATE_FIELDS]
+
+
+class FlowAggregator:
+    def __init__(self, channels: int, interval: float|None = 1.0, rate: float = 20.0, raw_seconds: float = 10.0) -> None:
+        """
+
+        Turns high rate flow samples into per-interval statistics, e.g. 20 Hz
+        polling stored at 1 Hz, while the last raw_seconds of raw samples are
+        kept in a ring buffer for the live view. Memory does not grow with
+        the number of samples. Intervals are aligned to whole multiples of
+        interval on the sample clock
+
+        :param channels: Number of values per sample, e.g. one per MFC
+        :param interval: Seconds aggregated into one interval, None when the 
+                         caller ends every interval with finish()
+        :param rate: Expected samples per second, sizes the ring buffer
+        :param raw_seconds: Seconds of raw samples kept
+
+        """
+
+        self.channels = channels
+        self.interval = interval
+        self.stats = StreamingStats(channels)
+        size = max(1, int(math.ceil(rate * raw_seconds)))
+        self._raw_times = np.full(size, np.nan)
+        self._raw_values = np.full((size, channels), np.nan)
+        self._raw_next = 0
+        self._raw_count = 0
+        self._slot = None
+        self._start = None
+
+    def add(self, timestamp: float, values: list[float]) -> FlowInterval|None:
+        """
+
+        :param timestamp: Epoch time of the sample, e.g. time.time()
+        :param values: One flow per channel, NaN for a gap
+
+        :returns: The interval completed by this sample, None while the
+                  current interval continues
+
+        """
+        slot = math.floor(timestamp / self.interval) if self.interval is not None else 0
+        finished = None
+        if self._slot is not None and slot != self._slot:
+            finished = self.finish()
+        if self._slot is None:
+            self._start = slot * self.interval if self.interval is not None else timestamp
+        self._slot = slot
+        self.stats.add(values)
+
+        self._raw_times[self._raw_next] = timestamp
+        self._raw_values[self._raw_next] = values
+        self._raw_next = (self._raw_next + 1) % len(self._raw_times)
+        self._raw_count = min(self._raw_count + 1, len(self._raw_times))
+        return finished
+
+    def finish(self) -> FlowInterval|None:
+        """
+
+        Ends the current interval, e.g. when acquisition stops
+
+        :returns: The statistics of the interval, None if it has no samples
+
+        """
+        if self._slot is None:
+            return None
+        interval = FlowInterval(self._start, **self.stats.result())
+        self.stats.reset()
+        self._slot = None
+        return interval
+
+    def raw(self) -> tuple[np.ndarray, np.ndarray]:
+        """
+
+        :returns: Tuple of the times and values of the kept raw samples, oldest first
+
+        """
+        size = len(self._raw_times)
+        order = (np.arange(self._raw_count) + self._raw_next - self._raw_count) % size
+        return self._raw_times[order], self._raw_values[order]
+
+    def latest(self) -> np.ndarray|None:
+        """
+
+        :returns: Values of the last sample, None before the first sample
+
+        """
+        if self._raw_count == 0:
+            return None
+        return self._raw_values[self._raw_next - 1].copy()
+
+
+def aggregate_headers(headers: str) -> str:
+    """
+
+    :param headers: Header of a log with a date column and one column per MFC
+
+    :return: Header with a column per statistic in AGGREGATE_FIELDS for every MFC
+
+    """
+    date, *columns = [column.strip() for column in headers.split(',')]
+    return ','.join([date] + [f'{column} {field}' for column in columns for field in AGGREGATE_FIELDS])
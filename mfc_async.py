@@ -0,0 +1,146 @@
+import asyncio
+from typing import Any
+from concurrent.futures import Future, wait
+from bronkhorst_mfc_test.airpy import BronkhorstMFC
+from bronkhorst_mfc_test.mfc_logger_v1 import read_bh_flow, read_bh_set, scale_raw
+from bronkhorst_mfc_test.mfc_port_worker import PortWorker, port_worker, READ_PRIORITY
+
+#######################################################################
+###------------------Asyncio Bronkhorst MFC driver------------------###
+#######################################################################
+
+
+class AsyncBronkhorstMFC:
+    def __init__(self, bh_mfc: BronkhorstMFC) -> None:
+        """
+
+        Wraps a BronkhorstMFC with awaitable reads and writes. The blocking
+        serial I/O runs on the worker thread of the MFC's port, so MFCs on
+        independent ports can be polled concurrently with asyncio.gather.
+        The port and worker follow the MFC when it is rebound to a new port
+
+        :param bh_mfc: BronkhorstMFC object to wrap
+
+        """
+
+        self.mfc = bh_mfc
+        self.max_flow = bh_mfc.max_flow
+        self.readout_unit = bh_mfc.readout_unit
+        self.pretty_unit = bh_mfc.pretty_unit
+        self.data_unit = bh_mfc.data_unit
+        self.read_plan = bh_mfc.read_plan
+
+    @property
+    def port(self) -> str:
+        return self.mfc.port
+
+    @property
+    def worker(self) -> PortWorker:
+        return port_worker(self.mfc.port)
+
+    @classmethod
+    async def connect(cls, port: str, **kwargs) -> 'AsyncBronkhorstMFC':
+        """
+
+        Opens the port and reads the MFC settings without blocking the event loop
+
+        :param port: Serial port of the connected Bronkhorst MFC
+        :param kwargs: Keyword arguments passed on to BronkhorstMFC
+
+        :returns: AsyncBronkhorstMFC for the connected MFC
+
+        """
+        bh_mfc = await asyncio.wrap_future(port_worker(port).submit(lambda: BronkhorstMFC(port, **kwargs)))
+        return cls(bh_mfc)
+
+    def _submit(self, function, *args) -> Future:
+        return self.worker.submit(function, *args, priority=READ_PRIORITY)
+
+    async def _run(self, function, *args) -> Any:
+        return await asyncio.wrap_future(self._submit(function, *args))
+
+    async def read_bronkhorst(self, dde_numbers: list[int], batched: bool = True) -> dict:
+        """
+
+        :param dde_numbers: Parameter numbers of parameters to read
+        :param batched: Read a list of parameters in one chained request
+
+        :returns: Dictionary with read parameter values and the parameter number
+
+        """
+        return await self._run(self.mfc.read_bronkhorst, dde_numbers, batched)
+
+    async def write_bronkhorst(self, dde_number: int, value: Any) -> bool:
+        """
+
+        :param dde_number: Parameter number for the parameter to be written
+        :param value: Value to write to the parameter number
+
+        :returns: True if the MFC acknowledged the write, False when it did not
+
+        """
+        return await asyncio.wrap_future(self.worker.submit_write(self.mfc, dde_number, value))
+
+    async def read_flow(self, raw: bool = False) -> float:
+        """
+
+        :param raw: Read the 0-32000 measure (DDE 8) instead of fMeasure (DDE 205)
+
+        :returns: Float of the current flow in mLn/min
+
+        """
+        return await self._run(read_bh_flow, self.mfc, raw)
+
+    async def read_setpoint(self, raw: bool = False) -> float:
+        """
+
+        :param raw: Read the 0-32000 setpoint (DDE 9) instead of fSetpoint (DDE 206)
+
+        :returns: Float of the current setpoint in mLn/min
+
+        """
+        return await self._run(read_bh_set, self.mfc, raw)
+
+
+async def read_flows(async_mfcs: list[AsyncBronkhorstMFC], raw: bool = False) -> list[float]:
+    """
+
+    Reads the flow of all MFCs concurrently, so a poll takes as long as
+    the slowest port instead of the sum of all ports. Raw measures are
+    scaled for all MFCs in one step, see scale_raw
+
+    :param async_mfcs: List of AsyncBronkhorstMFC objects to read
+    :param raw: Read the 0-32000 measure (DDE 8) instead of fMeasure (DDE 205)
+
+    :return: List of the current flows in mLn/min in the order of async_mfcs,
+             NaN for MFCs that did not answer
+
+    """
+    if raw:
+        answers = await asyncio.gather(*(mfc.read_bronkhorst(mfc.read_plan.raw_measure_dde) for mfc in async_mfcs))
+        raw_values = [answer[mfc.read_plan.raw_measure_dde] for answer, mfc in zip(answers, async_mfcs)]
+        return scale_raw(raw_values, async_mfcs).tolist()
+    return list(await asyncio.gather(*(mfc.read_flow(raw) for mfc in async_mfcs)))
+
+
+def poll_flows(async_mfcs: list[AsyncBronkhorstMFC], raw: bool = False) -> list[float]:
+    """
+
+    Blocking version of read_flows for loops without an event loop. The 
+    reads are queued on the port workers at once and their futures waited 
+    on directly, so a poll does not set up an event loop
+
+    :param async_mfcs: List of AsyncBronkhorstMFC objects to read
+    :param raw: Read the 0-32000 measure (DDE 8) instead of fMeasure (DDE 205)
+
+    :return: List of the current flows in mLn/min in the order of async_mfcs
+
+    """
+    if raw:
+        futures = [mfc._submit(mfc.mfc.read_bronkhorst, mfc.read_plan.raw_measure_dde) for mfc in async_mfcs]
+        wait(futures)
+        raw_values = [future.result()[mfc.read_plan.raw_measure_dde] for future, mfc in zip(futures, async_mfcs)]
+        return scale_raw(raw_values, async_mfcs).tolist()
+    futures = [mfc._submit(read_bh_flow, mfc.mfc, raw) for mfc in async_mfcs]
+    wait(futures)
+    return [future.result() for future in futures]
@@ -0,0 +1,105 @@
+import time
+import numpy as np
+from bronkhorst_mfc_test.airpy import BronkhorstMFC
+from bronkhorst_mfc_test.mfc_logger_v1 import read_bh_flows, scale_raw, ACQUISITION_MODES
+from bronkhorst_mfc_test.propar_pty import ProparPtyEmulator
+from bronkhorst_mfc_test.propar_sim import SimulatedInstrument
+
+#######################################################################
+###--------------Bronkhorst MFC acquisition benchmarks--------------###
+#######################################################################
+
+
+def benchmark_acquisition_modes(bronkhorsts: list[BronkhorstMFC],
+                                emulators: list[ProparPtyEmulator]|None = None,
+                                polls: int = 200) -> dict:
+    """
+
+    Polls the flow of all MFCs in every acquisition mode and compares the
+    poll rate, and with emulated ports also the bytes on the wire per poll
+
+    :param bronkhorsts: BronkhorstMFC objects to poll
+    :param emulators: ProparPtyEmulator objects serving the ports, to count bytes
+    :param polls: Number of polls per mode
+
+    :return: Dictionary per mode with polls per second, time per poll and
+             conversion, and request and answer bytes per poll
+
+    """
+
+    results = {}
+    for mode in ACQUISITION_MODES:
+        read_bh_flows(bronkhorsts, mode)
+        before = [dict(emulator.stats) for emulator in emulators or []]
+
+        durations = np.empty(polls)
+        for idx in range(polls):
+            start = time.perf_counter()
+            read_bh_flows(bronkhorsts, mode)
+            durations[idx] = time.perf_counter() - start
+
+        result = {'polls_per_second': float(polls / durations.sum()),
+                  'mean_poll': float(durations.mean()),
+                  'p95_poll': float(np.percentile(durations, 95))}
+        if emulators:
+            result['request_bytes'] = sum(e.stats['bytes_received'] - b['bytes_received']
+                                          for e, b in zip(emulators, before)) / polls
+            result['answer_bytes'] = sum(e.stats['bytes_sent'] - b['bytes_sent']
+                                         for e, b in zip(emulators, before)) / polls
+        results[mode] = result
+
+    # Conversion cost alone per poll, the float path scales the parsed float of every 
+    # MFC as read_bh_flow does and the raw path scales all MFCs at once with scale_raw.
+    # With a few MFCs the raw conversion is the slower one, e.g. 5 us against 1 us for two
+    raw_values = np.random.randint(0, 32000, size=(polls, len(bronkhorsts))).tolist()
+    float_values = (np.array(raw_values) / 32000 * [bh_mfc.max_flow for bh_mfc in bronkhorsts]).tolist()
+    start = time.perf_counter()
+    for values in float_values:
+        [float(value) * bh_mfc.read_plan.scale for value, bh_mfc in zip(values, bronkhorsts)]
+    results['float']['conversion'] = (time.perf_counter() - start) / polls
+    start = time.perf_counter()
+    for values in raw_values:
+        scale_raw(values, bronkhorsts)
+    results['raw']['conversion'] = (time.perf_counter() - start) / polls
+
+    for mode, result in results.items():
+        line = (f'{mode:>5}: {result["polls_per_second"]:.1f} polls/s, {result["mean_poll"]*1000:.2f} ms per poll, '
+                f'{result["conversion"]*1e6:.1f} us conversion')
+        if emulators:
+            line += f', {result["request_bytes"]:.0f} B request + {result["answer_bytes"]:.0f} B answer per poll'
+        print(line)
+    return results
+
+
+def emulated_benchmark(configs: list[tuple[float, str]] = [(100, 'mln/min'), (2.5, 'ln/min')],
+                       polls: int = 200) -> dict:
+    """
+
+    Runs benchmark_acquisition_modes on emulated serial ports, one per MFC
+
+    :param configs: Capacity and capacity unit of each emulated MFC
+    :param polls: Number of polls per mode
+
+    :return: Dictionary with the results of benchmark_acquisition_modes
+
+    """
+
+    emulators = []
+    for idx, (max_flow, unit) in enumerate(configs):
+        emulator = ProparPtyEmulator([SimulatedInstrument(max_flow=max_flow,
+                                                          capacity_unit=unit,
+                                                          serial_number=f'M{idx:08d}A')])
+        emulators.append(emulator)
+    bronkhorsts = []
+    try:
+        bronkhorsts = [BronkhorstMFC(emulator.port) for emulator in emulators]
+        return benchmark_acquisition_modes(bronkhorsts, emulators, polls)
+    finally:
+        for bh_mfc in bronkhorsts:
+            bh_mfc.close()
+        for emulator in emulators:
+            emulator.disconnect()
+
+
+if __name__ == '__main__':
+    emulated_benchmark()
@@ -0,0 +1,365 @@
+import os
+import sys
+import time
+import errno
+import socket
+import threading
+import multiprocessing
+from typing import Any
+from multiprocessing.connection import Listener, Client, Connection
+from bronkhorst_mfc_test.airpy import BronkhorstMFC, ReadCache, PortBusyError, split_node, compile_read_plan, port_lock_dir
+from bronkhorst_mfc_test.mfc_port_worker import QueuedBronkhorstMFC
+
+#######################################################################
+###-----------------Bronkhorst MFC acquisition broker---------------###
+#######################################################################
+
+# Requests are tuples of (operation, port, *arguments) and every request
+# is answered with ('ok', result) or ('error', exception)
+# {
+# 'list':  ()                            -> {port: info} for all MFCs
+# 'info':  (port,)                       -> max_flow, readout_unit, pretty_unit
+# 'read':  (port, dde_numbers, batched)  -> {dde: value}
+# 'write': (port, dde_number, value)     -> True if the MFC acknowledged the write
+# 'stats': ()                            -> {port: read cache counters}
+# 'stop':  ()                            -> None, shuts the broker down
+# }
+
+
+def default_broker_address() -> str:
+    """
+
+    :return: Address of the broker, a Unix socket in the private directory 
+             of the port locks (see port_lock_dir) or a named pipe on Windows
+
+    """
+    if sys.platform == 'win32':
+        return r'\\.\pipe\bronkhorst_mfc_broker'
+    return os.path.join(port_lock_dir(), 'bronkhorst_mfc_broker.sock')
+
+
+class MFCBroker:
+    def __init__(self, 
+                 ports: list[str], 
+                 address: str|None = None, 
+                 authkey: bytes|None = None, 
+                 cache_ttl: float|None = None) -> None:
+        """
+
+        Owns every MFC port of the rig and serves reads and writes to client
+        processes, so no process but the broker ever holds a serial handle
+
+        :param ports: Serial ports of the connected Bronkhorst MFCs, nodes on
+                      a FLOW-BUS as port@address (see airpy.node_name)
+        :param address: Address to listen on, defaults to default_broker_address()
+        :param authkey: Key the clients must authenticate with
+        :param cache_ttl: Seconds a read value is shared between clients, 
+                          e.g. the flows polled by both logger and controller.
+                          Every read goes to the MFC when None
+
+        """
+
+        self.address = address if address is not None else default_broker_address()
+        self.authkey = authkey if authkey is not None else bytes(multiprocessing.current_process().authkey)
+
+        # All I/O on a port goes through its worker, also with several clients
+        # connected or several nodes on the bus of the port
+        self.bronkhorsts = {}
+        for node in ports:
+            port, node_address = split_node(node)
+            read_cache = ReadCache(cache_ttl) if cache_ttl is not None else None
+            self.bronkhorsts[node] = QueuedBronkhorstMFC(BronkhorstMFC(port, address=node_address, read_cache=read_cache, 
+                                                                       resilient=True))
+        self._stopped = threading.Event()
+        self._listener = None
+
+    def info(self, port: str) -> dict:
+        """
+
+        :param port: Serial port of the MFC
+
+        :returns: Dictionary with the settings of the MFC read at connect time
+
+        """
+        bh_mfc = self.bronkhorsts[port]
+        return {'max_flow': bh_mfc.max_flow, 'readout_unit': bh_mfc.readout_unit, 'pretty_unit': bh_mfc.pretty_unit}
+
+    def handle(self, request: tuple) -> Any:
+        """
+
+        :param request: Tuple of operation, port and arguments
+
+        :returns: Result of the request
+
+        """
+        operation, *arguments = request
+        if operation == 'list':
+            return {port: self.info(port) for port in self.bronkhorsts}
+        elif operation == 'info':
+            return self.info(arguments[0])
+        elif operation == 'read':
+            port, dde_numbers, batched = arguments
+            return self.bronkhorsts[port].read_bronkhorst(dde_numbers, batched)
+        elif operation == 'write':
+            port, dde_number, value = arguments
+            return self.bronkhorsts[port].write_bronkhorst(dde_number, value)
+        elif operation == 'stats':
+            return {port: bh_mfc.mfc.read_cache.stats() for port, bh_mfc in self.bronkhorsts.items() 
+                    if bh_mfc.mfc.read_cache is not None}
+        elif operation == 'stop':
+            self.stop()
+            return None
+        raise ValueError(f'Unknown broker operation: {operation}')
+
+    def serve_client(self, conn: Connection) -> None:
+        """
+
+        Answers the requests of one client until it disconnects
+
+        """
+        with conn:
+            while not self._stopped.is_set():
+                try:
+                    request = conn.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    response = ('ok', self.handle(request))
+                except Exception as e:
+                    response = ('error', e)
+                try:
+                    conn.send(response)
+                except (OSError, ValueError):
+                    return
+
+    def serve_forever(self, ready: Any = None) -> None:
+        """
+
+        Accepts clients until a stop request is received
+
+        :param ready: Event set when the broker accepts connections
+
+        :raises OSError: With errno.EADDRINUSE when another broker serves the address
+
+        """
+
+        # A socket file left by a killed broker would block the address, 
+        # the socket of a running broker is left alone
+        if sys.platform != 'win32' and os.path.exists(self.address):
+            with socket.socket(socket.AF_UNIX) as probe:
+                try:
+                    probe.connect(self.address)
+                except OSError:
+                    os.remove(self.address)
+                else:
+                    raise OSError(errno.EADDRINUSE, f'Another MFC broker is serving at {self.address}!')
+
+        self._listener = Listener(self.address, authkey=self.authkey)
+        print(f'MFC broker serving {", ".join(self.bronkhorsts)} at {self.address}')
+
+        # Processes finding a port busy can attach to the broker instead, see open_mfc.
+        # The key is only published in lock files the user alone can read, see port_lock_dir
+        for bh_mfc in self.bronkhorsts.values():
+            if bh_mfc.mfc.port_lock is not None:
+                bh_mfc.mfc.port_lock.publish(broker=self.address, authkey=self.authkey.hex())
+        if ready is not None:
+            ready.set()
+        try:
+            while not self._stopped.is_set():
+                try:
+                    conn = self._listener.accept()
+                except (OSError, EOFError, multiprocessing.AuthenticationError):
+                    continue
+                threading.Thread(target=self.serve_client, args=(conn,), daemon=True).start()
+        finally:
+            self._listener.close()
+
+    def stop(self) -> None:
+        """
+
+        Stops accepting clients and closes the listener
+
+        """
+        self._stopped.set()
+
+        # Wake up the accept call of serve_forever with a connection of our own
+        try:
+            Client(self.address, authkey=self.authkey).close()
+        except OSError:
+            pass
+
+
+def run_broker(ports: list[str], address: str, authkey: bytes, ready: Any = None, cache_ttl: float|None = None) -> None:
+    """
+
+    Process target running a broker for the given ports
+
+    :param ports: Serial ports of the connected Bronkhorst MFCs
+    :param address: Address to listen on
+    :param authkey: Key the clients must authenticate with
+    :param ready: Event set when the broker accepts connections
+    :param cache_ttl: Seconds a read value is shared between clients
+
+    """
+    MFCBroker(ports, address, authkey, cache_ttl).serve_forever(ready)
+
+
+def start_broker(ports: list[str], 
+                 address: str|None = None, 
+                 timeout: float = 30, 
+                 cache_ttl: float|None = None) -> tuple[multiprocessing.Process, str]:
+    """
+
+    Starts the broker in its own process and waits until it accepts clients
+
+    :param ports: Serial ports of the connected Bronkhorst MFCs
+    :param address: Address to listen on, defaults to default_broker_address()
+    :param timeout: Seconds to wait for the broker to open all ports
+    :param cache_ttl: Seconds a read value is shared between clients
+
+    :return: Tuple of the broker process and its address
+
+    """
+    address = address if address is not None else default_broker_address()
+    authkey = bytes(multiprocessing.current_process().authkey)
+    ready = multiprocessing.Event()
+    broker = multiprocessing.Process(target=run_broker, args=(ports, address, authkey, ready, cache_ttl), daemon=True)
+    broker.start()
+
+    # A broker that cannot open its ports or address exits without setting ready
+    deadline = time.monotonic() + timeout
+    while not ready.wait(0.1):
+        if not broker.is_alive():
+            raise RuntimeError(f'MFC broker exited with code {broker.exitcode} before accepting clients.')
+        if time.monotonic() > deadline:
+            broker.terminate()
+            raise TimeoutError(f'MFC broker did not start within {timeout} s.')
+    return broker, address
+
+
+class BrokerMFC:
+    def __init__(self, port: str, address: str|None = None, authkey: bytes|None = None) -> None:
+        """
+
+        Client side stand-in for a BronkhorstMFC owned by the broker process.
+        Safe to use from several threads, as requests on the connection are serialized
+
+        :param port: Serial port of the MFC in the broker
+        :param address: Address of the broker, defaults to default_broker_address()
+        :param authkey: Key to authenticate with, defaults to the key of the process
+                        tree, which is shared with a broker started by start_broker
+
+        """
+
+        self.port = port
+        self.address = address if address is not None else default_broker_address()
+        authkey = authkey if authkey is not None else bytes(multiprocessing.current_process().authkey)
+        self._conn = Client(self.address, authkey=authkey)
+        self._lock = threading.Lock()
+
+        info = self._request('info', port)
+        self.max_flow = info['max_flow']
+        self.readout_unit = info['readout_unit']
+        self.pretty_unit = info['pretty_unit']
+        self.read_plan = compile_read_plan(self.readout_unit, self.max_flow)
+        self.data_unit = self.read_plan.data_unit
+
+    def _request(self, *request) -> Any:
+        with self._lock:
+            self._conn.send(request)
+            status, result = self._conn.recv()
+        if status == 'error':
+            raise result
+        return result
+
+    def read_bronkhorst(self, dde_numbers: list[int], batched: bool = True) -> dict:
+        """
+
+        :param dde_numbers: Parameter numbers of parameters to read
+        :param batched: Read a list of parameters in one chained request
+
+        :returns: Dictionary with read parameter values and the parameter number
+
+        """
+        return self._request('read', self.port, dde_numbers, batched)
+
+    def write_bronkhorst(self, dde_number: int, value: Any) -> bool:
+        """
+
+        :param dde_number: Parameter number for the parameter to be written
+        :param value: Value to write to the parameter number
+
+        :returns: True if the MFC acknowledged the write, False when it did not
+
+        """
+        return self._request('write', self.port, dde_number, value)
+
+    def close(self) -> None:
+        self._conn.close()
+
+
+def open_mfc(node: str, attach: bool = True, **kwargs) -> BronkhorstMFC|BrokerMFC:
+    """
+
+    Opens an MFC, or attaches to the broker of the process owning its port
+
+    :param node: Serial port of the MFC, as port@address for nodes on a FLOW-BUS
+    :param attach: Connect as a client when the owner of the port serves it
+                   through a broker, instead of raising PortBusyError
+    :param kwargs: Keyword arguments passed on to BronkhorstMFC
+
+    :return: BronkhorstMFC object, or a BrokerMFC when attached to the owner
+
+    :raises PortBusyError: When the port is owned by another process that
+                           cannot be attached to
+
+    """
+    port, node_address = split_node(node)
+    try:
+        return BronkhorstMFC(port, address=node_address, **kwargs)
+    except PortBusyError as e:
+        if not attach or e.broker is None or 'authkey' not in e.owner:
+            raise
+        print(f'{e}, attaching as a client')
+        return BrokerMFC(node, e.broker, bytes.fromhex(e.owner['authkey']))
+
+
+def connect_bronkhorsts(address: str|None = None, authkey: bytes|None = None) -> list[BrokerMFC]:
+    """
+
+    :param address: Address of the broker, defaults to default_broker_address()
+    :param authkey: Key to authenticate with
+
+    :return: List of BrokerMFC objects for every MFC of the broker, in the
+             order the ports were given to the broker
+
+    :raises Exception: The error of the broker when it could not list its MFCs
+
+    """
+    address = address if address is not None else default_broker_address()
+    authkey = authkey if authkey is not None else bytes(multiprocessing.current_process().authkey)
+    with Client(address, authkey=authkey) as conn:
+        conn.send(('list',))
+        status, ports = conn.recv()
+    if status == 'error':
+        raise ports
+    return [BrokerMFC(port, address, authkey) for port in ports]
+
+
+def stop_broker(address: str|None = None, authkey: bytes|None = None) -> None:
+    """
+
+    :param address: Address of the broker, defaults to default_broker_address()
+    :param authkey: Key to authenticate with
+
+    """
+    address = address if address is not None else default_broker_address()
+    authkey = authkey if authkey is not None else bytes(multiprocessing.current_process().authkey)
+    with Client(address, authkey=authkey) as conn:
+        conn.send(('stop',))
+
+        # The broker process may exit before its answer is sent
+        try:
+            conn.recv()
+        except EOFError:
+            pass
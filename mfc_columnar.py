@@ -0,0 +1,366 @@
+import os
+import re
+import csv
+import glob
+import gzip
+import json
+import numpy as np
+import datetime as dt
+
+#######################################################################
+###-------------------Columnar flow log storage---------------------###
+#######################################################################
+
+# Timestamps are epoch seconds, flows are float32 with a column per channel
+TIME_DTYPE = np.dtype('<f8')
+FLOW_DTYPE = np.dtype('<f4')
+
+# Timestamp formats of the csv logs, data_logging and flow_plot files, and
+# the str() of a datetime written by cancel_program
+CSV_TIME_FORMATS = ('%Y-%m-%d %H:%M:%S', '%d/%m/%Y %H:%M:%S', '%Y-%m-%d %H:%M:%S.%f')
+
+INDEX_NAME = 'index.json'
+
+
+def to_epoch(timestamp: float|dt.datetime|None) -> float|None:
+    """
+
+    :param timestamp: Epoch seconds, or a datetime in local time if naive
+
+    :return: Epoch seconds, None for None
+
+    """
+    if isinstance(timestamp, dt.datetime):
+        return timestamp.timestamp()
+    return timestamp
+
+
+class ColumnarLog:
+    def __init__(self,
+                 directory: str,
+                 channels: list[str]|None = None,
+                 chunk_rows: int = 86400,
+                 flush_rows: int = 60) -> None:
+        """
+
+        Append-only binary flow log. Rows are stored in chunks of chunk_rows
+        rows, every chunk is a file of float64 timestamps and a file of
+        float32 flows, and a sidecar index.json holds the channels and the
+        time range of every chunk. A time range is read by picking the
+        chunks from the index and bisecting their memory mapped timestamps,
+        so nothing is parsed and only the rows of the range are loaded
+
+        :param directory: Directory of the store, created if it does not exist
+        :param channels: Names of the flow columns, required for a new store
+                         and checked against the index of an existing one
+        :param chunk_rows: Rows per chunk file, a day at 1 Hz by default
+        :param flush_rows: Rows collected before they are appended to the files
+
+        """
+
+        self.directory = directory
+        self.chunk_rows = chunk_rows
+        self.flush_rows = flush_rows
+        self._times = []
+        self._flows = []
+
+        index_path = os.path.join(directory, INDEX_NAME)
+        if os.path.exists(index_path):
+            with open(index_path, encoding='utf-8') as f:
+                index = json.load(f)
+            if channels is not None and list(channels) != index['channels']:
+                raise ValueError(f'Channels {list(channels)} do not match the store at {directory}: {index["channels"]}.')
+            self.channels = index['channels']
+            self.chunk_rows = index['chunk_rows']
+            self.chunks = index['chunks']
+            self._recover()
+        else:
+            if channels is None:
+                raise ValueError(f'No store at {directory}, the channels are needed to create one.')
+            os.makedirs(directory, exist_ok=True)
+            self.channels = list(channels)
+            self.chunks = []
+            self._write_index()
+
+    def _recover(self) -> None:
+        # Rows appended after the last index update, e.g. before a crash, are
+        # taken from the files, also from chunks created after it, and a row
+        # written only partly is cut off
+        width = len(self.channels)
+        names = {os.path.splitext(name)[0] for name in os.listdir(self.directory) if name.startswith('chunk_')}
+        while f'chunk_{len(self.chunks):06d}' in names:
+            self.chunks.append({'name': f'chunk_{len(self.chunks):06d}', 'rows': None, 'start': None, 'end': None})
+
+        for chunk in self.chunks:
+            time_path, flow_path = self._paths(chunk['name'])
+            sizes = [os.path.getsize(path) if os.path.exists(path) else 0 for path in (time_path, flow_path)]
+            rows = min(sizes[0] // TIME_DTYPE.itemsize, sizes[1] // (FLOW_DTYPE.itemsize * width))
+            if rows != chunk['rows'] or sizes != [rows * TIME_DTYPE.itemsize, rows * FLOW_DTYPE.itemsize * width]:
+                for path, size in ((time_path, rows * TIME_DTYPE.itemsize), (flow_path, rows * FLOW_DTYPE.itemsize * width)):
+                    with open(path, 'ab') as f:
+                        f.truncate(size)
+                times = np.memmap(time_path, TIME_DTYPE, 'r') if rows else np.empty(0)
+                chunk.update(rows=rows, start=float(times[0]) if rows else None, end=float(times[-1]) if rows else None)
+        self._write_index()
+
+    def _paths(self, name: str) -> tuple[str, str]:
+        return os.path.join(self.directory, f'{name}.time'), os.path.join(self.directory, f'{name}.flow')
+
+    def _write_index(self) -> None:
+        index_path = os.path.join(self.directory, INDEX_NAME)
+        temp_path = f'{index_path}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({'channels': self.channels, 'chunk_rows': self.chunk_rows, 'chunks': self.chunks}, f, indent=1)
+        os.replace(temp_path, index_path)
+
+    def __len__(self) -> int:
+        return sum(chunk['rows'] for chunk in self.chunks) + len(self._times)
+
+    @property
+    def time_range(self) -> tuple[float, float]|None:
+        """
+
+        :returns: Tuple of the first and last epoch timestamp, None when empty
+
+        """
+        self.flush()
+        starts = [chunk['start'] for chunk in self.chunks if chunk['rows']]
+        if not starts:
+            return None
+        return min(starts), max(chunk['end'] for chunk in self.chunks if chunk['rows'])
+
+    def append(self, timestamp: float|dt.datetime, values: list[float]) -> None:
+        """
+
+        :param timestamp: Epoch seconds or datetime of the row
+        :param values: One flow per channel, NaN for a gap
+
+        """
+        if len(values) != len(self.channels):
+            raise ValueError(f'Expected {len(self.channels)} values, got {len(values)}.')
+        self._times.append(to_epoch(timestamp))
+        self._flows.append(values)
+        if len(self._times) >= self.flush_rows:
+            self.flush()
+
+    def append_many(self, timestamps: np.ndarray, values: np.ndarray) -> None:
+        """
+
+        :param timestamps: Epoch seconds of the rows
+        :param values: Array of rows x channels flows
+
+        """
+        self.flush()
+        self._append(np.asarray(timestamps, dtype=TIME_DTYPE), np.asarray(values, dtype=FLOW_DTYPE))
+        self._write_index()
+
+    def flush(self) -> None:
+        """
+
+        Appends the collected rows to the chunk files and updates the index
+
+        """
+        if not self._times:
+            return
+        times = np.asarray(self._times, dtype=TIME_DTYPE)
+        flows = np.asarray(self._flows, dtype=FLOW_DTYPE).reshape(len(times), len(self.channels))
+        self._times.clear()
+        self._flows.clear()
+        self._append(times, flows)
+        self._write_index()
+
+    def _append(self, times: np.ndarray, flows: np.ndarray) -> None:
+        while len(times):
+            chunk = self.chunks[-1] if self.chunks else None
+            # Every chunk is sorted by time, a row older than the end of the
+            # last chunk (e.g. the clock was set back) starts a new chunk
+            if chunk is None or chunk['rows'] >= self.chunk_rows or (chunk['rows'] and times[0] < chunk['end']):
+                chunk = {'name': f'chunk_{len(self.chunks):06d}', 'rows': 0, 'start': None, 'end': None}
+                self.chunks.append(chunk)
+            count = min(self.chunk_rows - chunk['rows'], len(times))
+            unsorted = np.flatnonzero(np.diff(times[:count]) < 0)
+            if len(unsorted):
+                count = int(unsorted[0]) + 1
+
+            # A new chunk replaces files left behind by an earlier write
+            mode = 'ab' if chunk['rows'] else 'wb'
+            time_path, flow_path = self._paths(chunk['name'])
+            with open(time_path, mode) as f:
+                times[:count].tofile(f)
+            with open(flow_path, mode) as f:
+                flows[:count].tofile(f)
+            if chunk['start'] is None:
+                chunk['start'] = float(times[0])
+            chunk['end'] = float(times[count - 1])
+            chunk['rows'] += count
+            times, flows = times[count:], flows[count:]
+
+    def slice(self, start: float|dt.datetime|None = None, end: float|dt.datetime|None = None) -> tuple[np.ndarray, np.ndarray]:
+        """
+
+        :param start: First time to include, from the beginning when None
+        :param end: Time to stop before, to the end when None
+
+        :returns: Tuple of the epoch timestamps and the rows x channels flows in the range,
+                  in time order
+
+        """
+        self.flush()
+        start, end = to_epoch(start), to_epoch(end)
+        start = -np.inf if start is None else start
+        end = np.inf if end is None else end
+
+        width = len(self.channels)
+        times, flows = [], []
+        for chunk in self.chunks:
+            if not chunk['rows'] or chunk['end'] < start or chunk['start'] >= end:
+                continue
+            time_path, flow_path = self._paths(chunk['name'])
+            chunk_times = np.memmap(time_path, TIME_DTYPE, 'r', shape=(chunk['rows'],))
+            first = int(np.searchsorted(chunk_times, start, 'left'))
+            last = int(np.searchsorted(chunk_times, end, 'left'))
+            if first == last:
+                continue
+            chunk_flows = np.memmap(flow_path, FLOW_DTYPE, 'r', shape=(chunk['rows'], width))
+            times.append(np.array(chunk_times[first:last]))
+            flows.append(np.array(chunk_flows[first:last]))
+
+        if not times:
+            return np.empty(0, TIME_DTYPE), np.empty((0, width), FLOW_DTYPE)
+        times, flows = np.concatenate(times), np.concatenate(flows)
+        if np.any(np.diff(times) < 0):
+            order = np.argsort(times, kind='stable')
+            times, flows = times[order], flows[order]
+        return times, flows
+
+    def close(self) -> None:
+        self.flush()
+
+
+def csv_time_format(text: str) -> str:
+    """
+
+    :param text: Timestamp of a csv log
+
+    :return: The format of CSV_TIME_FORMATS the timestamp is in
+
+    """
+    for time_format in CSV_TIME_FORMATS:
+        try:
+            dt.datetime.strptime(text, time_format)
+        except ValueError:
+            continue
+        return time_format
+    raise ValueError(f'Unknown timestamp {text}, expected one of {CSV_TIME_FORMATS}.')
+
+
+def read_csv_log(path: str) -> tuple[list[str], np.ndarray, np.ndarray]:
+    """
+
+    Reads a csv log with a timestamp column followed by flow columns, as
+    written by data_logging (also gzipped) and flow_controller
+
+    :param path: Path of the csv file, .csv or .csv.gz
+
+    :return: Tuple of the flow column names, epoch timestamps and rows x columns flows
+
+    """
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', newline='', encoding='utf-8') as f:
+        rows = [row for row in csv.reader(f) if row]
+    if not rows:
+        raise ValueError(f'{path} is empty.')
+    channels = [column.strip() for column in rows[0][1:]]
+
+    # ISO timestamps are parsed with fromisoformat, which is much faster than strptime,
+    # other formats are looked up on the first row and again only when a row differs
+    time_format = CSV_TIME_FORMATS[1]
+    times = np.empty(len(rows) - 1, dtype=TIME_DTYPE)
+    flows = np.full((len(rows) - 1, len(channels)), np.nan, dtype=FLOW_DTYPE)
+    for idx, row in enumerate(rows[1:]):
+        try:
+            times[idx] = dt.datetime.fromisoformat(row[0]).timestamp()
+        except ValueError:
+            try:
+                times[idx] = dt.datetime.strptime(row[0], time_format).timestamp()
+            except ValueError:
+                time_format = csv_time_format(row[0])
+                times[idx] = dt.datetime.strptime(row[0], time_format).timestamp()
+        values = [float(value) if value.strip() else np.nan for value in row[1:len(channels) + 1]]
+        flows[idx, :len(values)] = values
+    return channels, times, flows
+
+
+def convert_csv_log(csv_path: str|list[str], directory: str, chunk_rows: int = 86400) -> ColumnarLog:
+    """
+
+    Converts csv logs to a columnar store, e.g. all daily files of a log.
+    Files are appended in time order, to a new or an existing store with
+    the same columns. Rows up to the end of an existing store are skipped,
+    so converting the same files again only adds the new rows
+
+    :param csv_path: Path or list of paths of csv logs, see read_csv_log
+    :param directory: Directory of the store
+    :param chunk_rows: Rows per chunk file of a new store
+
+    :return: The ColumnarLog of the store
+
+    """
+    paths = [csv_path] if isinstance(csv_path, str) else list(csv_path)
+    logs = [(path, *read_csv_log(path)) for path in paths]
+    logs.sort(key=lambda log: log[2].min() if len(log[2]) else np.inf)
+
+    store = None
+    for path, channels, times, flows in logs:
+        if store is None:
+            store = ColumnarLog(directory, channels, chunk_rows)
+            time_range = store.time_range
+            converted_until = time_range[1] if time_range is not None else -np.inf
+        elif channels != store.channels:
+            raise ValueError(f'Columns of {path} do not match the store at {directory}: {channels}.')
+        order = np.argsort(times, kind='stable')
+        times, flows = times[order], flows[order]
+        new = times > converted_until
+        store.append_many(times[new], flows[new])
+    return store
+
+
+def daily_logs(log_dir: str, log_name: str) -> list[str]:
+    '''
+    :param log_dir: Directory of the daily csv logs
+    :param log_name: Identification name of the log
+
+    :return: Paths of the plain and gzipped logs, also the parts split off 
+             by size (date_name_N.csv), in order of date and part
+    '''
+    pattern = re.compile(rf'^(\d{{4}}-\d{{2}}-\d{{2}})_{re.escape(log_name)}(?:_(\d+))?\.csv(\.gz)?$')
+    logs = []
+    for path in glob.glob(f'{log_dir}/*_{log_name}.csv*') + glob.glob(f'{log_dir}/*_{log_name}_*.csv*'):
+        match = pattern.match(os.path.basename(path))
+        if match is not None:
+            # A gzipped part holds older rows than a plain file left of the same part
+            date, part, gzipped = match.groups()
+            logs.append(((date, int(part or 0), gzipped is None), path))
+    return [path for _, path in sorted(set(logs))]
+
+
+def main_convert(log_name: str = 'flow') -> None:
+    '''
+    Converts the daily csv logs of data_logging to a columnar store
+    next to them.
+
+    :param log_name: Identification name of the log
+    '''
+
+    log_dir = 'bronkhorst_mfc_test/test/logs'
+    paths = daily_logs(log_dir, log_name)
+    if not paths:
+        print(f'No {log_name} logs found in {log_dir}.')
+        return
+    store = convert_csv_log(paths, f'{log_dir}/{log_name}_columnar')
+    print(f'Converted {len(paths)} files, {len(store)} rows, to {store.directory}.')
+
+
+# Only run the script from this document
+if __name__ == '__main__':
+    main_convert()
@@ -4,6 +4,7 @@ import threading
 from mfc_logger_v1 import main_logger
 from mfc_controller_v1 import main_controller
 from airpy import BronkhorstMFC, find_bronkhorst_ports
+from mfc_port_worker import QueuedBronkhorstMFC
 
 ### SEMI WORKING BUILD ###
 ### Function order with threading is not working properly ###
@@ -27,8 +28,9 @@ def main():
     sleep_time = 10
 
     # Find the Bronkhorst MFC ports
+    # Both threads share the MFCs, so all I/O goes through one worker per port
     bh_ports = list(find_bronkhorst_ports().values())
-    bronkhorsts = [BronkhorstMFC(bh_port) for bh_port in bh_ports]
+    bronkhorsts = [QueuedBronkhorstMFC(BronkhorstMFC(bh_port, resilient=True)) for bh_port in bh_ports]
 
     # Create coordination and shutdown events
     stop_event = threading.Event()
@@ -2,28 +2,33 @@ import time
 import multiprocessing
 from mfc_logger_v1 import main_logger
 from mfc_controller_v1 import main_controller
-from airpy import BronkhorstMFC, find_bronkhorst_ports
+from airpy import find_bronkhorst_ports
+from mfc_broker import start_broker, stop_broker, connect_bronkhorsts
 
 
-def logger_process(bronkhorsts):
+def logger_process(broker_address):
     print('logging')
-    main_logger(bronkhorsts)
+    main_logger(connect_bronkhorsts(broker_address))
 
 
-def controller_process(bronkhorsts, sleep_time):
+def controller_process(broker_address, sleep_time):
     print('controlling')
-    main_controller(bronkhorsts, sleep_time)
+    main_controller(connect_bronkhorsts(broker_address), sleep_time)
 
 
 def main():
     sleep_time = 10  # 1 hour between instructions
 
     bh_ports = list(find_bronkhorst_ports().values())
-    bronkhorsts = [BronkhorstMFC(bh_port) for bh_port in bh_ports]
+
+    # Serial handles cannot be shared between processes, so the broker process
+    # owns all MFC ports and the logger and controller connect to it as clients.
+    # Flows polled by both within 0.2 s are read from the MFC once
+    broker, broker_address = start_broker(bh_ports, cache_ttl=0.2)
 
     # Start logger in a separate process
-    logger = multiprocessing.Process(target=logger_process, args=(bronkhorsts,))
-    controller = multiprocessing.Process(target=controller_process, args=(bronkhorsts, sleep_time))
+    logger = multiprocessing.Process(target=logger_process, args=(broker_address,))
+    controller = multiprocessing.Process(target=controller_process, args=(broker_address, sleep_time))
 
     logger.start()
     controller.start()
@@ -42,4 +47,6 @@ def main():
 
     logger.join()
     controller.join()
+    stop_broker(broker_address)
+    broker.join()
     print("All processes have exited. Program terminated.")
\ No newline at end of file
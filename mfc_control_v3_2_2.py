@@ -4,6 +4,7 @@ import csv
 import glob
 import time
 import random
+import traceback
 import chardet
 import openpyxl
 import datetime
@@ -19,6 +20,13 @@ from tkcalendar import Calendar
 from bronkhorst_mfc_test.airpy import *
 from bronkhorst_mfc_test.mfc_logger_v1 import *
 from bronkhorst_mfc_test.mfc_controller_v1 import *
+from bronkhorst_mfc_test.mfc_async import AsyncBronkhorstMFC, poll_flows
+from bronkhorst_mfc_test.mfc_setpoints import write_step, apply_step
+from bronkhorst_mfc_test.mfc_profiler import BusProfiler, profile_bronkhorst
+from bronkhorst_mfc_test.mfc_hotplug import PortManager
+from bronkhorst_mfc_test.mfc_scheduler import DeadlineScheduler
+from bronkhorst_mfc_test.mfc_aggregate import FlowAggregator, aggregate_headers
+from bronkhorst_mfc_test.mfc_log_writer import LogWriter
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 from tkinter.filedialog import askopenfilename
 from tkinter.scrolledtext import ScrolledText
@@ -464,10 +472,48 @@ def early_cancel_program(status_root,
     time.sleep(2)
     status_root.destroy()
 
+    # Idle setpoints already written are not sent again
     bh_small_idle_point = bronkhorst_small.max_flow*end_setpoint_frac[0]
     bh_large_idle_point = bronkhorst_large.max_flow*end_setpoint_frac[1]
-    bronkhorst_small.write_bronkhorst(206, bh_small_idle_point)
-    bronkhorst_large.write_bronkhorst(206, bh_large_idle_point)
+    write_step([(bronkhorst_small, bh_small_idle_point), (bronkhorst_large, bh_large_idle_point)])
+
+
+def open_stats_log(programme, csv_header):
+    '''
+    Opens the file of the per second statistics of a run sampled at more than 1 Hz.
+    Every second is written when it closes, so a crash loses at most the open second
+
+    :param programme: ProgrammeSelector of the run
+    :param csv_header: Header of the flow_plot csv file
+
+    :return: LogWriter of the flow_stats csv file
+    '''
+    return LogWriter(f'{programme.save_name}/flow_stats{programme.selected_starttime.strftime("%d_%m_%H_%M")}.csv',
+                     aggregate_headers(','.join(csv_header)),
+                     flush_rows=1)
+
+
+def write_stats(stats_log, interval):
+    '''
+    :param stats_log: LogWriter of open_stats_log
+    :param interval: mfc_aggregate.FlowInterval of one second
+    '''
+    row = [datetime.datetime.fromtimestamp(interval.start).strftime("%d/%m/%Y %H:%M:%S"), *interval.values()]
+    stats_log.write_row(','.join(str(value) for value in row))
+
+
+def raw_span(aggregator):
+    '''
+    :param aggregator: FlowAggregator of the run
+
+    :return: Status text with the lowest and highest raw samples of the last 10 s
+    '''
+    _, values = aggregator.raw()
+    if not len(values):
+        return ''
+    low, high = np.nanmin(values, axis=0), np.nanmax(values, axis=0)
+    return (f'\nSidste 10 s  Span: {low[0]:.4f}-{high[0]:.4f} mL/min  '
+            f'Fortynding: {low[1]/1000:.4f}-{high[1]/1000:.4f} L/min')
 
 
 def cancel_program(status_root, 
@@ -481,7 +527,9 @@ def cancel_program(status_root,
                    bronkhorst_small, 
                    bronkhorst_large,
                    append_to_file,
-                   setting_text):
+                   setting_text,
+                   profiler=None,
+                   stats_log=None):
     
     end_setpoint_frac = [0.01, 0.6]
     status_label.config(text='Programmet blev afbrudt under kørsel.')
@@ -498,6 +546,8 @@ def cancel_program(status_root,
         writer = csv.writer(f)
         writer.writerow(csv_header)
         writer.writerows(csv_rows)
+    if stats_log is not None:
+        stats_log.close()
 
     comment_settings = '\n'.join(setting_text)
     append_to_file(comment_settings)
@@ -505,31 +555,43 @@ def cancel_program(status_root,
     # Save plot
     fig.savefig(f'{programme.save_name}/flow_plot_{programme.selected_starttime.strftime("%d_%m_%H_%M")}.pdf')
 
+    # Save the serial bus timings of the run
+    if profiler is not None:
+        profiler.export(f'{programme.save_name}/bus_profile_{programme.selected_starttime.strftime("%d_%m_%H_%M")}.json')
+        print(profiler.summary())
+
     bh_small_idle_point = bronkhorst_small.max_flow*end_setpoint_frac[0]
     bh_large_idle_point = bronkhorst_large.max_flow*end_setpoint_frac[1]
-    bronkhorst_large.write_bronkhorst(206, bh_small_idle_point)
-    bronkhorst_small.write_bronkhorst(206, bh_large_idle_point)
+    write_step([(bronkhorst_small, bh_small_idle_point), (bronkhorst_large, bh_large_idle_point)])
 
 
 def flow_controller(bronkhorsts: list[BronkhorstMFC], 
                     programme: ProgrammeSelector, 
-                    end_setpoint_frac: int) -> None:
+                    end_setpoint_frac: int,
+                    acquisition_mode: str = 'float',
+                    samples_per_second: int = 1) -> None:
     '''
     Defines the main function to controll the Bronkhorst MFC's using the worksheet.
 
     :param bronkhorsts: List of Bronkhorst MFC objects to be controlled.
     :param sleep_time: Time the program is supposed to sleep between dilution steps
                        to achieve a stable concentration.
+    :param acquisition_mode: 'float' polls fMeasure (DDE 205), 'raw' polls the 
+                             0-32000 measure (DDE 8) and scales it locally
+    :param samples_per_second: Polls of the flows per second, e.g. 20 to catch transients.
+                               Plot, GUI and stored flows are updated once per second with the
+                               mean, and the statistics of every second are saved to flow_stats
     '''
 
     if len(bronkhorsts) != 2:
         raise KeyError('Uncompatible number of Bronkhorst MFCs connected. Program can only handle 2 MFCs (span + dilution).')
+    if acquisition_mode not in ACQUISITION_MODES:
+        raise ValueError(f'Unknown acquisition mode {acquisition_mode}, use one of {ACQUISITION_MODES}.')
+    raw = acquisition_mode == 'raw'
     
     def normalize_flow(mfc: BronkhorstMFC):
         # Convert everything to ln/min for comparison
-        if mfc.readout_unit == 'mln/min':
-            return mfc.max_flow / 1000
-        return mfc.max_flow
+        return mfc.max_flow * mfc.read_plan.scale / 1000
     
     # Starting time and flows
     start_time = programme.selected_starttime
@@ -563,6 +625,40 @@ def flow_controller(bronkhorsts: list[BronkhorstMFC],
     mfcs_sorted = sorted(bronkhorsts, key=normalize_flow)
     bronkhorst_small = mfcs_sorted[0]
     bronkhorst_large = mfcs_sorted[1]
+
+    # Every serial request is timed, so a drifting 1 s tick can be traced to the bus or the GUI
+    profiler = BusProfiler()
+    for mfc in mfcs_sorted:
+        profile_bronkhorst(mfc, profiler)
+
+    # The MFCs are on separate ports, so they are polled concurrently
+    async_mfcs = [AsyncBronkhorstMFC(bronkhorst_small), AsyncBronkhorstMFC(bronkhorst_large)]
+
+    # Flows are sampled on a fixed grid, so reads, plotting and the GUI do not
+    # stretch a step. A sample lost to a slow redraw is skipped, not caught up
+    scheduler = DeadlineScheduler(1.0 / samples_per_second)
+
+    # The samples of every second are reduced to mean, min, max, std and count,
+    # the last 10 s of raw samples are kept for the live values
+    aggregator = FlowAggregator(2, None, rate=samples_per_second)
+
+    def poll_step(step_time):
+        # Polls the flows for a step and yields the second and its interval whenever a second
+        # is complete. A tick of a later second also closes the interval, so a skipped last 
+        # tick neither merges two seconds nor carries samples into the next step
+        open_second = None
+        for tick in scheduler.ticks(step_time * samples_per_second):
+            second = tick.index // samples_per_second
+            if open_second is not None and second != open_second:
+                yield open_second, aggregator.finish()
+            with profiler.section('poll'):
+                aggregator.add(time.time(), poll_flows(async_mfcs, raw))
+            open_second = second
+            if (tick.index + 1) % samples_per_second == 0:
+                yield second, aggregator.finish()
+                open_second = None
+        if open_second is not None:
+            yield open_second, aggregator.finish()
     set_large, flow_large, set_small, flow_small, ppb_conc = find_setpoints(programme)
 
     set_pts = (set_large, flow_large, set_small, flow_small, ppb_conc)
@@ -588,6 +684,7 @@ def flow_controller(bronkhorsts: list[BronkhorstMFC],
     csv_header = ['Datetime', 
                   f'Bronkhorst {bronkhorst_small.max_flow:.1f}SCCM [mL/min]', 
                   f'Bronkhorst {bronkhorst_large.max_flow:.1f}SLM [L/min]']
+    stats_log = open_stats_log(programme, csv_header) if samples_per_second > 1 else None
     
     (status_root,     # Main window
      info_frame,      # Frame for UI elements
@@ -642,22 +739,25 @@ def flow_controller(bronkhorsts: list[BronkhorstMFC],
         status_root, status_label, programme, time_list,
         flow_list_small, flow_list_large, csv_header,
         fig, bronkhorst_small, bronkhorst_large,
-        append_to_file, setting_text))
+        append_to_file, setting_text, profiler, 
+        stats_log))
 
         abort_button.config(command=lambda: cancel_program(
             status_root, status_label, programme, time_list,
             flow_list_small, flow_list_large, csv_header,
             fig, bronkhorst_small, bronkhorst_large,
-            append_to_file, setting_text
+            append_to_file, setting_text, profiler, 
+            stats_log
         ))
 
         # 206 is the DDE number for setting the specific flow of a Bronkhorst MFC
         for i, (dilution, dilution_flow_set, span, span_flow_set, conc) in enumerate(final_point_list):            
             if not flow_list_large and not flow_list_small:
-                meas_flow_large = read_bh_flow(bronkhorst_large)
-                meas_flow_small = read_bh_flow(bronkhorst_small)/1000
-                flow_large = ((read_bh_flow(bronkhorst_large))/bronkhorst_large.max_flow)*100
-                flow_small = ((read_bh_flow(bronkhorst_small)/1000)/bronkhorst_small.max_flow)*100
+                # Each MFC is read once, the percentage is derived from the same reading
+                meas_flow_small = read_bh_flow(bronkhorst_small)
+                meas_flow_large = read_bh_flow(bronkhorst_large)/1000
+                flow_large = (meas_flow_large/bronkhorst_large.max_flow)*100
+                flow_small = (meas_flow_small/bronkhorst_small.max_flow)*100
             else:
                 flow_large = (flow_list_large[-1]/bronkhorst_large.max_flow)*100
                 flow_small = (flow_list_small[-1]/bronkhorst_small.max_flow)*100
@@ -665,8 +765,26 @@ def flow_controller(bronkhorsts: list[BronkhorstMFC],
                 meas_flow_small = flow_list_small[-1]
             dilution_flow = pct_mln_conversion(bronkhorst_large.max_flow, dilution)
             span_flow = pct_mln_conversion(bronkhorst_small.max_flow, span)
-            bronkhorst_large.write_bronkhorst(206, dilution_flow)
-            bronkhorst_small.write_bronkhorst(206, span_flow)
+
+            # Both setpoints are written at the same time to keep the mixture on ratio.
+            # Unchanged setpoints are skipped, written ones are confirmed by read-back
+            setpoints = [(bronkhorst_large, dilution_flow), (bronkhorst_small, span_flow)]
+            step_write = apply_step(setpoints, verify=True)
+            print(f'Step {i+1}: {step_write.written} setpoints applied in {step_write.latency*1000:.1f} ms, '
+                  f'skew {step_write.skew*1000:.2f} ms, '
+                  f'{sum(write.verified is True for write in step_write.writes)} verified')
+
+            # Setpoints the MFC did not acknowledge or confirm are sent once more,
+            # and noted in the comment file if they still fail, as the step is then off ratio
+            unconfirmed = [setpoint for setpoint, write in zip(setpoints, step_write.writes) if write.verified is False]
+            if unconfirmed:
+                retry = apply_step(unconfirmed, verify=True)
+                unconfirmed = [setpoint for setpoint, write in zip(unconfirmed, retry.writes) if write.verified is False]
+            for bh_mfc, value in unconfirmed:
+                warning = (f'{datetime.datetime.now().strftime("%d/%m/%Y %H:%M:%S")} Advarsel: Trin {i+1}, '
+                           f'setpunkt {value:.4f} {bh_mfc.pretty_unit} blev ikke bekræftet af MFC på {bh_mfc.port}')
+                print(warning)
+                append_to_file(warning)
 
             # Append new settings to comment/log file
             setting_text.append('{:<16}{:<16}{:<20.2f}{:<12}{:<18.2f}{:<20.2f}'.format(datetime.datetime.now().strftime('%d/%m %H:%M'), 
@@ -690,10 +808,13 @@ def flow_controller(bronkhorsts: list[BronkhorstMFC],
                                    f'{"Koncentration:":<15}{conc:.2f} ppb')
             status_root.update()
 
-            for t in range(step_time):            
+            # Runs once per second, with the mean flows of the second
+            for t, interval in poll_step(step_time):
+                if stats_log is not None:
+                    write_stats(stats_log, interval)
                 time_list.append(datetime.datetime.now())
-                meas_flow_small = read_bh_flow(bronkhorst_small)
-                meas_flow_large = read_bh_flow(bronkhorst_large)/1000
+                meas_flow_small, meas_flow_large = interval.mean
+                meas_flow_large = meas_flow_large/1000
                 flow_small = (meas_flow_small/bronkhorst_small.max_flow)*100
                 flow_large = (meas_flow_large/bronkhorst_large.max_flow)*100
                 flow_list_small.append(np.round(meas_flow_small, 4))
@@ -708,8 +829,9 @@ def flow_controller(bronkhorsts: list[BronkhorstMFC],
                 ax2.relim()
                 ax2.set_ylim([0, np.float16(f'{bronkhorst_large.max_flow:.2f}')])
                 ax2.autoscale_view()
-                fig.tight_layout()
-                canvas.draw()
+                with profiler.section('plot'):
+                    fig.tight_layout()
+                    canvas.draw()
 
                 tot_time_left = datetime.timedelta(seconds=(len(final_point_list)-(i+1))*step_time+step_time-(t+1))
                 tot_hours, tot_remainder = divmod(int(tot_time_left.total_seconds()), 3600)
@@ -726,9 +848,10 @@ def flow_controller(bronkhorsts: list[BronkhorstMFC],
                                    f'{"Fortynding:":<15}{f"{dilution}%":<5}{f"{dilution_flow_set/1000:.5f} L/min":<20}{f"{flow_large:.2f}%":<10}{f"{meas_flow_large:.4f} L/min":<10}\n'
                                    f'{"Span:":<15}{f"{span}%":<5}{f"{span_flow_set:.2f} mL/min":<20}{f"{flow_small:.2f}%":<10}{f"{meas_flow_small:.4f} mL/min":<10}\n'
                                    f'{"Koncentration:":<15}{conc:.2f} ppb')
-                status_label.config(text=f'Tid tilbage på trin: {step_hours:02d}:{step_minutes:02d}:{step_seconds:02d}')
-                status_root.update()
-                time.sleep(1)
+                status_label.config(text=f'Tid tilbage på trin: {step_hours:02d}:{step_minutes:02d}:{step_seconds:02d}'
+                                         f'{raw_span(aggregator) if samples_per_second > 1 else ""}')
+                with profiler.section('gui'):
+                    status_root.update()
 
             time_progress['value'] = 0  # Reset time progress for next step
 
@@ -745,10 +868,17 @@ def flow_controller(bronkhorsts: list[BronkhorstMFC],
             writer = csv.writer(f)
             writer.writerow(csv_header)
             writer.writerows(csv_rows)
+        if stats_log is not None:
+            stats_log.close()
 
         # Save plot
         fig.savefig(f'{programme.save_name}/flow_plot_{programme.selected_starttime.strftime("%d_%m_%H_%M")}.pdf')
 
+        # Save the serial bus timings of the run
+        profiler.export(f'{programme.save_name}/bus_profile_{programme.selected_starttime.strftime("%d_%m_%H_%M")}.json')
+        print(profiler.summary())
+        print(scheduler.summary())
+
         time.sleep(2)
 
         comment_settings = '\n'.join(setting_text)
@@ -757,8 +887,7 @@ def flow_controller(bronkhorsts: list[BronkhorstMFC],
         status_label.config(text='Program Færdig.\nAlle data er nu gemt.')
         bh_small_idle_point = bronkhorst_small.max_flow*end_setpoint_frac[0]
         bh_large_idle_point = bronkhorst_large.max_flow*end_setpoint_frac[1]
-        bronkhorst_small.write_bronkhorst(206, bh_small_idle_point)
-        bronkhorst_large.write_bronkhorst(206, bh_large_idle_point)
+        write_step([(bronkhorst_small, bh_small_idle_point), (bronkhorst_large, bh_large_idle_point)])
 
         on_programme_complete(status_root, 
                               bronkhorst_small, 
@@ -768,8 +897,22 @@ def flow_controller(bronkhorsts: list[BronkhorstMFC],
                               step_label, 
                               end_setpoint_frac)
         status_root.mainloop()
-    except Exception:
+    except tk.TclError:
+        # The window was closed by cancel_program, which has saved the data
         pass
+    except Exception:
+        # Any other error ends the programme, so it is written to the comment file
+        # and the MFCs are returned to their idle setpoints
+        error = traceback.format_exc()
+        print(error)
+        if stats_log is not None:
+            stats_log.close()
+        append_to_file(f'{datetime.datetime.now().strftime("%d/%m/%Y %H:%M:%S")} Programmet stoppede med en fejl:\n{error}')
+        try:
+            write_step([(bronkhorst_small, bronkhorst_small.max_flow*end_setpoint_frac[0]), 
+                        (bronkhorst_large, bronkhorst_large.max_flow*end_setpoint_frac[1])])
+        except Exception:
+            print(f'Could not write the idle setpoints:\n{traceback.format_exc()}')
 
 
 def find_setpoints(programme: ProgrammeSelector):
@@ -794,11 +937,26 @@ def find_setpoints(programme: ProgrammeSelector):
 
 if __name__ == '__main__':
     end_setpoint_frac = [0.01, 0.6] # % of max flow
-
-    # Find and connect the Bronkhorst MFC's
-    bh_ports = list(find_bronkhorst_ports().values())
-    bronkhorsts = [BronkhorstMFC(bh_port) for bh_port in bh_ports]
+    acquisition_mode = 'float' # 'raw' polls the 0-32000 measure (DDE 8), 2 bytes less per answer
+    samples_per_second = 1 # e.g. 20 to catch transients, stored as statistics per second
+
+    # Find and connect the Bronkhorst MFC's, known MFCs only need their serial number read.
+    # Reads of the same parameter within 0.2 s share one serial request, except the polled 
+    # measure (DDE 205 and 8), so every sample is a new reading at any samples_per_second. 
+    # Failed requests are retried and the port reopened, so a glitch of an adapter does 
+    # not stop the programme
+    metadata_cache = MetadataCache()
+    bh_ports = list(find_bronkhorst_ports(metadata_cache).values())
+    bronkhorsts = [BronkhorstMFC(bh_port, metadata_cache=metadata_cache, read_cache=ReadCache(ttl=0.2, ttls={205: 0, 8: 0}), 
+                                 resilient=True) 
+                   for bh_port in bh_ports]
+
+    # An MFC whose USB adapter comes back under another device name is rebound to it
+    port_manager = PortManager(metadata_cache)
+    for bronkhorst in bronkhorsts:
+        port_manager.track(bronkhorst)
+    port_manager.start()
 
     # Find and load programme variables
     programme_variables = ProgrammeSelector()
-    flow_controller(bronkhorsts, programme_variables, end_setpoint_frac)
\ No newline at end of file
+    flow_controller(bronkhorsts, programme_variables, end_setpoint_frac, acquisition_mode, samples_per_second)
\ No newline at end of file
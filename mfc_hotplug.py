@@ -0,0 +1,277 @@
+import os
+import re
+import time
+import ctypes
+import select
+import struct
+import threading
+from typing import Any, Callable
+from bronkhorst_mfc_test.airpy import (MetadataCache, LOCAL_ADDRESS,
+                                       bronkhorst_candidate_ports, probe_bronkhorst_port)
+
+#######################################################################
+###-------------------Hot-plug aware port manager-------------------###
+#######################################################################
+
+# Serial device nodes of USB adapters in /dev
+SERIAL_DEVICE_PATTERN = r'^tty(USB|ACM)\d+$'
+
+# inotify events of /dev, a new node is created with root permissions and
+# made accessible by udev afterwards, which is an attribute change
+IN_ATTRIB = 0x004
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+INOTIFY_EVENT = struct.Struct('iIII')
+
+
+def inotify_watch(directory: str) -> int|None:
+    """
+
+    :param directory: Directory to watch for created and deleted files
+
+    :return: Non-blocking inotify file descriptor, None where inotify is
+             not available (not Linux, or out of watches)
+
+    """
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    mask = IN_CREATE | IN_DELETE | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO
+    if libc.inotify_add_watch(fd, os.fsencode(directory), mask) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+def read_inotify_events(fd: int) -> list[tuple[int, str]]:
+    """
+
+    :param fd: inotify file descriptor with events ready
+
+    :return: List of tuples of event mask and file name
+
+    """
+    events = []
+    try:
+        data = os.read(fd, 64 * 1024)
+    except BlockingIOError:
+        return events
+    offset = 0
+    while offset < len(data):
+        _, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+        offset += INOTIFY_EVENT.size
+        name = data[offset:offset + length].rstrip(b'\0').decode(errors='replace')
+        offset += length
+        events.append((mask, name))
+    return events
+
+
+class PortManager:
+    def __init__(self,
+                 metadata_cache: MetadataCache|None = None,
+                 watch_dir: str|None = '/dev',
+                 port_pattern: str = SERIAL_DEVICE_PATTERN,
+                 poll_interval: float = 0.5,
+                 rebind_timeout: float = 1.0,
+                 candidate_ports: Callable[[], list[str]]|None = None) -> None:
+        """
+
+        Keeps track of MFCs by their serial number (DDE 92) while their USB
+        adapters come and go. When the port of a tracked MFC disappears the
+        MFC is marked as lost, and every new port is probed for the lost
+        MFCs only, so an adapter enumerated under a new device name is
+        rebound within a second without rescanning all ports. Device events
+        come from inotify on watch_dir, or from polling candidate_ports
+        where inotify is not available (e.g. on Windows)
+
+        :param metadata_cache: MetadataCache used when probing new ports
+        :param watch_dir: Directory of the device nodes, None to always poll
+        :param port_pattern: Regular expression for the device names in watch_dir
+        :param poll_interval: Seconds between polls of candidate_ports
+        :param rebind_timeout: Seconds a new port is probed for before it is given up,
+                               the device node is not accessible right away
+        :param candidate_ports: Function listing the serial ports when polling,
+                                defaults to airpy.bronkhorst_candidate_ports
+
+        """
+
+        self.metadata_cache = metadata_cache
+        self.watch_dir = watch_dir
+        self.port_pattern = re.compile(port_pattern)
+        self.poll_interval = poll_interval
+        self.rebind_timeout = rebind_timeout
+        self.candidate_ports = candidate_ports if candidate_ports is not None else bronkhorst_candidate_ports
+
+        # Called with the MFC, the old port and the new port, and with the lost MFC
+        self.on_rebind = None
+        self.on_lost = None
+
+        self.instruments = {}
+        self.lost = set()
+        self.rebinds = []
+        self.mode = None
+        self._known_ports = set()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._inotify_fd = None
+
+    def track(self, bh_mfc: Any) -> str:
+        """
+
+        :param bh_mfc: BronkhorstMFC object, or a wrapper with a rebind method
+
+        :returns: Serial number the MFC is tracked by
+
+        """
+        serial_number = getattr(bh_mfc, 'serial_number', None)
+        if serial_number is None:
+            serial_number = bh_mfc.read_bronkhorst(92)[92]
+            if serial_number is None:
+                raise ValueError(f'Could not read the serial number of the MFC at {bh_mfc.port}!')
+            serial_number = serial_number.strip()
+        with self._lock:
+            self.instruments[serial_number] = bh_mfc
+        return serial_number
+
+    def untrack(self, bh_mfc: Any) -> None:
+        with self._lock:
+            for serial_number, tracked in list(self.instruments.items()):
+                if tracked is bh_mfc:
+                    del self.instruments[serial_number]
+                    self.lost.discard(serial_number)
+
+    def start(self) -> None:
+        """
+
+        Starts watching for device events on a background thread
+
+        """
+        if self.watch_dir is not None and os.path.isdir(self.watch_dir):
+            self._inotify_fd = inotify_watch(self.watch_dir)
+        self.mode = 'inotify' if self._inotify_fd is not None else 'polling'
+        self._known_ports = set(self.list_ports())
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name='mfc-hotplug', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._inotify_fd is not None:
+            os.close(self._inotify_fd)
+            self._inotify_fd = None
+
+    def list_ports(self) -> list[str]:
+        """
+
+        :returns: Serial ports present now, from watch_dir when inotify is used
+
+        """
+        if self.mode == 'inotify':
+            return [os.path.join(self.watch_dir, name) for name in os.listdir(self.watch_dir)
+                    if self.port_pattern.match(name)]
+        return list(self.candidate_ports())
+
+    def _run(self) -> None:
+        # New ports are probed until the lost MFCs are found there or rebind_timeout passes
+        pending = {}
+        while not self._stopped.is_set():
+            added, removed = self._wait_for_changes(0.05 if pending else self.poll_interval)
+            for port in removed:
+                pending.pop(port, None)
+                self._removed(port)
+            for port in added:
+                pending[port] = time.monotonic()
+            for port, since in list(pending.items()):
+                if self._added(port, since) or time.monotonic() - since > self.rebind_timeout:
+                    del pending[port]
+
+    def _wait_for_changes(self, timeout: float) -> tuple[list[str], list[str]]:
+        """
+
+        :param timeout: Seconds to wait for device events
+
+        :returns: Tuple of lists of added and removed ports
+
+        """
+        if self._inotify_fd is None:
+            self._stopped.wait(timeout)
+            ports = set(self.list_ports())
+            added, removed = ports - self._known_ports, self._known_ports - ports
+            self._known_ports = ports
+            return sorted(added), sorted(removed)
+
+        added, removed = [], []
+        readable, _, _ = select.select([self._inotify_fd], [], [], timeout)
+        if not readable:
+            return added, removed
+        for mask, name in read_inotify_events(self._inotify_fd):
+            if not self.port_pattern.match(name):
+                continue
+            port = os.path.join(self.watch_dir, name)
+            if mask & (IN_DELETE | IN_MOVED_FROM):
+                removed.append(port)
+            elif mask & (IN_CREATE | IN_MOVED_TO | IN_ATTRIB) and port not in added:
+                added.append(port)
+        return added, removed
+
+    def _removed(self, port: str) -> None:
+        with self._lock:
+            gone = [(serial_number, bh_mfc) for serial_number, bh_mfc in self.instruments.items()
+                    if bh_mfc.port == port and serial_number not in self.lost]
+            self.lost.update(serial_number for serial_number, _ in gone)
+        for serial_number, bh_mfc in gone:
+            print(f'MFC {serial_number} at port {port} disconnected')
+            if self.on_lost is not None:
+                self.on_lost(bh_mfc)
+
+    def _added(self, port: str, since: float) -> bool:
+        """
+
+        Probes a new port for the lost MFCs and rebinds the ones found there
+
+        :param port: New serial port
+        :param since: time.monotonic() of the device event
+
+        :returns: True when the port answered or no MFC is lost, False to probe again
+
+        """
+        with self._lock:
+            lost = {serial_number: self.instruments[serial_number] for serial_number in self.lost}
+        if not lost:
+            return True
+
+        # Nodes on a FLOW-BUS keep their address on the new port
+        addresses = sorted({getattr(getattr(bh_mfc, 'mfc', bh_mfc), 'address', LOCAL_ADDRESS) for bh_mfc in lost.values()})
+        answered = False
+        for address in addresses:
+            probe = probe_bronkhorst_port(port, address, self.metadata_cache)
+            if not probe.found:
+                continue
+            answered = True
+            bh_mfc = lost.get(probe.serial_number)
+            if bh_mfc is not None:
+                self._rebind(probe.serial_number, bh_mfc, port, since)
+        return answered
+
+    def _rebind(self, serial_number: str, bh_mfc: Any, port: str, since: float) -> None:
+        old_port = bh_mfc.port
+        # The MFC holds its lock while the port is swapped, so reads and writes
+        # of other threads wait for the new port instead of using the old one
+        bh_mfc.rebind(port)
+        with self._lock:
+            self.lost.discard(serial_number)
+        self.rebinds.append({'serial_number': serial_number, 'old_port': old_port,
+                             'new_port': port, 'seconds': time.monotonic() - since})
+        print(f'MFC {serial_number} reconnected at port {port}, was {old_port}')
+        if self.on_rebind is not None:
+            self.on_rebind(bh_mfc, old_port, port)
@@ -0,0 +1,307 @@
+import os
+import gzip
+import time
+import shutil
+import signal
+import threading
+import datetime as dt
+from concurrent.futures import ThreadPoolExecutor
+
+#######################################################################
+###----------------------Buffered CSV log writer---------------------###
+#######################################################################
+
+# 'flush' hands the rows to the OS, which survives a crash of the programme,
+# 'interval' also fsyncs every fsync_interval seconds and 'row' fsyncs every
+# row, which survive a power cut at the cost of a disk write per fsync
+DURABILITY_MODES = ('flush', 'interval', 'row')
+
+
+class LogWriter:
+    def __init__(self,
+                 path: str,
+                 header: str|None = None,
+                 flush_rows: int = 12,
+                 flush_interval: float = 60.0,
+                 durability: str = 'flush',
+                 fsync_interval: float = 60.0) -> None:
+        """
+
+        Keeps a log file open and collects rows in memory, which are written
+        when flush_rows rows are waiting or flush_interval seconds passed
+        since the last flush, and when the writer is closed
+
+        :param path: Path of the log file, rows are appended
+        :param header: Header written when the file is empty
+        :param flush_rows: Number of rows collected before they are written
+        :param flush_interval: Seconds after which collected rows are written
+        :param durability: One of DURABILITY_MODES
+        :param fsync_interval: Seconds between fsyncs for the 'interval' durability
+
+        """
+
+        if durability not in DURABILITY_MODES:
+            raise ValueError(f'Unknown durability {durability}, use one of {DURABILITY_MODES}.')
+        self.path = path
+        self.header = header
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.durability = durability
+        self.fsync_interval = fsync_interval
+        self.rows_written = 0
+        self.flushes = 0
+        self.fsyncs = 0
+
+        self._rows = []
+        self._lock = threading.Lock()
+        self._file = None
+        self.open()
+
+    def open(self) -> None:
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(self.path, 'a')
+        if self.header is not None and self._file.tell() == 0:
+            self._file.write(self.header + '\n')
+            self._file.flush()
+        self.size = self._file.tell()
+        self._last_flush = time.monotonic()
+        self._last_fsync = self._last_flush
+
+    @property
+    def closed(self) -> bool:
+        return self._file is None
+
+    @property
+    def pending(self) -> int:
+        return len(self._rows)
+
+    def write_row(self, row: str) -> None:
+        """
+
+        :param row: Line to log, without line end
+
+        """
+        with self._lock:
+            self._rows.append(row)
+            self.size += len(row) + 1
+            if self.durability == 'row':
+                self._flush(fsync=True)
+            elif len(self._rows) >= self.flush_rows or time.monotonic() - self._last_flush >= self.flush_interval:
+                self._flush()
+
+    def flush(self, fsync: bool = False) -> None:
+        """
+
+        Writes the collected rows to the file
+
+        :param fsync: Also wait for the OS to write the file to disk
+
+        """
+        with self._lock:
+            self._flush(fsync)
+
+    def _flush(self, fsync: bool = False) -> None:
+        if self._file is None:
+            return
+        now = time.monotonic()
+        if self._rows:
+            self._file.write('\n'.join(self._rows) + '\n')
+            self.rows_written += len(self._rows)
+            self._rows.clear()
+        self._file.flush()
+        self.flushes += 1
+        self._last_flush = now
+        if fsync or (self.durability == 'interval' and now - self._last_fsync >= self.fsync_interval):
+            os.fsync(self._file.fileno())
+            self.fsyncs += 1
+            self._last_fsync = now
+
+    def close(self) -> None:
+        """
+
+        Writes the collected rows, syncs them to disk and closes the file
+
+        """
+        with self._lock:
+            if self._file is None:
+                return
+            self._flush(fsync=True)
+            self._file.close()
+            self._file = None
+
+
+class RotatingLogWriter:
+    def __init__(self,
+                 directory: str,
+                 log_name: str,
+                 header: str|None = None,
+                 max_bytes: int|None = None,
+                 compress: bool = False,
+                 date: dt.date|None = None,
+                 **writer_kwargs) -> None:
+        """
+
+        Log sink writing daily files named {date}_{log_name}.csv, which 
+        switches to the next file in place when a row of a new date arrives
+        or the file reaches max_bytes, so every row ends up in the file of 
+        its own date and none is lost at the switch. Files over max_bytes 
+        continue in {date}_{log_name}_1.csv, _2.csv and so on. Closed files
+        can be gzipped on a background thread
+
+        :param directory: Directory of the log files
+        :param log_name: Identification name of the log
+        :param header: Header written at the top of every file
+        :param max_bytes: Size at which a file is continued in the next part,
+                          only the date switches files when None
+        :param compress: Gzip closed files to .csv.gz on a background thread
+        :param date: Date of the first file, defaults to today
+        :param writer_kwargs: Flush and durability settings passed on to LogWriter
+
+        """
+
+        self.directory = directory
+        self.log_name = log_name
+        self.header = header
+        self.max_bytes = max_bytes
+        self.writer_kwargs = writer_kwargs
+        self.date = date if date is not None else dt.date.today()
+        self.part = self.open_part(self.date, 0)
+        self.rotations = 0
+        self._compressor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='log-gzip') if compress else None
+        self.writer = LogWriter(self.path_for(self.date, self.part), header, **writer_kwargs)
+
+    @property
+    def path(self) -> str:
+        return self.writer.path
+
+    def path_for(self, date: dt.date, part: int = 0) -> str:
+        """
+
+        :param date: Date of the file
+        :param part: Number of the file within the date
+
+        :returns: Path of the log file
+
+        """
+        suffix = f'_{part}' if part else ''
+        return os.path.join(self.directory, f'{date}_{self.log_name}{suffix}.csv')
+
+    def open_part(self, date: dt.date, part: int = 0) -> int:
+        """
+
+        :param date: Date of the file
+        :param part: First part to consider
+
+        :returns: First part from part on that was not compressed yet. A gzipped
+                  part of an earlier run on the same date is filled, logging
+                  continues after it instead of in a new file of the same name
+
+        """
+        while os.path.exists(f'{self.path_for(date, part)}.gz'):
+            part += 1
+        return part
+
+    def write_row(self, row: str, date: dt.date|None = None) -> bool:
+        """
+
+        :param row: Line to log, without line end
+        :param date: Date of the row, defaults to today
+
+        :returns: True if the row started a new file
+
+        """
+        date = date if date is not None else dt.date.today()
+        rotated = False
+        if date != self.date:
+            self.rotate(date, 0)
+            rotated = True
+
+        # A row longer than max_bytes still goes into a file of its own. Parts filled 
+        # by an earlier run are skipped, as a restart continues the files of the day
+        header_size = len(self.header) + 1 if self.header is not None else 0
+        while (self.max_bytes is not None and self.writer.size + len(row) + 1 > self.max_bytes 
+               and self.writer.size > header_size):
+            self.rotate(date, self.part + 1)
+            rotated = True
+        self.writer.write_row(row)
+        return rotated
+
+    def rotate(self, date: dt.date, part: int = 0) -> None:
+        """
+
+        Closes the current file and continues in the file of the date and part
+
+        :param date: Date of the next file
+        :param part: Number of the next file within the date
+
+        """
+        self.writer.close()
+        if self._compressor is not None:
+            self._compressor.submit(compress_log, self.writer.path)
+        self.date = date
+        self.part = self.open_part(date, part)
+        self.rotations += 1
+        self.writer = LogWriter(self.path_for(date, part), self.header, **self.writer_kwargs)
+
+    def flush(self, fsync: bool = False) -> None:
+        self.writer.flush(fsync)
+
+    def close(self) -> None:
+        """
+
+        Closes the current file and waits for the files being compressed,
+        the current file is left uncompressed, as logging may continue in it
+
+        """
+        self.writer.close()
+        if self._compressor is not None:
+            self._compressor.shutdown(wait=True)
+
+
+def compress_log(path: str) -> str:
+    """
+
+    Gzips a closed log file and removes the original once the compressed
+    file is complete. An existing compressed file is never overwritten,
+    the log is added to it as a further gzip member, which gzip readers
+    return as one file
+
+    :param path: Path of the log file
+
+    :return: Path of the compressed file
+
+    """
+    temp_path = f'{path}.gz.tmp'
+    with open(temp_path, 'wb') as target:
+        if os.path.exists(f'{path}.gz'):
+            with open(f'{path}.gz', 'rb') as existing:
+                shutil.copyfileobj(existing, target)
+        with open(path, 'rb') as source, gzip.GzipFile(fileobj=target, mode='wb') as member:
+            shutil.copyfileobj(source, member)
+    os.replace(temp_path, f'{path}.gz')
+    os.remove(path)
+    return f'{path}.gz'
+
+
+def exit_on_signals(signals: tuple[str, ...] = ('SIGTERM', 'SIGHUP')) -> None:
+    """
+
+    Turns the signals into SystemExit, so the finally blocks closing the log
+    writers run when the logger is stopped, as they already do for Ctrl+C
+    (SIGINT). Signals not available on the platform are skipped, and nothing
+    is changed outside the main thread, where handlers cannot be set
+
+    :param signals: Names of the signals to handle
+
+    """
+
+    def handler(signum: int, frame) -> None:
+        raise SystemExit(f'Stopped by {signal.Signals(signum).name}')
+
+    if threading.current_thread() is not threading.main_thread():
+        return
+    for name in signals:
+        if hasattr(signal, name):
+            signal.signal(getattr(signal, name), handler)
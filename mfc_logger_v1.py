@@ -1,9 +1,15 @@
 import os
+import math
 import time
 import serial
+import numpy as np
 import propar as pp
 import datetime as dt
 from bronkhorst_mfc_test.airpy import *
+from bronkhorst_mfc_test.mfc_log_writer import RotatingLogWriter, exit_on_signals
+from bronkhorst_mfc_test.mfc_scheduler import DeadlineScheduler
+from bronkhorst_mfc_test.mfc_aggregate import FlowAggregator, aggregate_headers
+from bronkhorst_mfc_test.mfc_columnar import ColumnarLog
 from serial.tools import list_ports
 
 #######################################################################
@@ -24,49 +30,102 @@ from serial.tools import list_ports
 #######################################################################
 
 
-def read_bh_flow(bh_mfc: BronkhorstMFC) -> float:
+# 'float' reads fMeasure/fSetpoint (DDE 205/206) in capacity unit, 'raw' reads
+# the 0-32000 Measure/Setpoint (DDE 8/9), which is scaled locally with the 
+# capacity, at a resolution of 1/32000 of capacity. The only gain of 'raw' is
+# an answer 2 bytes shorter per MFC, the local scaling costs more CPU than 
+# the float path (see mfc_benchmark)
+ACQUISITION_MODES = ('float', 'raw')
+
+
+def read_bh_flow(bh_mfc: BronkhorstMFC, raw: bool = False) -> float:
     """
-    Reads the setpoint of a Bronkhorst MFC
+    Reads the flow of a Bronkhorst MFC
     
-    :param bh_mfc: BronkhorstMFC object for the MFC to read the setpoint of
+    :param bh_mfc: BronkhorstMFC object for the MFC to read the flow of
+    :param raw: Read the 0-32000 measure (DDE 8) instead of fMeasure (DDE 205)
     
-    :return: Float of the current flow in mLn/min
+    :return: Float of the current flow in bh_mfc.data_unit, mLn/min for 
+             the ln/min and mln/min MFCs, NaN if the MFC did not answer
     """
 
-    # Find the capacity unit of the MFC to standardise output to mLn/min
-    # 205 is the DDE number of the actual flow of a Bronkhorst MFC
-    bh_mfc.data_unit = 'mLn/min'
+    # The read plan is compiled from the capacity unit when connecting
+    plan = bh_mfc.read_plan
+    dde, scale = (plan.raw_measure_dde, plan.raw_scale) if raw else (plan.measure_dde, plan.scale)
+    value = bh_mfc.read_bronkhorst(dde)[dde]
 
-    if 'mln' in bh_mfc.readout_unit:
-        return float(bh_mfc.read_bronkhorst(205)[205])
+    # A sample the MFC did not answer is a gap (NaN) in the data instead of stopping the run
+    if value is None:
+        return math.nan
+    return float(value) * scale
     
-    elif 'mln' not in bh_mfc.readout_unit and 'ln' in bh_mfc.readout_unit:
-        return (float(bh_mfc.read_bronkhorst(205)[205]) * 1000)
     
-    
-def read_bh_set(bh_mfc: BronkhorstMFC) -> float:
+def read_bh_set(bh_mfc: BronkhorstMFC, raw: bool = False) -> float:
     """
     Reads the setpoint of a Bronkhorst MFC
     
     :param bh_mfc: BronkhorstMFC object for the MFC to read the setpoint of
+    :param raw: Read the 0-32000 setpoint (DDE 9) instead of fSetpoint (DDE 206)
     
-    :return: Float of the current flow in mLn/min
+    :return: Float of the current setpoint in bh_mfc.data_unit, mLn/min for 
+             the ln/min and mln/min MFCs, NaN if the MFC did not answer
     """
 
-    # Find the capacity unit of the MFC to standardise output to mLn/min
-    # 205 is the DDE number of the actual flow of a Bronkhorst MFC
-    bh_mfc.data_unit = 'mLn/min'
-    
-    if 'mln' in bh_mfc.readout_unit:
-        return float(bh_mfc.read_bronkhorst(206)[206])
-    
-    elif 'mln' not in bh_mfc.readout_unit and 'ln' in bh_mfc.readout_unit:
-        return (float(bh_mfc.read_bronkhorst(206)[206]) * 1000)
+    plan = bh_mfc.read_plan
+    dde, scale = (plan.raw_setpoint_dde, plan.raw_scale) if raw else (plan.setpoint_dde, plan.scale)
+    value = bh_mfc.read_bronkhorst(dde)[dde]
+    if value is None:
+        return math.nan
+    return float(value) * scale
+
+
+def scale_raw(raw_values: list[int], bh_mfcs: list[BronkhorstMFC]) -> np.ndarray:
+    """
+    Scales 0-32000 measures or setpoints of several MFCs in one step. For a
+    few MFCs the array setup makes this slower than scaling the floats of 
+    read_bh_flow, the raw path only saves bytes on the serial line
+
+    :param raw_values: Raw values read from DDE 8 or 9, in the order of bh_mfcs,
+                       None for values that could not be read
+    :param bh_mfcs: BronkhorstMFC objects the values were read from
+
+    :return: Array of the values in the data_unit of each MFC, NaN for gaps
+    """
+    scales = np.fromiter((bh_mfc.read_plan.raw_scale for bh_mfc in bh_mfcs), dtype=np.float64, count=len(bh_mfcs))
+    return np.array([np.nan if value is None else value for value in raw_values], dtype=np.float64) * scales
+
+
+def read_bh_flows(bh_mfcs: list[BronkhorstMFC], mode: str = 'float') -> list[float]:
+    """
+    Reads the flow of several Bronkhorst MFCs
+
+    :param bh_mfcs: BronkhorstMFC objects to read the flow of
+    :param mode: Acquisition mode, one of ACQUISITION_MODES
+
+    :return: List of the current flows in the data_unit of each MFC, NaN 
+             for MFCs that did not answer
+    """
+    if mode == 'raw':
+        raw_values = [bh_mfc.read_bronkhorst(bh_mfc.read_plan.raw_measure_dde)[bh_mfc.read_plan.raw_measure_dde] 
+                      for bh_mfc in bh_mfcs]
+        return scale_raw(raw_values, bh_mfcs).tolist()
+    elif mode == 'float':
+        return [read_bh_flow(bh_mfc) for bh_mfc in bh_mfcs]
+    raise ValueError(f'Unknown acquisition mode {mode}, use one of {ACQUISITION_MODES}.')
 
 
 def data_logging(headers: str, 
                  log_name: str, 
-                 bronkhorst_mfc: list[BronkhorstMFC]|None = None) -> None:
+                 bronkhorst_mfc: list[BronkhorstMFC]|None = None,
+                 mode: str = 'float',
+                 flush_rows: int = 12,
+                 flush_interval: float = 60.0,
+                 durability: str = 'flush',
+                 max_bytes: int|None = None,
+                 compress: bool = False,
+                 period: float = 5.0,
+                 aggregate_interval: float|None = None,
+                 columnar: bool = False) -> None:
     '''
     Reads data from a serial print from Bronkhorst MFC's, adds a 
     timestamp, and logs the data in 5 second intervals, and 
@@ -76,72 +135,116 @@ def data_logging(headers: str,
     :param log_name: Identification name of the log
     :param bronkhorst_mfc: List of BronkhorstMFC objects to 
                            read and include in the log
+    :param mode: Acquisition mode, one of ACQUISITION_MODES
+    :param flush_rows: Rows collected before they are written to the file
+    :param flush_interval: Seconds after which collected rows are written
+    :param durability: 'flush', 'interval' or 'row', see mfc_log_writer.DURABILITY_MODES
+    :param max_bytes: Size at which the file of a day is continued in a next part
+    :param compress: Gzip the files of past days on a background thread
+    :param period: Seconds between samples, e.g. 0.05 for 20 Hz with aggregate_interval
+    :param aggregate_interval: Seconds of samples stored as one row of mean, min, 
+                               max, std and count per MFC, every sample is a row when None
+    :param columnar: Also store the rows in the columnar store {log_name}_columnar in 
+                     the log directory, see mfc_columnar.ColumnarLog
     '''
     
     # Defines all constants for use in the loop
     today = dt.date.today()
-    filename = f'bronkhorst_mfc_test/test/logs/{today}_{log_name}.csv'
-    error_log_name = f'bronkhorst_mfc_test/test/errorlogs/{today}_data_errorlog.csv'
-    with open(filename, 'w') as file:
-        file.close()
-    line = 0
-
-    # Use a try except statement to close the serial port and file
-    # when stopping the data logging from the terminal
+    log_dir = 'bronkhorst_mfc_test/test/logs'
+    error_log_dir = 'bronkhorst_mfc_test/test/errorlogs'
+    os.makedirs(error_log_dir, exist_ok=True)
+
+    # At high sample rates only the statistics of every interval are stored
+    aggregator = None
+    if aggregate_interval is not None:
+        aggregator = FlowAggregator(len(bronkhorst_mfc), aggregate_interval, rate=1/period)
+        headers = aggregate_headers(headers)
+
+    # The file stays open and rows are written in batches. A restart during the day
+    # continues the file of the day, which only gets a header when new. At midnight
+    # the sink switches to the file of the new day in place, starting with the row
+    # of the sample that crossed it. The finally block writes the rows still collected
+    writer = RotatingLogWriter(log_dir, log_name, headers, max_bytes, compress, today, 
+                               flush_rows=flush_rows, flush_interval=flush_interval, durability=durability)
+    store = ColumnarLog(f'{log_dir}/{log_name}_columnar', [column.strip() for column in headers.split(',')[1:]]) if columnar else None
+    exit_on_signals()
+
+    # Samples are taken on a fixed grid, so reading and writing do not add to the period
+    scheduler = DeadlineScheduler(period)
     print(f'Data logging for {today} started at {time.strftime("%H:%M:%S")}.')
-    while True:
-        bh_data = []
-        for mfc in bronkhorst_mfc:
-            bh_data.append(read_bh_flow(mfc))
-
-        # Exit the loop when the day switches, and starts a new loop for the next day
-        if today != dt.date.today():
-            #file.close()
-            print(f'Data collection for {today} complete! New file created.')
-            data_logging(headers, log_name, bronkhorst_mfc)
-            break
-        
-        # If at the start of the document write headers
-        if line == 0 and os.stat(filename).st_size==0:
-            with open(filename, 'w') as file:
-                file.write(headers + '\n')
-            line += 1
-
-        #######################################################
-        ### SECTION FOR MFC ERROR CHECK IMPLEMENT AS NEEDED ###
-        #######################################################
-
-        # Check the big MFC output for data corruption that 
-        # affects the measurement but not the overall data structure
-        #if prev_big_flow is not None and big_flow is not None:
-        #    if not prev_big_flow-0.5 < big_flow < prev_big_flow+0.5:
-        #        if big_flow_check >= 12:
-        #            prev_big_flow = big_flow
-        #            big_flow_check = 0
-        #            continue
-        #        else:
-        #            error_message = f'Error: Data corrupted ({data}).'
-        #            error_log(error_message, error_log_name)
-        #            big_flow_check += 1
-        #            continue
-        #    else:
-        #        prev_big_flow = big_flow
-        #elif big_flow is not None and prev_big_flow is None:
-        #    prev_big_flow = big_flow
-
-        # Check if the small flow is correct
-        #if float(data.split(',')[0]) < 140:
-        #    error_message = f'Error: Data corrupted ({data}).'
-        #    error_log(error_message, error_log_name)
-        #    continue
-
-        # Add a timestamp and write the data to the .csv file
-        data = f'{time.strftime("%Y-%m-%d %H:%M:%S")},{bh_data[0]},{bh_data[1]}'
-        with open(filename, 'a') as file:
-            file.write(data + '\n')
-            file.flush()
-
-        time.sleep(5)
+    try:
+        for tick in scheduler:
+            bh_data = read_bh_flows(bronkhorst_mfc, mode)
+            now = dt.datetime.now()
+            error_log_name = f'{error_log_dir}/{now.date()}_data_errorlog.csv'
+
+            # Samples are collected until their interval is complete, which is then logged
+            if aggregator is not None:
+                interval = aggregator.add(now.timestamp(), bh_data)
+                if interval is None:
+                    continue
+                now = dt.datetime.fromtimestamp(interval.start)
+                bh_data = interval.values()
+                for count, mfc in zip(interval.count, bronkhorst_mfc):
+                    if count == 0:
+                        error_log(f'Error: No answer from the MFC at {mfc.port} in the interval, logged as nan.', error_log_name)
+
+            # Samples the MFCs did not answer are logged as nan, so the gap is visible in the data
+            else:
+                for value, mfc in zip(bh_data, bronkhorst_mfc):
+                    if math.isnan(value):
+                        error_log(f'Error: No answer from the MFC at {mfc.port}, sample logged as nan.', error_log_name)
+
+            #######################################################
+            ### SECTION FOR MFC ERROR CHECK IMPLEMENT AS NEEDED ###
+            #######################################################
+
+            # Check the big MFC output for data corruption that 
+            # affects the measurement but not the overall data structure
+            #if prev_big_flow is not None and big_flow is not None:
+            #    if not prev_big_flow-0.5 < big_flow < prev_big_flow+0.5:
+            #        if big_flow_check >= 12:
+            #            prev_big_flow = big_flow
+            #            big_flow_check = 0
+            #            continue
+            #        else:
+            #            error_message = f'Error: Data corrupted ({data}).'
+            #            error_log(error_message, error_log_name)
+            #            big_flow_check += 1
+            #            continue
+            #    else:
+            #        prev_big_flow = big_flow
+            #elif big_flow is not None and prev_big_flow is None:
+            #    prev_big_flow = big_flow
+
+            # Check if the small flow is correct
+            #if float(data.split(',')[0]) < 140:
+            #    error_message = f'Error: Data corrupted ({data}).'
+            #    error_log(error_message, error_log_name)
+            #    continue
+
+            # Add a timestamp and write the data to the .csv file of its date
+            data = f'{now.strftime("%Y-%m-%d %H:%M:%S")},{",".join(str(value) for value in bh_data)}'
+            if store is not None:
+                store.append(now, bh_data)
+            if writer.write_row(data, now.date()) and now.date() != today:
+                print(f'Data collection for {today} complete! New file created.')
+                print(scheduler.summary())
+                today = now.date()
+            if tick.skipped:
+                error_log(f'Error: Sampling overran, {tick.skipped} samples skipped.', error_log_name)
+    finally:
+        # The interval in progress is logged too, so no samples are lost when stopping
+        interval = aggregator.finish() if aggregator is not None else None
+        if interval is not None:
+            start = dt.datetime.fromtimestamp(interval.start)
+            writer.write_row(f'{start.strftime("%Y-%m-%d %H:%M:%S")},{",".join(str(value) for value in interval.values())}', 
+                             start.date())
+            if store is not None:
+                store.append(start, interval.values())
+        writer.close()
+        if store is not None:
+            store.close()
 
 
 def error_log(error: str, log_name: str) -> None:
@@ -159,11 +262,12 @@ def error_log(error: str, log_name: str) -> None:
     error_log.close()
 
 
-def main_logger(bronkhorsts) -> None:
+def main_logger(bronkhorsts, mode: str = 'float') -> None:
     '''
     Function for execution of the data logger.
 
     :param bronkhorsts: List of Bronkhorst MFC objects to be controlled.
+    :param mode: Acquisition mode, 'raw' polls the 0-32000 measure (DDE 8)
     '''
 
     # The header is defined manually
@@ -171,7 +275,7 @@ def main_logger(bronkhorsts) -> None:
     headers = 'Date,Bronkhorst 100SCCM [mLn/min], Bronkhorst 2.5SLM[mLn/min]'
     log_name = 'flow'
 
-    data_logging(headers, log_name, bronkhorsts)
+    data_logging(headers, log_name, bronkhorsts, mode)
 
 
 # Only run the script from this document
@@ -0,0 +1,209 @@
+import time
+import queue
+import itertools
+import threading
+from typing import Any, Callable
+from concurrent.futures import Future
+from bronkhorst_mfc_test.airpy import BronkhorstMFC
+
+#######################################################################
+###--------------------Per port I/O worker setup--------------------###
+#######################################################################
+
+# Lower numbers are served first, requests with the same priority in order of arrival
+SETPOINT_PRIORITY = 0
+WRITE_PRIORITY = 1
+READ_PRIORITY = 2
+STOP_PRIORITY = 3
+
+# 9 is the setpoint from 0-32000 and 206 the setpoint in capacity unit
+SETPOINT_DDE_NUMBERS = (9, 206)
+
+
+class PortWorker:
+    def __init__(self, port: str) -> None:
+        """
+
+        Owns all I/O on one serial port. A single thread drains a priority
+        queue, so requests from several threads never interleave frames on
+        the line, and setpoint writes overtake queued telemetry reads. All 
+        nodes of a FLOW-BUS share the worker of their port
+
+        :param port: Serial port served by the worker
+
+        """
+
+        self.port = port
+        self._queue = queue.PriorityQueue()
+        self._order = itertools.count()
+        self.max_wait = {SETPOINT_PRIORITY: 0.0, WRITE_PRIORITY: 0.0, READ_PRIORITY: 0.0}
+        self.requests = 0
+
+        self._thread = threading.Thread(target=self._run, name=f'mfc-port-{port}', daemon=True)
+        self._thread.start()
+
+    def submit(self, function: Callable, *args, priority: int = READ_PRIORITY) -> Future:
+        """
+
+        Queues a call to be run on the port thread
+
+        :param function: Function doing the I/O
+        :param args: Arguments for the function
+        :param priority: Priority of the request, lower is served first
+
+        :returns: Future with the result of the call
+
+        """
+        future = Future()
+        self._queue.put((priority, next(self._order), time.perf_counter(), future, function, args))
+        return future
+
+    def submit_read(self, bh_mfc: BronkhorstMFC, dde_numbers: list[int], batched: bool = True) -> Future:
+        """
+
+        :param bh_mfc: BronkhorstMFC object on the port to read from
+        :param dde_numbers: Parameter numbers of parameters to read
+        :param batched: Read a list of parameters in one chained request
+
+        :returns: Future with the dictionary of read parameter values
+
+        """
+        return self.submit(bh_mfc.read_bronkhorst, dde_numbers, batched, priority=READ_PRIORITY)
+
+    def submit_write(self, bh_mfc: BronkhorstMFC, dde_number: int, value: Any) -> Future:
+        """
+
+        Setpoint writes (DDE 9 and 206) are served before any other request
+
+        :param bh_mfc: BronkhorstMFC object on the port to write to
+        :param dde_number: Parameter number for the parameter to be written
+        :param value: Value to write to the parameter number
+
+        :returns: Future with True if the MFC acknowledged the write
+
+        """
+        priority = SETPOINT_PRIORITY if dde_number in SETPOINT_DDE_NUMBERS else WRITE_PRIORITY
+        return self.submit(bh_mfc.write_bronkhorst, dde_number, value, priority=priority)
+
+    def stop(self) -> None:
+        """
+
+        Serves the requests already queued and stops the worker thread
+
+        """
+        self._queue.put((STOP_PRIORITY, next(self._order), time.perf_counter(), None, None, ()))
+        self._thread.join()
+
+    def _run(self) -> None:
+        while True:
+            priority, _, queued, future, function, args = self._queue.get()
+            if future is None:
+                return
+            if not future.set_running_or_notify_cancel():
+                continue
+            self.max_wait[priority] = max(self.max_wait.get(priority, 0.0), time.perf_counter() - queued)
+            self.requests += 1
+            try:
+                future.set_result(function(*args))
+            except BaseException as e:
+                future.set_exception(e)
+
+
+_port_workers = {}
+_port_workers_lock = threading.Lock()
+
+
+def port_worker(port: str) -> PortWorker:
+    """
+
+    :param port: Serial port of the MFC
+
+    :return: The PortWorker owning the port, started on first use
+
+    """
+    with _port_workers_lock:
+        if port not in _port_workers:
+            _port_workers[port] = PortWorker(port)
+        return _port_workers[port]
+
+
+class QueuedBronkhorstMFC:
+    def __init__(self, bh_mfc: BronkhorstMFC) -> None:
+        """
+
+        Drop-in replacement for a BronkhorstMFC shared between threads,
+        where every read and write goes through the worker of its port
+
+        :param bh_mfc: BronkhorstMFC object to route through the port worker
+
+        """
+
+        self.mfc = bh_mfc
+        self.serial_number = bh_mfc.serial_number
+        self.max_flow = bh_mfc.max_flow
+        self.readout_unit = bh_mfc.readout_unit
+        self.pretty_unit = bh_mfc.pretty_unit
+        self.data_unit = bh_mfc.data_unit
+        self.read_plan = bh_mfc.read_plan
+        self.worker = port_worker(bh_mfc.port)
+
+    @property
+    def port(self) -> str:
+        # Follows the MFC when it is rebound, also by a PortManager tracking the MFC itself
+        return self.mfc.port
+
+    def read_bronkhorst_future(self, dde_numbers: list[int], batched: bool = True) -> Future:
+        """
+
+        :param dde_numbers: Parameter numbers of parameters to read
+        :param batched: Read a list of parameters in one chained request
+
+        :returns: Future with the dictionary of read parameter values
+
+        """
+        return self.worker.submit_read(self.mfc, dde_numbers, batched)
+
+    def write_bronkhorst_future(self, dde_number: int, value: Any) -> Future:
+        """
+
+        :param dde_number: Parameter number for the parameter to be written
+        :param value: Value to write to the parameter number
+
+        :returns: Future with True if the MFC acknowledged the write
+
+        """
+        return self.worker.submit_write(self.mfc, dde_number, value)
+
+    def read_bronkhorst(self, dde_numbers: list[int], batched: bool = True) -> dict:
+        """
+
+        :param dde_numbers: Parameter numbers of parameters to read
+        :param batched: Read a list of parameters in one chained request
+
+        :returns: Dictionary with read parameter values and the parameter number
+
+        """
+        return self.read_bronkhorst_future(dde_numbers, batched).result()
+
+    def write_bronkhorst(self, dde_number: int, value: Any) -> bool:
+        """
+
+        :param dde_number: Parameter number for the parameter to be written
+        :param value: Value to write to the parameter number
+
+        :returns: True if the MFC acknowledged the write, False when it did not
+
+        """
+        return self.write_bronkhorst_future(dde_number, value).result()
+
+    def rebind(self, port: str) -> None:
+        """
+
+        Moves the MFC to another serial port on the thread of its worker, so
+        no queued request is sent while the port is swapped. The MFC keeps 
+        its worker, and with it the order of the requests already queued
+
+        :param port: New serial port of the MFC
+
+        """
+        self.worker.submit(self.mfc.rebind, port, priority=SETPOINT_PRIORITY).result()
@@ -0,0 +1,355 @@
+import json
+import time
+import bisect
+import threading
+import propar as pp
+from typing import Any
+from contextlib import contextmanager
+from bronkhorst_mfc_test.airpy import BronkhorstMFC, ResilientInstrument
+
+#######################################################################
+###-------------------Bronkhorst MFC bus profiler-------------------###
+#######################################################################
+
+# Upper bounds of the latency histogram buckets in seconds, slower calls go in a last bucket
+LATENCY_BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0)
+
+# Bytes of a binary propar frame around the message: DLE STX, sequence,
+# node, length and DLE ETX. Doubled DLE bytes in the data are not counted
+FRAME_OVERHEAD = 7
+ANSWER_STATUS_SIZE = 3
+TYPE_SIZES = {pp.PP_TYPE_INT8: 1, pp.PP_TYPE_INT16: 2, pp.PP_TYPE_SINT16: 2, pp.PP_TYPE_BSINT16: 2,
+              pp.PP_TYPE_INT32: 4, pp.PP_TYPE_FLOAT: 4}
+TIMEOUT_STATUSES = (pp.PP_STATUS_TIMEOUT_ANSWER, pp.PP_STATUS_NO_ANSWER_FOUND)
+
+
+def value_size(parm_type: int, value: Any) -> int:
+    """
+
+    :param parm_type: Propar type of the parameter
+    :param value: Value of the parameter, used for the length of strings
+
+    :return: Bytes of the value in a propar message
+
+    """
+    if parm_type in TYPE_SIZES:
+        return TYPE_SIZES[parm_type]
+    # Strings are sent with a length byte and zero terminated
+    return len(str(value or '')) + 2
+
+
+def request_size(parameters: list[dict]) -> int:
+    """
+
+    :param parameters: Propar parameters read in one request
+
+    :return: Bytes of the request frame, process and parameter are sent
+             for every requested parameter, and a length for strings
+
+    """
+    return FRAME_OVERHEAD + 1 + sum(4 + (parameter.get('parm_type') == pp.PP_TYPE_STRING) for parameter in parameters)
+
+
+def answer_size(parameters: list[dict], values: list[Any]) -> int:
+    """
+
+    :param parameters: Propar parameters answered in one message
+    :param values: Answered values
+
+    :return: Bytes of the answer frame, the process is sent once per process
+
+    """
+    processes = len({parameter.get('proc_nr') for parameter in parameters})
+    return FRAME_OVERHEAD + 1 + processes + sum(1 + value_size(parameter.get('parm_type'), value)
+                                                for parameter, value in zip(parameters, values))
+
+
+class LatencyHistogram:
+    def __init__(self, buckets: tuple[float] = LATENCY_BUCKETS) -> None:
+        """
+
+        Fixed bucket histogram of call latencies, cheap enough to update
+        on every serial request
+
+        :param buckets: Upper bounds of the buckets in seconds
+
+        """
+
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, seconds: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.min = seconds if self.min is None else min(self.min, seconds)
+        self.max = seconds if self.max is None else max(self.max, seconds)
+
+    def percentile(self, q: float) -> float|None:
+        """
+
+        :param q: Percentile from 0-100
+
+        :returns: Upper bound of the bucket holding the percentile, the
+                  maximum for the last bucket, None without any calls
+
+        """
+        if self.count == 0:
+            return None
+        rank = q / 100 * self.count
+        seen = 0
+        for idx, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return self.buckets[idx] if idx < len(self.buckets) else self.max
+        return self.max
+
+    def snapshot(self) -> dict:
+        """
+
+        :returns: Dictionary with count, mean, min, max, p50, p95, p99 and
+                  the bucket counts keyed by the upper bound in ms
+
+        """
+        labels = [f'<={bound*1000:g}ms' for bound in self.buckets] + [f'>{self.buckets[-1]*1000:g}ms']
+        return {'count': self.count,
+                'mean': self.total / self.count if self.count else None,
+                'min': self.min,
+                'max': self.max,
+                'p50': self.percentile(50),
+                'p95': self.percentile(95),
+                'p99': self.percentile(99),
+                'buckets': {label: count for label, count in zip(labels, self.counts) if count}}
+
+
+class BusProfiler:
+    def __init__(self) -> None:
+        """
+
+        Collects latency histograms per operation and parameter, timeouts,
+        retries, errors and bytes on the wire of all instruments wrapped
+        with profile_bronkhorst. Sections of other work, e.g. the GUI
+        update of a control loop, can be timed next to the bus with section()
+
+        """
+
+        self.started = time.time()
+        self.histograms = {}
+        self.counters = {'requests': 0, 'timeouts': 0, 'retries': 0, 'errors': 0,
+                         'bytes_sent': 0, 'bytes_received': 0}
+        self._lock = threading.Lock()
+
+    def record(self,
+               operation: str,
+               key: str,
+               seconds: float,
+               timeout: bool = False,
+               error: bool = False,
+               bytes_sent: int = 0,
+               bytes_received: int = 0) -> None:
+        """
+
+        :param operation: Kind of call, e.g. read or write
+        :param key: DDE number, or DDE numbers of a chained request
+        :param seconds: Latency of the call
+        :param timeout: The instrument did not answer
+        :param error: The instrument answered with an error status
+        :param bytes_sent: Bytes of the request frame
+        :param bytes_received: Bytes of the answer frame
+
+        """
+        with self._lock:
+            name = f'{operation} {key}'
+            if name not in self.histograms:
+                self.histograms[name] = LatencyHistogram()
+            self.histograms[name].add(seconds)
+            self.counters['requests'] += 1
+            self.counters['timeouts'] += timeout
+            self.counters['errors'] += error
+            self.counters['bytes_sent'] += bytes_sent
+            self.counters['bytes_received'] += bytes_received
+
+    def record_retry(self) -> None:
+        """
+
+        Counts a request that was sent again after a failure
+
+        """
+        with self._lock:
+            self.counters['retries'] += 1
+
+    @contextmanager
+    def section(self, name: str):
+        """
+
+        Times a block of code that is not bus I/O into its own histogram
+
+        :param name: Name of the section
+
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            with self._lock:
+                if f'section {name}' not in self.histograms:
+                    self.histograms[f'section {name}'] = LatencyHistogram()
+                self.histograms[f'section {name}'].add(seconds)
+
+    def snapshot(self) -> dict:
+        """
+
+        :returns: Live metrics with the counters, the bus time and the
+                  histogram summary of every operation
+
+        """
+        with self._lock:
+            bus_time = sum(h.total for name, h in self.histograms.items() if not name.startswith('section'))
+            return {'elapsed': time.time() - self.started,
+                    'bus_time': bus_time,
+                    **self.counters,
+                    'latency': {name: histogram.snapshot() for name, histogram in sorted(self.histograms.items())}}
+
+    def summary(self) -> str:
+        """
+
+        :returns: Table of the latency of every operation and the counters
+
+        """
+        snapshot = self.snapshot()
+        ms = lambda seconds: f'{seconds*1000:.2f}' if seconds is not None else '-'
+        lines = [f'{"Operation":<24}{"Count":>8}{"Mean ms":>10}{"p50 ms":>10}{"p95 ms":>10}{"Max ms":>10}']
+        for name, latency in snapshot['latency'].items():
+            lines.append(f'{name:<24}{latency["count"]:>8}{ms(latency["mean"]):>10}{ms(latency["p50"]):>10}'
+                         f'{ms(latency["p95"]):>10}{ms(latency["max"]):>10}')
+        lines.append(f'{snapshot["requests"]} requests in {snapshot["elapsed"]:.1f} s, '
+                     f'{snapshot["bus_time"]:.2f} s on the bus, {snapshot["timeouts"]} timeouts, '
+                     f'{snapshot["retries"]} retries, {snapshot["errors"]} errors, '
+                     f'{snapshot["bytes_sent"]} B sent, {snapshot["bytes_received"]} B received')
+        return '\n'.join(lines)
+
+    def export(self, path: str) -> None:
+        """
+
+        Writes the snapshot of the profiler to a .json file
+
+        :param path: Path of the file
+
+        """
+        with open(path, 'w') as file:
+            json.dump(self.snapshot(), file, indent=2)
+
+
+class ProfiledInstrument:
+    def __init__(self, communication: Any, profiler: BusProfiler) -> None:
+        """
+
+        Wraps an object with the propar.instrument interface and records
+        every request in a BusProfiler. Other attributes are passed on
+
+        :param communication: propar.instrument or an object with its interface
+        :param profiler: BusProfiler to record in
+
+        """
+
+        self.communication = communication
+        self.profiler = profiler
+        self._parameters = {}
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.communication, name)
+
+    def _parameter(self, dde_nr: int) -> dict:
+        if dde_nr not in self._parameters:
+            self._parameters[dde_nr] = self.communication.db.get_parameter(dde_nr)
+        return self._parameters[dde_nr]
+
+    def _key(self, parameters: list[dict]) -> str:
+        return ','.join(str(p['dde_nr']) if 'dde_nr' in p else f'{p["proc_nr"]}/{p["parm_nr"]}' for p in parameters)
+
+    def readParameter(self, dde_nr: int, channel: int|None = None) -> Any:
+        parameter = self._parameter(dde_nr)
+        start = time.perf_counter()
+        value = self.communication.readParameter(dde_nr, channel)
+        seconds = time.perf_counter() - start
+        # readParameter only returns None, which is nearly always a missing answer
+        self.profiler.record('read', str(dde_nr), seconds, timeout=value is None,
+                             bytes_sent=request_size([parameter]),
+                             bytes_received=answer_size([parameter], [value]) if value is not None else 0)
+        return value
+
+    def writeParameter(self, dde_nr: int, data: Any, channel: int|None = None) -> Any:
+        parameter = self._parameter(dde_nr)
+        start = time.perf_counter()
+        result = self.communication.writeParameter(dde_nr, data, channel)
+        seconds = time.perf_counter() - start
+        self.profiler.record('write', str(dde_nr), seconds, error=result is False,
+                             bytes_sent=answer_size([parameter], [data]),
+                             bytes_received=FRAME_OVERHEAD + ANSWER_STATUS_SIZE)
+        return result
+
+    def read_parameters(self, parameters: list[dict], callback=None, channel: int|None = None) -> Any:
+        key = self._key(parameters)
+        sent = request_size(parameters)
+        start = time.perf_counter()
+        response = self.communication.read_parameters(parameters, callback, channel)
+        seconds = time.perf_counter() - start
+        if response is None:
+            self.profiler.record('read', key, seconds, bytes_sent=sent)
+            return response
+
+        status = response[0].get('status', pp.PP_STATUS_OK) if response else pp.PP_STATUS_NO_ANSWER_FOUND
+        complete = len(response) == len(parameters)
+        self.profiler.record('read', key, seconds,
+                             timeout=status in TIMEOUT_STATUSES,
+                             error=status not in TIMEOUT_STATUSES and any(r.get('status', pp.PP_STATUS_OK) != pp.PP_STATUS_OK
+                                                                        for r in response),
+                             bytes_sent=sent,
+                             bytes_received=answer_size(parameters, [r.get('data') for r in response]) if complete else 0)
+        return response
+
+    def write_parameters(self, parameters: list[dict], command: int = pp.PP_COMMAND_SEND_PARM_WITH_ACK,
+                         callback=None, channel: int|None = None) -> Any:
+        key = self._key(parameters)
+        start = time.perf_counter()
+        status = self.communication.write_parameters(parameters, command, callback, channel)
+        seconds = time.perf_counter() - start
+        self.profiler.record('write', key, seconds,
+                             timeout=status in TIMEOUT_STATUSES,
+                             error=status not in TIMEOUT_STATUSES + (pp.PP_STATUS_OK, None),
+                             bytes_sent=answer_size(parameters, [p.get('data') for p in parameters]),
+                             bytes_received=FRAME_OVERHEAD + ANSWER_STATUS_SIZE)
+        return status
+
+
+def profile_bronkhorst(bh_mfc: BronkhorstMFC, profiler: BusProfiler|None = None) -> BusProfiler:
+    """
+
+    Routes all I/O of a BronkhorstMFC through a ProfiledInstrument
+
+    :param bh_mfc: BronkhorstMFC object to profile
+    :param profiler: BusProfiler to record in, shared between MFCs to
+                     profile the whole rig, a new one when None
+
+    :return: The BusProfiler recording the MFC
+
+    """
+    profiler = profiler if profiler is not None else BusProfiler()
+
+    # Retries happen inside a single call, so the resilient layer reports them itself
+    communication = bh_mfc.communication
+    if isinstance(communication, ProfiledInstrument):
+        communication = communication.communication
+    if isinstance(communication, ResilientInstrument):
+        communication.on_retry = profiler.record_retry
+
+    if isinstance(bh_mfc.communication, ProfiledInstrument):
+        bh_mfc.communication.profiler = profiler
+    else:
+        bh_mfc.communication = ProfiledInstrument(bh_mfc.communication, profiler)
+    return profiler
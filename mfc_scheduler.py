@@ -0,0 +1,152 @@
+import time
+from typing import Iterator
+from dataclasses import dataclass
+from bronkhorst_mfc_test.mfc_profiler import LatencyHistogram
+
+#######################################################################
+###-------------------Fixed rate sampling scheduler-----------------###
+#######################################################################
+
+# Upper bounds of the jitter histogram buckets in seconds
+JITTER_BUCKETS = (0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0)
+
+# 'skip' drops the ticks whose period passed completely during an overrun and
+# continues on the grid, 'flag' runs every tick, the missed ones right away
+# and marked as overrun, until the schedule has caught up
+OVERRUN_POLICIES = ('skip', 'flag')
+
+
+@dataclass
+class Tick:
+    """
+
+    One tick of a DeadlineScheduler. index is the number of periods since
+    the start, deadline the time.monotonic() the tick was due and lateness
+    the seconds it started after its deadline. overrun is True when the
+    work of the previous tick ran past this deadline, and skipped counts
+    the ticks dropped right before this one
+
+    """
+    index: int
+    deadline: float
+    lateness: float
+    overrun: bool = False
+    skipped: int = 0
+
+
+class DeadlineScheduler:
+    def __init__(self, period: float, overrun: str = 'skip') -> None:
+        """
+
+        Ticks at a fixed rate on the monotonic clock. Every tick is due at
+        start + index * period, so the time spent on the work of a tick does
+        not add to the period and the samples do not drift, as they do when
+        sleeping a fixed time after the work
+
+        :param period: Seconds between ticks
+        :param overrun: What to do with ticks missed by slow work, one of OVERRUN_POLICIES
+
+        """
+
+        if overrun not in OVERRUN_POLICIES:
+            raise ValueError(f'Unknown overrun policy {overrun}, use one of {OVERRUN_POLICIES}.')
+        self.period = period
+        self.overrun = overrun
+        self.ticks_run = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.jitter = LatencyHistogram(JITTER_BUCKETS)
+        self.restart()
+
+    def restart(self) -> None:
+        """
+
+        Starts a new grid with the first tick due now, the statistics are kept
+
+        """
+        self.start = time.monotonic()
+        self.index = -1
+
+    def wait(self) -> Tick:
+        """
+
+        Sleeps until the next tick is due
+
+        :returns: Tick that is due
+
+        """
+        index = self.index + 1
+        deadline = self.start + index * self.period
+        now = time.monotonic()
+        overrun = now > deadline and index > 0
+        skipped = 0
+
+        if overrun and self.overrun == 'skip':
+            # Continue with the latest tick that is due, the ones before it are dropped
+            due = int((now - self.start) // self.period)
+            skipped = max(due - index, 0)
+            index += skipped
+            deadline = self.start + index * self.period
+        elif now < deadline:
+            time.sleep(deadline - now)
+            now = time.monotonic()
+
+        self.index = index
+        tick = Tick(index, deadline, max(now - deadline, 0.0), overrun, skipped)
+        self.ticks_run += 1
+        self.overruns += overrun
+        self.skipped += skipped
+        self.jitter.add(tick.lateness)
+        return tick
+
+    def ticks(self, count: int|None = None) -> Iterator[Tick]:
+        """
+
+        :param count: Number of periods to run, e.g. the seconds of a step
+                      with a 1 s period, runs until stopped when None. With
+                      the 'skip' policy fewer ticks are run if some are dropped,
+                      but the last one is still due at (count - 1) * period
+
+        :returns: Iterator of the ticks, starting with one due now
+
+        """
+        self.restart()
+        while count is None or self.index + 1 < count:
+            tick = self.wait()
+            if count is not None and tick.index >= count:
+                return
+            yield tick
+
+        # The run lasts count periods, so a following run starts on the grid
+        remaining = self.start + count * self.period - time.monotonic()
+        if remaining > 0:
+            time.sleep(remaining)
+
+    def __iter__(self) -> Iterator[Tick]:
+        return self.ticks()
+
+    def stats(self) -> dict:
+        """
+
+        :returns: Dictionary with the number of ticks, overruns and skipped
+                  ticks, and the jitter (lateness) histogram
+
+        """
+        return {'period': self.period,
+                'ticks': self.ticks_run,
+                'overruns': self.overruns,
+                'skipped': self.skipped,
+                'jitter': self.jitter.snapshot()}
+
+    def summary(self) -> str:
+        """
+
+        :returns: One line summary of the ticks and their jitter
+
+        """
+        jitter = self.jitter
+        if jitter.count == 0:
+            return f'{self.period:g} s ticks: none run'
+        return (f'{self.period:g} s ticks: {self.ticks_run} run, {self.overruns} overruns, {self.skipped} skipped, '
+                f'jitter mean {jitter.total/jitter.count*1000:.2f} ms, p95 <= {jitter.percentile(95)*1000:.2f} ms, '
+                f'max {jitter.max*1000:.2f} ms')
@@ -0,0 +1,265 @@
+import time
+import weakref
+import threading
+from dataclasses import dataclass, field
+from bronkhorst_mfc_test.airpy import BronkhorstMFC, FULL_SCALE
+
+#######################################################################
+###-------------------Bronkhorst MFC setpoint writes----------------###
+#######################################################################
+
+
+@dataclass
+class SetpointWrite:
+    """
+
+    Result of one setpoint write, latency is the time from sending the
+    write until it was acknowledged, or confirmed by read-back when verified.
+    sent and acknowledged are time.perf_counter() stamps of the write frame.
+    written is False for a skipped write and for a write the MFC did not
+    acknowledge, which then has verified False
+
+    """
+    port: str
+    value: float
+    written: bool
+    verified: bool|None = None
+    latency: float = 0.0
+    sent: float|None = None
+    acknowledged: float|None = None
+
+
+@dataclass
+class StepWrite:
+    """
+
+    Result of writing the setpoints of all MFCs for one step, latency is
+    the time until the last setpoint was applied and skew the time between
+    the first and the last setpoint write being acknowledged
+
+    """
+    writes: list[SetpointWrite] = field(default_factory=list)
+    latency: float = 0.0
+    skew: float = 0.0
+
+    @property
+    def written(self) -> int:
+        return sum(write.written for write in self.writes)
+
+
+class SetpointWriter:
+    def __init__(self, bh_mfc: BronkhorstMFC, dde_number: int = 206, tolerance: float = 1e-6) -> None:
+        """
+
+        Writes the setpoint of one MFC, skipping writes of the value that
+        was last written. Only writes through the writer are known, call
+        forget() after the setpoint was changed by other means
+
+        :param bh_mfc: BronkhorstMFC object, or a wrapper with the same interface
+        :param dde_number: Setpoint parameter written, 206 in capacity unit or 9 from 0-32000
+        :param tolerance: Difference from the last written value below which
+                          a write is skipped
+
+        """
+
+        self.mfc = bh_mfc
+        self.dde_number = dde_number
+        self.tolerance = tolerance
+        self.value = None
+        self.written = 0
+        self.skipped = 0
+        self.last_latency = None
+        self._lock = threading.Lock()
+
+    def write(self, value: float, verify: bool = False, force: bool = False, timeout: float = 1.0) -> SetpointWrite:
+        """
+
+        :param value: Setpoint to write
+        :param verify: Read the setpoint back (DDE 206 and 9) until it matches
+        :param force: Write even when the value was already written
+        :param timeout: Seconds to wait for the read-back to match
+
+        :returns: SetpointWrite with the result of the write
+
+        """
+        with self._lock:
+            if not force and not self.changed(value):
+                self.skipped += 1
+                return SetpointWrite(self.mfc.port, value, written=False)
+
+            # Until the write is acknowledged the setpoint of the MFC is unknown
+            self.value = None
+            start = time.perf_counter()
+            written = bool(self.mfc.write_bronkhorst(self.dde_number, value))
+            acknowledged = time.perf_counter()
+            if not written:
+                return SetpointWrite(self.mfc.port, value, written=False, verified=False, sent=start)
+            verified = self.confirm(value, timeout) if verify else None
+            latency = time.perf_counter() - start
+
+            # A setpoint that is not confirmed stays unknown, so the next write is sent
+            if verified is not False:
+                self.value = value
+            self.written += 1
+            self.last_latency = latency
+            return SetpointWrite(self.mfc.port, value, written=True, verified=verified, latency=latency, 
+                                 sent=start, acknowledged=acknowledged)
+
+    def changed(self, value: float) -> bool:
+        """
+
+        :param value: Setpoint to write
+
+        :returns: True if the value differs from the last written setpoint
+
+        """
+        return self.value is None or abs(value - self.value) > self.tolerance
+
+    def confirm(self, value: float, timeout: float = 1.0) -> bool:
+        """
+
+        Reads back both setpoints until they match the written value
+
+        :param value: Written setpoint
+        :param timeout: Seconds to wait for the read-back to match
+
+        :returns: True if the MFC reports the written setpoint within timeout
+
+        """
+        if self.dde_number == 206:
+            expected = {206: value, 9: value / self.mfc.max_flow * FULL_SCALE}
+        else:
+            expected = {9: value, 206: value / FULL_SCALE * self.mfc.max_flow}
+        tolerances = {206: max(self.tolerance, self.mfc.max_flow / FULL_SCALE), 9: 1}
+
+        deadline = time.perf_counter() + timeout
+        while True:
+            read = self.mfc.read_bronkhorst([206, 9])
+            if all(read.get(dde) is not None and abs(read[dde] - expected[dde]) <= tolerances[dde] for dde in expected):
+                return True
+            if time.perf_counter() > deadline:
+                return False
+            time.sleep(0.01)
+
+    def forget(self) -> None:
+        """
+
+        Forgets the last written setpoint, so the next write is always sent.
+        Not locked, as a port reopened in the middle of a write calls it too
+
+        """
+        self.value = None
+
+
+_setpoint_writers = weakref.WeakKeyDictionary()
+_setpoint_writers_lock = threading.Lock()
+
+
+def setpoint_writer(bh_mfc: BronkhorstMFC) -> SetpointWriter:
+    """
+
+    :param bh_mfc: BronkhorstMFC object to write the setpoint of
+
+    :return: The SetpointWriter of the MFC, created on first use so every
+             part of a program shares what was last written. The writer
+             forgets the setpoint when the port of the MFC is reopened or
+             rebound, as a reset MFC would otherwise never get it again
+
+    """
+    with _setpoint_writers_lock:
+        if bh_mfc not in _setpoint_writers:
+            writer = SetpointWriter(bh_mfc)
+            # Wrappers (queued, async) hold the BronkhorstMFC as mfc
+            reset_callbacks = getattr(getattr(bh_mfc, 'mfc', bh_mfc), 'reset_callbacks', None)
+            if reset_callbacks is not None:
+                reset_callbacks.append(writer.forget)
+            _setpoint_writers[bh_mfc] = writer
+        return _setpoint_writers[bh_mfc]
+
+
+def write_step(setpoints: list[tuple[BronkhorstMFC, float]], verify: bool = False) -> StepWrite:
+    """
+
+    Writes the setpoints of all MFCs for one step, setpoints that are
+    unchanged since the last step are not sent
+
+    :param setpoints: List of tuples of MFC and setpoint in its capacity unit
+    :param verify: Confirm every written setpoint by reading it back
+
+    :return: StepWrite with the results and the time until all setpoints were applied
+
+    """
+    start = time.perf_counter()
+    step = StepWrite()
+    for bh_mfc, value in setpoints:
+        step.writes.append(setpoint_writer(bh_mfc).write(value, verify=verify))
+    step.latency = time.perf_counter() - start
+    return step
+
+
+def apply_step(setpoints: list[tuple[BronkhorstMFC, float]], verify: bool = False, timeout: float = 5.0) -> StepWrite:
+    """
+
+    Writes the setpoints of all MFCs for one step as close together as 
+    possible. The changed setpoints are staged on one thread per port,
+    which are released together, so the transitions are not a serial 
+    round trip apart as with write_step. MFCs sharing a port (FLOW-BUS)
+    are written one after another on the thread of the port
+
+    :param setpoints: List of tuples of MFC and setpoint in its capacity unit
+    :param verify: Confirm every written setpoint by reading it back, after
+                   all setpoints of the port are written
+    :param timeout: Seconds to wait for the threads of all ports to be ready
+
+    :return: StepWrite with the results, the time until all setpoints were
+             applied and the skew between the transitions
+
+    """
+
+    # Stage the writes per port, unchanged setpoints do not need a thread
+    results = [None] * len(setpoints)
+    by_port = {}
+    for idx, (bh_mfc, value) in enumerate(setpoints):
+        writer = setpoint_writer(bh_mfc)
+        if writer.changed(value):
+            by_port.setdefault(bh_mfc.port, []).append((idx, writer, value))
+        else:
+            results[idx] = writer.write(value)
+
+    barrier = threading.Barrier(len(by_port) + 1)
+    errors = []
+
+    def fire(writes: list[tuple[int, SetpointWriter, float]]) -> None:
+        try:
+            barrier.wait(timeout)
+            for idx, writer, value in writes:
+                results[idx] = writer.write(value)
+            if verify:
+                for idx, writer, value in writes:
+                    if not results[idx].written:
+                        continue
+                    results[idx].verified = writer.confirm(value)
+                    results[idx].latency = time.perf_counter() - results[idx].sent
+                    if not results[idx].verified:
+                        writer.forget()
+        except BaseException as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=fire, args=(writes,), name=f'mfc-step-{port}') 
+               for port, writes in by_port.items()]
+    for thread in threads:
+        thread.start()
+
+    # Released once every port thread is waiting, so only the writes themselves differ in time
+    barrier.wait(timeout)
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    latency = time.perf_counter() - start
+    if errors:
+        raise errors[0]
+
+    step = StepWrite(results, latency)
+    acknowledged = [write.acknowledged for write in step.writes if write.written]
+    step.skew = max(acknowledged) - min(acknowledged) if len(acknowledged) > 1 else 0.0
+    return step
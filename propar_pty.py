@@ -0,0 +1,494 @@
+import os
+import tty
+import time
+import random
+import select
+import struct
+import threading
+import propar as pp
+from typing import Any
+from bronkhorst_mfc_test.propar_sim import SimulatedInstrument
+
+#######################################################################
+###--------------------Propar framing constants--------------------###
+#######################################################################
+
+# Binary frames:  DLE STX <seq> <node> <len> <data...> DLE ETX, DLE bytes doubled
+# ASCII frames:   :<len+1><node><data...>\r\n as hex characters, no sequence number
+
+BYTE_DLE = 0x10
+BYTE_STX = 0x02
+BYTE_ETX = 0x03
+
+# Propar parameters answered by the node itself rather than the MFC model,
+# these are what propar.master.get_nodes uses to scan the bus
+NODE_ID = (0, 0)
+NODE_ADDRESS = (0, 1)
+NODE_NEXT = (0, 3)
+NODE_CHANNELS = (0, 18)
+NODE_DEVICE_TYPE = (113, 1)
+
+
+def parse_request(data: list[int]) -> list[dict]:
+    """
+
+    Reads the parameters of a propar request parameter message
+
+    :param data: Message data starting with the command byte
+
+    :return: List of requested parameters with process number,
+             parameter number, wire type and string length
+
+    """
+
+    pos = 1
+    parm_chained = False
+    parameters = []
+    while pos < len(data):
+        if not parm_chained:
+            pos += 1  # process index
+        parm_index = data[pos]
+        parm_chained = (parm_index & 0x80) != 0
+        proc_nr = data[pos + 1] & 0x7F
+        parm_nr = data[pos + 2]
+        pos += 3
+        parameter = {'proc_nr': proc_nr, 'parm_nr': parm_nr & 0x1F, 'wire_type': parm_nr & 0x60, 'size': 0}
+        if parameter['wire_type'] == pp.PP_TYPE_STRING:
+            parameter['size'] = data[pos]
+            pos += 1
+        parameters.append(parameter)
+    return parameters
+
+
+def parse_send(data: list[int]) -> list[dict]:
+    """
+
+    Reads the parameters and raw values of a propar send parameter message
+
+    :param data: Message data starting with the command byte
+
+    :return: List of sent parameters with process number, parameter
+             number, wire type and the raw value bytes
+
+    """
+
+    pos = 1
+    parm_chained = False
+    proc_nr = 0
+    parameters = []
+    while pos < len(data):
+        if not parm_chained:
+            proc_nr = data[pos] & 0x7F
+            pos += 1
+        parm_index = data[pos]
+        parm_chained = (parm_index & 0x80) != 0
+        wire_type = parm_index & 0x60
+        pos += 1
+        if wire_type == pp.PP_TYPE_STRING:
+            length = data[pos]
+            pos += 1
+            if length == 0:
+                length = data.index(0, pos) - pos + 1
+            raw = bytes(data[pos:pos + length])
+        else:
+            length = {pp.PP_TYPE_INT8: 1, pp.PP_TYPE_INT16: 2, pp.PP_TYPE_INT32: 4}[wire_type]
+            raw = bytes(data[pos:pos + length])
+        pos += length
+        parameters.append({'proc_nr': proc_nr, 'parm_nr': parm_index & 0x1F, 'wire_type': wire_type, 'raw': raw})
+    return parameters
+
+
+def encode_value(wire_type: int, value: Any) -> bytes:
+    """
+
+    :param wire_type: Propar type bits of the parameter on the wire
+    :param value: Value to encode, floats are sent as 32 bit values
+
+    :return: Bytes of the value as sent in a propar message
+
+    """
+
+    if wire_type == pp.PP_TYPE_INT8:
+        return bytes([int(value) & 0xFF])
+    elif wire_type == pp.PP_TYPE_INT16:
+        return (int(value) & 0xFFFF).to_bytes(2, 'big')
+    elif wire_type == pp.PP_TYPE_INT32:
+        if isinstance(value, float):
+            return struct.pack('>f', value)
+        return (int(value) & 0xFFFFFFFF).to_bytes(4, 'big')
+    # Strings are answered zero terminated with a length byte of 0
+    return b'\x00' + str(value).encode('ascii') + b'\x00'
+
+
+def build_answer(parameters: list[dict]) -> list[int]:
+    """
+
+    Builds the data of a send parameter message answering a request,
+    with the chaining bits set as in the request
+
+    :param parameters: Requested parameters with the encoded value bytes
+
+    :return: Message data starting with the command byte
+
+    """
+
+    data = [pp.PP_COMMAND_SEND_PARM]
+    for idx, parameter in enumerate(parameters):
+        following = parameters[idx + 1] if idx + 1 < len(parameters) else None
+        same_process = following is not None and following['proc_nr'] == parameter['proc_nr']
+        first_of_process = idx == 0 or parameters[idx - 1]['proc_nr'] != parameter['proc_nr']
+        if first_of_process:
+            # The process byte is chained when another process follows this one
+            later_process = any(p['proc_nr'] != parameter['proc_nr'] for p in parameters[idx + 1:])
+            data.append(parameter['proc_nr'] | (0x80 if later_process else 0x00))
+        data.append(parameter['parm_nr'] | parameter['wire_type'] | (0x80 if same_process else 0x00))
+        data.extend(parameter['value'])
+    return data
+
+
+def frame_binary(seq: int, node: int, data: list[int]) -> bytes:
+    """
+
+    :return: Binary propar frame with DLE bytes doubled
+
+    """
+    body = []
+    for byte in [seq, node, len(data)] + list(data):
+        body.append(byte)
+        if byte == BYTE_DLE:
+            body.append(byte)
+    return bytes([BYTE_DLE, BYTE_STX] + body + [BYTE_DLE, BYTE_ETX])
+
+
+def frame_ascii(node: int, data: list[int]) -> bytes:
+    """
+
+    :return: ASCII propar frame
+
+    """
+    return (f':{len(data) + 1:02X}{node:02X}' + ''.join(f'{b:02X}' for b in data) + '\r\n').encode('ascii')
+
+
+class ProparPtyEmulator:
+    def __init__(self,
+                 nodes: list[SimulatedInstrument]|None = None,
+                 baudrate: int = 38400,
+                 response_delay: float = 0.002,
+                 bit_error_rate: float = 0.0,
+                 timeout_rate: float = 0.0,
+                 seed: int|None = None) -> None:
+        """
+
+        Emulates Bronkhorst instruments on the slave side of a pseudo terminal,
+        answering binary and ASCII propar frames, so the unmodified
+        propar.instrument(port) code path can run against self.port
+
+        :param nodes: Simulated MFCs on the bus, nodes without a bus address
+                      (0x80) are given the addresses 3, 4, 5, ... in order.
+                      The first node answers messages for the local address 0x80
+        :param baudrate: Baud rate to emulate, every frame is delayed by the
+                         time its bytes would take on a real serial line
+        :param response_delay: Processing time of the instrument per request
+        :param bit_error_rate: Probability for every answered bit to be flipped
+        :param timeout_rate: Probability for a request not to be answered
+        :param seed: Seed for the injected errors
+
+        """
+
+        if nodes is None:
+            nodes = [SimulatedInstrument(noise=0, latency=0)]
+        self.nodes = {}
+        for idx, node in enumerate(nodes):
+            address = node.address if node.address < 0x80 else 3 + idx
+            self.nodes[address] = node
+        self.addresses = list(self.nodes)
+
+        self.baudrate = baudrate
+        self.response_delay = response_delay
+        self.bit_error_rate = bit_error_rate
+        self.timeout_rate = timeout_rate
+        self._random = random.Random(seed)
+        self._forced_timeouts = 0
+
+        self.stats = {'frames_received': 0, 'frames_answered': 0, 'bytes_received': 0,
+                      'bytes_sent': 0, 'bit_errors': 0, 'timeouts': 0, 'framing_errors': 0}
+
+        self._master_fd = None
+        self._slave_fd = None
+        self._thread = None
+        self.port = None
+        self.connect()
+
+    def connect(self) -> str:
+        """
+
+        Opens a new pseudo terminal pair and starts answering frames on it.
+        Every connection gets a new device name, like a re-enumerated USB adapter
+
+        :returns: Device name of the serial port to open
+
+        """
+
+        self._master_fd, self._slave_fd = os.openpty()
+        tty.setraw(self._slave_fd)
+        self.port = os.ttyname(self._slave_fd)
+        self._running = True
+        self._thread = threading.Thread(target=self._serve, args=(self._master_fd,), daemon=True)
+        self._thread.start()
+        return self.port
+
+    def disconnect(self) -> None:
+        """
+
+        Closes the pseudo terminal, as if the adapter was unplugged
+
+        """
+
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+        for fd in (self._master_fd, self._slave_fd):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        self._thread = None
+
+    def reconnect(self) -> str:
+        """
+
+        :returns: Device name of the new serial port
+
+        """
+        self.disconnect()
+        return self.connect()
+
+    def inject_timeouts(self, count: int = 1) -> None:
+        """
+
+        Leaves the next requests unanswered
+
+        :param count: Number of requests not to answer
+
+        """
+        self._forced_timeouts += count
+
+    def _serve(self, fd: int) -> None:
+        """
+
+        Reads bytes from the master side and answers every complete frame
+
+        """
+
+        state = 'idle'
+        buffer = []
+        while self._running:
+            readable, _, _ = select.select([fd], [], [], 0.05)
+            if not readable:
+                continue
+            try:
+                chunk = os.read(fd, 1024)
+            except OSError:
+                return
+            self.stats['bytes_received'] += len(chunk)
+            for byte in chunk:
+                if state == 'idle':
+                    if byte == BYTE_DLE:
+                        state = 'start'
+                    elif byte == 0x3A:  # ':'
+                        state, buffer = 'ascii', []
+                elif state == 'start':
+                    state, buffer = ('binary', []) if byte == BYTE_STX else ('idle', [])
+                elif state == 'binary':
+                    if byte == BYTE_DLE:
+                        state = 'binary_dle'
+                    else:
+                        buffer.append(byte)
+                elif state == 'binary_dle':
+                    if byte == BYTE_DLE:
+                        buffer.append(byte)
+                        state = 'binary'
+                    elif byte == BYTE_ETX:
+                        state = 'idle'
+                        if len(buffer) >= 3 and buffer[2] == len(buffer) - 3:
+                            self._handle(fd, buffer[0], buffer[1], buffer[3:], ascii_mode=False,
+                                         request_size=len(buffer) + 4 + buffer.count(BYTE_DLE))
+                        else:
+                            self.stats['framing_errors'] += 1
+                    else:
+                        state = 'idle'
+                        self.stats['framing_errors'] += 1
+                elif state == 'ascii':
+                    if byte == 0x0D:
+                        continue
+                    if byte == 0x0A:
+                        state = 'idle'
+                        try:
+                            message = bytes.fromhex(bytes(buffer).decode('ascii'))
+                        except ValueError:
+                            self.stats['framing_errors'] += 1
+                            continue
+                        if len(message) >= 2 and message[0] == len(message) - 1:
+                            self._handle(fd, 0, message[1], list(message[2:]), ascii_mode=True,
+                                         request_size=len(buffer) + 3)
+                        else:
+                            self.stats['framing_errors'] += 1
+                    else:
+                        buffer.append(byte)
+
+    def _handle(self, fd: int, seq: int, node: int, data: list[int], ascii_mode: bool, request_size: int) -> None:
+        """
+
+        Answers one received propar message
+
+        """
+
+        self.stats['frames_received'] += 1
+        address = self.addresses[0] if node == 0x80 else node
+        if address not in self.nodes or not data:
+            # Nothing on the bus answers an unknown address
+            return
+
+        answer = self._answer(address, data)
+        if answer is None:
+            return
+        if self._forced_timeouts > 0 or self._random.random() < self.timeout_rate:
+            self._forced_timeouts = max(self._forced_timeouts - 1, 0)
+            self.stats['timeouts'] += 1
+            return
+
+        frame = frame_ascii(address, answer) if ascii_mode else frame_binary(seq, address, answer)
+        if self.bit_error_rate > 0:
+            frame = self._flip_bits(frame)
+
+        # Request and answer share the line, every byte is 10 bits with start and stop bit
+        time.sleep(self.response_delay + (request_size + len(frame)) * 10 / self.baudrate)
+        try:
+            os.write(fd, frame)
+        except OSError:
+            return
+        self.stats['frames_answered'] += 1
+        self.stats['bytes_sent'] += len(frame)
+
+    def _flip_bits(self, frame: bytes) -> bytes:
+        frame = bytearray(frame)
+        for idx in range(len(frame)):
+            for bit in range(8):
+                if self._random.random() < self.bit_error_rate:
+                    frame[idx] ^= 1 << bit
+                    self.stats['bit_errors'] += 1
+        return bytes(frame)
+
+    def _answer(self, address: int, data: list[int]) -> list[int]|None:
+        """
+
+        :return: Data of the answer message, None when no answer is sent
+
+        """
+
+        node = self.nodes[address]
+        command = data[0]
+        try:
+            if command == pp.PP_COMMAND_REQUEST_PARM:
+                parameters = parse_request(data)
+                for parameter in parameters:
+                    value = self._node_value(address, parameter)
+                    if value is None:
+                        return [pp.PP_COMMAND_STATUS, pp.PP_STATUS_PARM_NUMBER, 0]
+                    parameter['value'] = encode_value(parameter['wire_type'], value)
+                return build_answer(parameters)
+
+            elif command in (pp.PP_COMMAND_SEND_PARM_WITH_ACK, pp.PP_COMMAND_SEND_PARM):
+                status = pp.PP_STATUS_OK
+                for parameter in parse_send(data):
+                    dde = node.dde_number(parameter)
+                    if dde is None or not node.set_value(dde, self._decode(node, dde, parameter)):
+                        status = pp.PP_STATUS_PARM_NUMBER
+                if command == pp.PP_COMMAND_SEND_PARM:
+                    return None
+                return [pp.PP_COMMAND_STATUS, status, 0]
+
+        except (IndexError, KeyError, ValueError):
+            return [pp.PP_COMMAND_STATUS, pp.PP_STATUS_PROTOCOL_ERROR, 0]
+        return [pp.PP_COMMAND_STATUS, pp.PP_STATUS_COMMAND, 0]
+
+    def _node_value(self, address: int, parameter: dict) -> Any:
+        """
+
+        :return: Value of a requested parameter, None if the node does not know it
+
+        """
+
+        node = self.nodes[address]
+        key = (parameter['proc_nr'], parameter['parm_nr'])
+        if key == NODE_ADDRESS:
+            return address
+        elif key == NODE_ID:
+            return f'M1S{node.serial_number}'
+        elif key == NODE_NEXT:
+            idx = self.addresses.index(address)
+            return self.addresses[idx + 1] if idx + 1 < len(self.addresses) else 0
+        elif key == NODE_CHANNELS:
+            return 1
+        elif key == NODE_DEVICE_TYPE:
+            return 'DMFC'
+
+        dde = node.dde_number(parameter)
+        if dde is None:
+            return None
+        value = node.get_value(dde)
+        if value is not None and node.db.get_parameter(dde)['parm_type'] == pp.PP_TYPE_FLOAT:
+            value = float(value)
+        return value
+
+    def _decode(self, node: SimulatedInstrument, dde: int, parameter: dict) -> Any:
+        raw = parameter['raw']
+        parm_type = node.db.get_parameter(dde)['parm_type']
+        if parm_type == pp.PP_TYPE_FLOAT:
+            return struct.unpack('>f', raw)[0]
+        elif parameter['wire_type'] == pp.PP_TYPE_STRING:
+            return raw.rstrip(b'\x00').decode('ascii')
+        return int.from_bytes(raw, 'big')
+
+
+def measure_frame_cost(port: str, dde_numbers: list[int] = [8, 9, 205, 206], repeats: int = 50) -> dict:
+    """
+
+    Times single and chained reads through propar and pyserial on a port
+
+    :param port: Serial port to read from, e.g. ProparPtyEmulator().port
+    :param dde_numbers: Parameter numbers to read
+    :param repeats: Number of reads to average over
+
+    :return: Dictionary with the average time per read of each path
+
+    """
+
+    instrument = pp.instrument(port)
+    db_parameters = [instrument.db.get_parameter(dde) for dde in dde_numbers]
+    timings = {}
+
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for dde in dde_numbers:
+            instrument.readParameter(dde)
+    timings['single'] = (time.perf_counter() - start) / repeats
+
+    start = time.perf_counter()
+    for _ in range(repeats):
+        instrument.read_parameters([dict(p) for p in db_parameters])
+    timings['chained'] = (time.perf_counter() - start) / repeats
+
+    print(f'DDE {dde_numbers} on {port}: {timings["single"]*1000:.2f} ms with one frame per parameter, '
+          f'{timings["chained"]*1000:.2f} ms chained')
+    return timings
+
+
+if __name__ == '__main__':
+    # Two MFCs behind one emulated port, read through the real propar master
+    emulator = ProparPtyEmulator([SimulatedInstrument(max_flow=100, capacity_unit='mln/min', serial_number='M00000001A'),
+                                  SimulatedInstrument(max_flow=2.5, capacity_unit='ln/min', serial_number='M00000002A')])
+    print(f'Emulating propar instruments at {emulator.port}')
+    measure_frame_cost(emulator.port)
+    print(pp.instrument(emulator.port).master.get_nodes())
+    print(emulator.stats)
@@ -0,0 +1,371 @@
+import math
+import time
+import random
+import threading
+import propar as pp
+from typing import Any
+from bronkhorst_mfc_test.airpy import FULL_SCALE
+
+#######################################################################
+###--------------Simulated Bronkhorst MFC DDE numbers---------------###
+#######################################################################
+
+# {
+# 8: 'Measure',               # Measurement from 0-32000 (32000 = 100%)
+# 9: 'Setpoint',              # Setpoint from 0-32000
+# 21: 'Max Output',           # Maximum output in capacity unit at 100%
+# 92: 'Serial Number',        # Serial number of the instrument
+# 129: 'Capacity Unit',       # Readout unit of the MFC at capacity
+# 205: 'fMeasure',            # Actual flow in capacity unit
+# 206: 'fSetpoint',           # Set flow in capacity unit
+# }
+
+SIMULATED_DDE_NUMBERS = [8, 9, 21, 92, 129, 205, 206]
+
+# The measure can read up to 131% of FULL_SCALE
+MAX_MEASURE = 41942
+
+
+class SimulatedClock:
+    def __init__(self, time_scale: float = 1.0) -> None:
+        """
+
+        Clock shared by the simulated instruments of a rig, where
+        time_scale simulated seconds pass per real second
+
+        """
+
+        self.time_scale = time_scale
+        self._real_start = time.monotonic()
+
+    def time(self) -> float:
+        """
+
+        :returns: Simulated seconds since the clock was created
+
+        """
+        return (time.monotonic() - self._real_start) * self.time_scale
+
+    def sleep(self, seconds: float) -> None:
+        """
+
+        Sleeps for a number of simulated seconds
+
+        :param seconds: Simulated seconds to sleep
+
+        """
+        if seconds > 0:
+            time.sleep(seconds / self.time_scale)
+
+
+class SimulatedInstrument:
+    def __init__(self,
+                 comport: str = 'SIM0',
+                 address: int = 0x80,
+                 max_flow: float = 100.0,
+                 capacity_unit: str = 'mln/min',
+                 serial_number: str = 'M00000000A',
+                 latency: float = 0.005,
+                 parameter_time: float = 0.0005,
+                 tau: float = 1.0,
+                 noise: float = 0.001,
+                 setpoint: float = 0.0,
+                 clock: SimulatedClock|None = None,
+                 seed: int|None = None) -> None:
+        """
+
+        Simulated Bronkhorst MFC with the same read/write interface as
+        propar.instrument, so a BronkhorstMFC can be built on it without
+        any hardware. The flow settles towards the setpoint as a first
+        order system with time constant tau and gaussian noise.
+
+        :param comport: Name of the simulated port
+        :param address: Propar node address of the simulated instrument
+        :param max_flow: Capacity of the MFC at 100% in capacity_unit
+        :param capacity_unit: Capacity unit returned for DDE 129
+        :param serial_number: Serial number returned for DDE 92
+        :param latency: Simulated seconds of serial round trip per request
+        :param parameter_time: Extra simulated seconds per parameter in a request
+        :param tau: Time constant of the flow settling in simulated seconds
+        :param noise: Standard deviation of the measurement noise as fraction of max_flow
+        :param setpoint: Initial setpoint as fraction of max_flow
+        :param clock: SimulatedClock shared between instruments, defaults to real time
+        :param seed: Seed for the measurement noise
+
+        """
+
+        self.comport = comport
+        self.address = address
+        self.max_flow = float(max_flow)
+        self.capacity_unit = capacity_unit
+        self.serial_number = serial_number
+        self.latency = latency
+        self.parameter_time = parameter_time
+        self.tau = tau
+        self.noise = noise
+        self.clock = clock if clock is not None else SimulatedClock()
+        self.db = pp.database()
+
+        self._random = random.Random(seed)
+        self._lock = threading.RLock()
+        self._setpoint = setpoint
+        self._flow = setpoint
+        self._updated = self.clock.time()
+
+        # Look up the DDE number of received propar parameters by process and parameter number
+        self._dde_by_propar = {}
+        for dde in SIMULATED_DDE_NUMBERS:
+            parm = self.db.get_parameter(dde)
+            self._dde_by_propar[(parm['proc_nr'], parm['parm_nr'])] = dde
+
+        self.requests = 0
+
+    def _settle(self) -> float:
+        """
+
+        Moves the flow towards the setpoint for the time passed since last update
+
+        :returns: Flow as fraction of max_flow
+
+        """
+        now = self.clock.time()
+        dt = now - self._updated
+        if self.tau > 0:
+            self._flow = self._setpoint + (self._flow - self._setpoint) * math.exp(-dt / self.tau)
+        else:
+            self._flow = self._setpoint
+        self._updated = now
+        return self._flow
+
+    def _transfer(self, n_parameters: int) -> None:
+        """
+
+        Blocks for the serial time of one request with n_parameters
+
+        """
+        self.requests += 1
+        self.clock.sleep(self.latency + self.parameter_time * n_parameters)
+
+    def get_value(self, dde_number: int) -> Any:
+        """
+
+        Current value of a parameter without any serial latency
+
+        :param dde_number: Parameter number to get
+
+        :returns: Parameter value, None if the parameter is not simulated
+
+        """
+        with self._lock:
+            return self._value(dde_number)
+
+    def _value(self, dde_number: int) -> Any:
+        flow = self._settle()
+        measured = flow + self._random.gauss(0, self.noise) if self.noise else flow
+        if dde_number == 8:
+            return min(max(int(round(measured * FULL_SCALE)), 0), MAX_MEASURE)
+        elif dde_number == 9:
+            return int(round(self._setpoint * FULL_SCALE))
+        elif dde_number == 21:
+            return self.max_flow
+        elif dde_number == 92:
+            return self.serial_number
+        elif dde_number == 129:
+            # The instrument pads the unit to 7 characters
+            return f'{self.capacity_unit:<7}'
+        elif dde_number == 205:
+            return max(measured, 0) * self.max_flow
+        elif dde_number == 206:
+            return self._setpoint * self.max_flow
+        return None
+
+    def set_value(self, dde_number: int, value: Any) -> bool:
+        """
+
+        Sets a parameter without any serial latency, only the setpoints
+        (DDE 9 and 206) can be written
+
+        :param dde_number: Parameter number to set
+        :param value: Value of the parameter
+
+        :returns: True if the parameter was set
+
+        """
+        with self._lock:
+            return self._apply(dde_number, value)
+
+    def _apply(self, dde_number: int, value: Any) -> bool:
+        self._settle()
+        if dde_number == 9:
+            self._setpoint = min(max(int(value), 0), FULL_SCALE) / FULL_SCALE
+        elif dde_number == 206:
+            self._setpoint = min(max(float(value) / self.max_flow, 0), 1)
+        else:
+            return False
+        return True
+
+    def dde_number(self, parameter: dict) -> int|None:
+        """
+
+        :param parameter: Propar parameter object
+
+        :returns: DDE number of the parameter, None if it is not simulated
+
+        """
+        if 'dde_nr' in parameter:
+            return parameter['dde_nr']
+        return self._dde_by_propar.get((parameter['proc_nr'], parameter['parm_nr']))
+
+    def readParameter(self, dde_nr: int, channel: int|None = None) -> Any:
+        """
+
+        :param dde_nr: Parameter number to read
+
+        :returns: Parameter value, None if the parameter is not simulated
+
+        """
+        with self._lock:
+            self._transfer(1)
+            return self._value(dde_nr)
+
+    def writeParameter(self, dde_nr: int, data: Any, channel: int|None = None) -> bool:
+        """
+
+        :param dde_nr: Parameter number to write
+        :param data: Value to write to the parameter
+
+        :returns: True if the parameter was written
+
+        """
+        with self._lock:
+            self._transfer(1)
+            return self._apply(dde_nr, data)
+
+    def read_parameters(self, parameters: list[dict], callback=None, channel: int|None = None) -> list[dict]:
+        """
+
+        Chained read of several parameters in one simulated request
+
+        :param parameters: List of propar parameter objects
+
+        :returns: List of parameter objects with data and status
+
+        """
+        with self._lock:
+            self._transfer(len(parameters))
+            response = []
+            for parameter in parameters:
+                value = self._value(self.dde_number(parameter))
+                status = pp.PP_STATUS_OK if value is not None else pp.PP_STATUS_PARM_NUMBER
+                response.append(dict(parameter, data=value, status=status))
+        if callback is not None:
+            callback(response)
+            return None
+        return response
+
+    def write_parameters(self, parameters: list[dict], command=pp.PP_COMMAND_SEND_PARM_WITH_ACK,
+                         callback=None, channel: int|None = None) -> int:
+        """
+
+        Chained write of several parameters in one simulated request
+
+        :param parameters: List of propar parameter objects with data
+
+        :returns: Propar status code, 0 if all parameters were written
+
+        """
+        with self._lock:
+            self._transfer(len(parameters))
+            status = pp.PP_STATUS_OK
+            for parameter in parameters:
+                if not self._apply(self.dde_number(parameter), parameter['data']):
+                    status = pp.PP_STATUS_PARM_NUMBER
+        if callback is not None:
+            callback(status)
+        return status
+
+
+def simulated_bronkhorsts(time_scale: float = 1.0,
+                          latency: float = 0.005,
+                          tau: float = 1.0,
+                          noise: float = 0.001,
+                          configs: list[tuple[float, str]] = [(100, 'mln/min'), (2.5, 'ln/min')]) -> list:
+    """
+
+    Builds BronkhorstMFC objects on simulated instruments sharing one clock,
+    by default the 100 mLn/min span and 2.5 Ln/min dilution MFC of the rig
+
+    :param time_scale: Simulated seconds per real second
+    :param latency: Simulated serial round trip per request in seconds
+    :param tau: Time constant of the flow settling in simulated seconds
+    :param noise: Standard deviation of the measurement noise as fraction of max_flow
+    :param configs: Capacity and capacity unit of each simulated MFC
+
+    :return: List of BronkhorstMFC objects, the shared clock is available
+             as the clock attribute of each communication object
+
+    """
+
+    # Imported here so the simulated instruments can be used without airpy
+    from bronkhorst_mfc_test.airpy import BronkhorstMFC
+
+    clock = SimulatedClock(time_scale)
+    bronkhorsts = []
+    for idx, (max_flow, unit) in enumerate(configs):
+        instrument = SimulatedInstrument(comport=f'SIM{idx}',
+                                         max_flow=max_flow,
+                                         capacity_unit=unit,
+                                         serial_number=f'M{idx:08d}A',
+                                         latency=latency,
+                                         tau=tau,
+                                         noise=noise,
+                                         clock=clock)
+        bronkhorsts.append(BronkhorstMFC(instrument.comport, communication=instrument))
+    return bronkhorsts
+
+
+def benchmark_poll_loop(bronkhorsts: list,
+                        dde_numbers: list[int] = [205],
+                        duration: float = 600,
+                        period: float = 1.0) -> dict:
+    """
+
+    Polls simulated MFCs at a fixed simulated period and reports how many
+    polls fit in the simulated duration
+
+    :param bronkhorsts: BronkhorstMFC objects built on simulated instruments
+    :param dde_numbers: Parameter numbers to read from every MFC per poll
+    :param duration: Simulated duration of the benchmark in seconds
+    :param period: Simulated time between polls in seconds
+
+    :return: Dictionary with the number of polls, requests and real run time
+
+    """
+
+    clock = bronkhorsts[0].communication.clock
+    requests = sum(bh.communication.requests for bh in bronkhorsts)
+    real_start = time.perf_counter()
+    start = clock.time()
+    polls = 0
+    while clock.time() - start < duration:
+        for bh in bronkhorsts:
+            bh.read_bronkhorst(dde_numbers)
+        polls += 1
+        clock.sleep(period)
+
+    result = {'polls': polls,
+              'requests': sum(bh.communication.requests for bh in bronkhorsts) - requests,
+              'simulated_time': clock.time() - start,
+              'real_time': time.perf_counter() - real_start}
+    print(f'{result["polls"]} polls with {result["requests"]} requests in '
+          f'{result["simulated_time"]:.0f} simulated s ({result["real_time"]:.2f} real s)')
+    return result
+
+
+if __name__ == '__main__':
+    # Ten simulated minutes of 1 s polling at 100x real time
+    bhs = simulated_bronkhorsts(time_scale=100)
+    bhs[0].write_bronkhorst(206, 50)
+    bhs[1].write_bronkhorst(206, 1.5)
+    benchmark_poll_loop(bhs, dde_numbers=[205, 206])
+    print({bh.port: bh.read_bronkhorst([205, 206]) for bh in bhs})
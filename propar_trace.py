@@ -0,0 +1,424 @@
+import json
+import time
+import struct
+import threading
+import propar as pp
+from typing import Any
+from collections import deque
+
+#######################################################################
+###-----------------Propar traffic capture and replay---------------###
+#######################################################################
+
+# A trace file starts with MAGIC, the length of a JSON header and the header
+# with the port, node address and settings of the recorded MFC. Every call
+# follows as a RECORD of time since the start, duration, operation and the
+# length of the packed request and response
+MAGIC = b'PRPTRC1\n'
+HEADER_LENGTH = struct.Struct('<I')
+RECORD = struct.Struct('<ddBI')
+
+# Operations of the propar.instrument interface
+READ = 1            # readParameter(dde_nr)
+WRITE = 2           # writeParameter(dde_nr, data)
+READ_CHAINED = 3    # read_parameters(parameters)
+WRITE_CHAINED = 4   # write_parameters(parameters)
+OPERATION_NAMES = {READ: 'read', WRITE: 'write', READ_CHAINED: 'read_chained', WRITE_CHAINED: 'write_chained'}
+
+# Values are packed with a type tag
+TAG_NONE, TAG_INT, TAG_FLOAT, TAG_STR, TAG_BOOL = range(5)
+NO_DDE = 0xFFFF
+PARAMETER = struct.Struct('<HBBB')
+
+
+def pack_value(value: Any) -> bytes:
+    """
+
+    :param value: None, bool, int, float or string value of a parameter
+
+    :return: Tagged bytes of the value
+
+    """
+    if value is None:
+        return bytes([TAG_NONE])
+    elif isinstance(value, bool):
+        return struct.pack('<B?', TAG_BOOL, value)
+    elif isinstance(value, int):
+        return struct.pack('<Bq', TAG_INT, value)
+    elif isinstance(value, float):
+        return struct.pack('<Bd', TAG_FLOAT, value)
+    data = str(value).encode('utf-8')
+    return struct.pack('<BH', TAG_STR, len(data)) + data
+
+
+def unpack_value(buffer: bytes, offset: int) -> tuple[Any, int]:
+    """
+
+    :param buffer: Bytes holding a packed value
+    :param offset: Position of the value in buffer
+
+    :return: Tuple of the value and the position after it
+
+    """
+    tag = buffer[offset]
+    offset += 1
+    if tag == TAG_NONE:
+        return None, offset
+    elif tag == TAG_BOOL:
+        return bool(buffer[offset]), offset + 1
+    elif tag == TAG_INT:
+        return struct.unpack_from('<q', buffer, offset)[0], offset + 8
+    elif tag == TAG_FLOAT:
+        return struct.unpack_from('<d', buffer, offset)[0], offset + 8
+    length = struct.unpack_from('<H', buffer, offset)[0]
+    offset += 2
+    return buffer[offset:offset + length].decode('utf-8'), offset + length
+
+
+def pack_parameters(parameters: list[dict], with_data: bool = False) -> bytes:
+    data = bytes([len(parameters)])
+    for parameter in parameters:
+        data += PARAMETER.pack(parameter.get('dde_nr', NO_DDE), parameter['proc_nr'],
+                               parameter['parm_nr'], parameter['parm_type'])
+        if with_data:
+            data += pack_value(parameter.get('data'))
+    return data
+
+
+def unpack_parameters(buffer: bytes, offset: int, with_data: bool = False) -> tuple[list[dict], int]:
+    parameters = []
+    count = buffer[offset]
+    offset += 1
+    for _ in range(count):
+        dde, proc_nr, parm_nr, parm_type = PARAMETER.unpack_from(buffer, offset)
+        offset += PARAMETER.size
+        parameter = {'proc_nr': proc_nr, 'parm_nr': parm_nr, 'parm_type': parm_type}
+        if dde != NO_DDE:
+            parameter['dde_nr'] = dde
+        if with_data:
+            parameter['data'], offset = unpack_value(buffer, offset)
+        parameters.append(parameter)
+    return parameters, offset
+
+
+def request_key(operation: int, request: Any) -> tuple:
+    """
+
+    :return: Key identifying a request independent of its values
+
+    """
+    if operation == READ:
+        return (operation, request)
+    elif operation == WRITE:
+        return (operation, request[0])
+    return (operation,) + tuple((p['proc_nr'], p['parm_nr']) for p in request)
+
+
+class RecordingInstrument:
+    def __init__(self, communication: Any, path: str, metadata: dict|None = None) -> None:
+        """
+
+        Wraps an object with the propar.instrument interface and appends
+        every call with its request, response, start time and duration to
+        a binary trace file. Other attributes are passed on
+
+        :param communication: propar.instrument or an object with its interface
+        :param path: Path of the trace file, overwritten if it exists
+        :param metadata: Settings of the MFC stored in the header, e.g. max_flow
+
+        """
+
+        self.communication = communication
+        self.path = path
+        self.records = 0
+        self._start = time.monotonic()
+        self._lock = threading.Lock()
+
+        header = {'comport': getattr(communication, 'comport', None),
+                  'address': getattr(communication, 'address', None),
+                  'started': time.time(),
+                  **(metadata or {})}
+        header = json.dumps(header).encode('utf-8')
+        self._file = open(path, 'wb')
+        self._file.write(MAGIC + HEADER_LENGTH.pack(len(header)) + header)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.communication, name)
+
+    def _record(self, operation: int, start: float, duration: float, payload: bytes) -> None:
+        with self._lock:
+            if self._file.closed:
+                return
+            self._file.write(RECORD.pack(start - self._start, duration, operation, len(payload)) + payload)
+            self.records += 1
+
+    def readParameter(self, dde_nr: int, channel: int|None = None) -> Any:
+        start = time.monotonic()
+        value = self.communication.readParameter(dde_nr, channel)
+        self._record(READ, start, time.monotonic() - start, struct.pack('<H', dde_nr) + pack_value(value))
+        return value
+
+    def writeParameter(self, dde_nr: int, data: Any, channel: int|None = None) -> Any:
+        start = time.monotonic()
+        result = self.communication.writeParameter(dde_nr, data, channel)
+        self._record(WRITE, start, time.monotonic() - start,
+                     struct.pack('<H', dde_nr) + pack_value(data) + pack_value(result))
+        return result
+
+    def read_parameters(self, parameters: list[dict], callback=None, channel: int|None = None) -> Any:
+        request = pack_parameters(parameters)
+        start = time.monotonic()
+        response = self.communication.read_parameters(parameters, callback, channel)
+        duration = time.monotonic() - start
+        if response is not None:
+            answer = bytes([len(response)])
+            for item in response:
+                answer += bytes([item.get('status', pp.PP_STATUS_OK)]) + pack_value(item.get('data'))
+            self._record(READ_CHAINED, start, duration, request + answer)
+        return response
+
+    def write_parameters(self, parameters: list[dict], command: int = pp.PP_COMMAND_SEND_PARM_WITH_ACK,
+                         callback=None, channel: int|None = None) -> Any:
+        request = pack_parameters(parameters, with_data=True)
+        start = time.monotonic()
+        status = self.communication.write_parameters(parameters, command, callback, channel)
+        self._record(WRITE_CHAINED, start, time.monotonic() - start, request + pack_value(status))
+        return status
+
+    def flush(self) -> None:
+        with self._lock:
+            if not self._file.closed:
+                self._file.flush()
+
+    def close(self) -> None:
+        """
+
+        Writes the remaining records and closes the trace file
+
+        """
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+
+
+def record_bronkhorst(bh_mfc: Any, path: str) -> RecordingInstrument:
+    """
+
+    Routes all I/O of a BronkhorstMFC through a RecordingInstrument. The
+    capacity, capacity unit and serial number are stored in the header,
+    so the trace can be replayed without the reads done when connecting
+
+    :param bh_mfc: BronkhorstMFC object to record
+    :param path: Path of the trace file
+
+    :return: The RecordingInstrument, close it to finish the trace
+
+    """
+    metadata = {'port': bh_mfc.port,
+                'max_flow': bh_mfc.max_flow,
+                'readout_unit': bh_mfc.readout_unit,
+                'serial_number': bh_mfc.serial_number}
+    recorder = RecordingInstrument(bh_mfc.communication, path, metadata)
+    bh_mfc.communication = recorder
+    return recorder
+
+
+def read_trace(path: str) -> tuple[dict, list[dict]]:
+    """
+
+    :param path: Path of the trace file
+
+    :return: Tuple of the header and a list of records with time, duration,
+             operation, request and response
+
+    """
+    with open(path, 'rb') as file:
+        buffer = file.read()
+    if not buffer.startswith(MAGIC):
+        raise ValueError(f'{path} is not a propar trace file.')
+    offset = len(MAGIC)
+    length = HEADER_LENGTH.unpack_from(buffer, offset)[0]
+    offset += HEADER_LENGTH.size
+    header = json.loads(buffer[offset:offset + length])
+    offset += length
+
+    records = []
+    while offset + RECORD.size <= len(buffer):
+        start, duration, operation, length = RECORD.unpack_from(buffer, offset)
+        offset += RECORD.size
+        payload = buffer[offset:offset + length]
+        offset += length
+        if len(payload) < length:
+            # The last record of a trace that was not closed can be cut off
+            break
+
+        if operation == READ:
+            request = struct.unpack_from('<H', payload)[0]
+            response, _ = unpack_value(payload, 2)
+        elif operation == WRITE:
+            dde = struct.unpack_from('<H', payload)[0]
+            data, position = unpack_value(payload, 2)
+            request = (dde, data)
+            response, _ = unpack_value(payload, position)
+        elif operation == READ_CHAINED:
+            request, position = unpack_parameters(payload, 0)
+            response = []
+            count = payload[position]
+            position += 1
+            for _ in range(count):
+                status = payload[position]
+                data, position = unpack_value(payload, position + 1)
+                response.append({'status': status, 'data': data})
+        else:
+            request, position = unpack_parameters(payload, 0, with_data=True)
+            response, _ = unpack_value(payload, position)
+        records.append({'time': start, 'duration': duration, 'operation': operation,
+                        'request': request, 'response': response})
+    return header, records
+
+
+class ReplayInstrument:
+    def __init__(self, path: str, speed: float|None = 1.0, strict: bool = False) -> None:
+        """
+
+        Serves the responses of a trace file with the propar.instrument
+        interface. Each request gets the next recorded response to the same
+        request, after the recorded duration divided by speed
+
+        :param path: Path of the trace file
+        :param speed: Replay speed, 1.0 is the original timing, 10.0 ten
+                      times faster and None without any delay
+        :param strict: Raise LookupError when a request has no recorded
+                       response left, instead of repeating the last response
+
+        """
+
+        self.header, self.records = read_trace(path)
+        self.speed = speed
+        self.strict = strict
+        self.comport = self.header.get('comport') or self.header.get('port')
+        self.address = self.header.get('address') or 0x80
+        self.db = pp.database()
+        self.requests = 0
+
+        self._queues = {}
+        for record in self.records:
+            self._queues.setdefault(request_key(record['operation'], record['request']), deque()).append(record)
+        self._last = {}
+        self._lock = threading.Lock()
+
+        # Settings read when connecting are answered from the header if they were not recorded
+        self._header_values = {21: self.header.get('max_flow'),
+                               129: self.header.get('readout_unit'),
+                               92: self.header.get('serial_number')}
+
+    def _serve(self, operation: int, request: Any) -> Any:
+        key = request_key(operation, request)
+        with self._lock:
+            self.requests += 1
+            queue = self._queues.get(key)
+            if queue:
+                record = queue.popleft()
+                self._last[key] = record
+            elif self.strict:
+                raise LookupError(f'No recorded {OPERATION_NAMES[operation]} response left for {key[1:]}.')
+            else:
+                record = self._last.get(key)
+        if record is None:
+            return None
+        if self.speed:
+            time.sleep(record['duration'] / self.speed)
+        return record['response']
+
+    def readParameter(self, dde_nr: int, channel: int|None = None) -> Any:
+        key = request_key(READ, dde_nr)
+        if key not in self._queues and self._header_values.get(dde_nr) is not None:
+            return self._header_values[dde_nr]
+        return self._serve(READ, dde_nr)
+
+    def writeParameter(self, dde_nr: int, data: Any, channel: int|None = None) -> Any:
+        return self._serve(WRITE, (dde_nr, data))
+
+    def read_parameters(self, parameters: list[dict], callback=None, channel: int|None = None) -> list[dict]:
+        response = self._serve(READ_CHAINED, parameters)
+        if response is None:
+            response = [{'status': pp.PP_STATUS_TIMEOUT_ANSWER, 'data': None}]
+        elif len(response) == len(parameters):
+            response = [dict(parameter, **item) for parameter, item in zip(parameters, response)]
+        else:
+            response = [dict(item) for item in response]
+        if callback is not None:
+            callback(response)
+            return None
+        return response
+
+    def write_parameters(self, parameters: list[dict], command: int = pp.PP_COMMAND_SEND_PARM_WITH_ACK,
+                         callback=None, channel: int|None = None) -> Any:
+        status = self._serve(WRITE_CHAINED, parameters)
+        if callback is not None:
+            callback(status)
+        return status
+
+
+def replay_bronkhorst(path: str, speed: float|None = 1.0, strict: bool = False) -> Any:
+    """
+
+    :param path: Path of the trace file
+    :param speed: Replay speed, 1.0 is the original timing and None without any delay
+    :param strict: Raise LookupError when the trace runs out of responses
+
+    :return: BronkhorstMFC object answering from the trace
+
+    """
+
+    # Imported here so traces can be read without airpy
+    from bronkhorst_mfc_test.airpy import BronkhorstMFC
+
+    replay = ReplayInstrument(path, speed, strict)
+    return BronkhorstMFC(replay.comport, communication=replay)
+
+
+def replay_requests(path: str, communication: Any, speed: float|None = 1.0) -> dict:
+    """
+
+    Sends the recorded requests of a trace to an instrument with the
+    recorded spacing and compares the latencies, e.g. to test a new
+    version of the I/O code against captured production traffic
+
+    :param path: Path of the trace file
+    :param communication: Object with the propar.instrument interface to send to
+    :param speed: Replay speed, 1.0 is the original spacing and None back to back
+
+    :return: Dictionary with the recorded and replayed latency per request
+             and the mean of both
+
+    """
+
+    _, records = read_trace(path)
+    start = time.monotonic()
+    results = []
+    for record in records:
+        if speed:
+            delay = start + record['time'] / speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+        operation, request = record['operation'], record['request']
+        sent = time.monotonic()
+        if operation == READ:
+            communication.readParameter(request)
+        elif operation == WRITE:
+            communication.writeParameter(*request)
+        elif operation == READ_CHAINED:
+            communication.read_parameters([dict(parameter) for parameter in request])
+        else:
+            communication.write_parameters([dict(parameter) for parameter in request])
+        results.append({'operation': OPERATION_NAMES[operation],
+                        'recorded': record['duration'],
+                        'replayed': time.monotonic() - sent})
+
+    recorded = sum(r['recorded'] for r in results) / len(results) if results else 0.0
+    replayed = sum(r['replayed'] for r in results) / len(results) if results else 0.0
+    print(f'Replayed {len(results)} requests from {path}: mean latency {recorded*1000:.2f} ms recorded, '
+          f'{replayed*1000:.2f} ms replayed')
+    return {'requests': results, 'recorded_mean': recorded, 'replayed_mean': replayed}
@@ -0,0 +1,66 @@
+import os
+import glob
+import gzip
+import datetime as dt
+from bronkhorst_mfc_test.mfc_log_writer import RotatingLogWriter, compress_log
+
+#######################################################################
+###------------------Rotating log writer regressions----------------###
+#######################################################################
+
+HEADER = 'Date,Bronkhorst 100SCCM [mLn/min], Bronkhorst 2.5SLM[mLn/min]'
+DATE = dt.date(2026, 1, 1)
+
+
+def read_rows(directory: str) -> list[str]:
+    """
+
+    :param directory: Directory of the log files
+
+    :return: Rows of all plain and gzipped log files without the headers
+
+    """
+    rows = []
+    for path in sorted(glob.glob(os.path.join(directory, '*.csv*'))):
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rt') as file:
+            rows += [line for line in file.read().splitlines() if line != HEADER]
+    return rows
+
+
+def log_run(directory: str, run: int, rows: int) -> list[str]:
+    """
+
+    Logs rows on DATE with size rotation and compression, as a restart of data_logging does
+
+    :param directory: Directory of the log files
+    :param run: Number of the run, part of every row
+    :param rows: Number of rows to log
+
+    :return: The logged rows
+
+    """
+    writer = RotatingLogWriter(directory, 'flow', HEADER, max_bytes=300, compress=True, date=DATE, flush_rows=1)
+    logged = [f'2026-01-01 00:{run:02d}:{idx:02d},{run}.0,{idx}.0' for idx in range(rows)]
+    for row in logged:
+        writer.write_row(row, DATE)
+    writer.close()
+    return logged
+
+
+def test_restart_keeps_compressed_parts(tmp_path):
+    # A restart on the same day must not reopen or overwrite the gzipped parts of the first run
+    logged = log_run(str(tmp_path), 1, 40) + log_run(str(tmp_path), 2, 40)
+    assert sorted(read_rows(str(tmp_path))) == sorted(logged)
+    for path in glob.glob(os.path.join(str(tmp_path), '*.csv.gz')):
+        assert not os.path.exists(path[:-len('.gz')])
+
+
+def test_compress_log_appends_to_existing(tmp_path):
+    path = os.path.join(str(tmp_path), '2026-01-01_flow.csv')
+    for rows in (['a,1', 'b,2'], ['c,3']):
+        with open(path, 'w') as file:
+            file.write('\n'.join(rows) + '\n')
+        compress_log(path)
+    with gzip.open(f'{path}.gz', 'rt') as file:
+        assert file.read().splitlines() == ['a,1', 'b,2', 'c,3']